@@ -4,14 +4,85 @@ Middleware para proteger acesso ao painel administrativo
 """
 import os
 import logging
+import ipaddress
+from bisect import bisect_right
+from functools import lru_cache
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Iterable, List, Optional, Tuple
 from fastapi import HTTPException, Request
 from supabase_service import get_supabase_service
 from audit_service import get_audit_service
+from shared_cache import SharedCache
 
 logger = logging.getLogger(__name__)
 
+# Entradas da whitelist por empresa (lista de IPs/CIDRs vinda do banco).
+# A tabela ip_whitelist é editada direto no Supabase, sem passar pelo backend:
+# alterações passam a valer quando a entrada expira (ADMIN_IP_WHITELIST_TTL)
+_company_whitelist_cache = SharedCache(
+    'admin_ip_whitelist',
+    maxsize=1000,
+    ttl=float(os.getenv('ADMIN_IP_WHITELIST_TTL', '60'))
+)
+
+
+class IPRangeMatcher:
+    """
+    Whitelist compilada: cada IP/CIDR vira um intervalo inteiro [início, fim];
+    os intervalos são ordenados e mesclados, e a busca é um bisect (O(log n)).
+    IPv4 e IPv6 ficam em tabelas separadas.
+    """
+    
+    def __init__(self, entries: Iterable[str]):
+        ranges = {4: [], 6: []}
+        for entry in entries:
+            entry = (entry or '').strip()
+            if not entry:
+                continue
+            try:
+                network = ipaddress.ip_network(entry, strict=False)
+            except ValueError:
+                logger.warning(f"⚠️ Entrada inválida na whitelist de IPs ignorada: {entry}")
+                continue
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address))
+            )
+        
+        self._starts = {}
+        self._ends = {}
+        for version, items in ranges.items():
+            merged: List[List[int]] = []
+            for start, end in sorted(items):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._starts[version] = [r[0] for r in merged]
+            self._ends[version] = [r[1] for r in merged]
+    
+    def __len__(self) -> int:
+        return len(self._starts[4]) + len(self._starts[6])
+    
+    def __contains__(self, ip: str) -> bool:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        
+        # ::ffff:1.2.3.4 (socket dual-stack) casa com as regras IPv4
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        
+        starts = self._starts[address.version]
+        value = int(address)
+        index = bisect_right(starts, value) - 1
+        return index >= 0 and value <= self._ends[address.version][index]
+
+
+@lru_cache(maxsize=256)
+def _compile_whitelist(entries: Tuple[str, ...]) -> IPRangeMatcher:
+    return IPRangeMatcher(entries)
+
 
 class AdminAccessControl:
     """Controle de acesso ao painel administrativo"""
@@ -20,12 +91,13 @@ class AdminAccessControl:
         # Whitelist de IPs (opcional, via env var)
         whitelist_str = os.getenv('ADMIN_IP_WHITELIST', '')
         self.ip_whitelist = [ip.strip() for ip in whitelist_str.split(',') if ip.strip()]
+        self.global_matcher = IPRangeMatcher(self.ip_whitelist)
         
         # Se whitelist vazia, não restringe por IP
         self.ip_restriction_enabled = len(self.ip_whitelist) > 0
         
         if self.ip_restriction_enabled:
-            logger.info(f"🔒 IP Whitelist ativada com {len(self.ip_whitelist)} IPs")
+            logger.info(f"🔒 IP Whitelist ativada com {len(self.ip_whitelist)} IPs/faixas")
         else:
             logger.info("⚠️ IP Whitelist DESATIVADA - todos IPs permitidos")
     
@@ -45,33 +117,17 @@ class AdminAccessControl:
             return True, None
         
         # Verificar whitelist global (.env)
-        if ip_address in self.ip_whitelist:
+        if ip_address in self.global_matcher:
             logger.info(f"✅ IP {ip_address} autorizado (whitelist global)")
             return True, None
         
-        # Verificar whitelist da empresa (banco de dados)
+        # Verificar whitelist da empresa (IPs e faixas CIDR, cacheada)
         if company_id:
             try:
-                db = get_supabase_service()
-                result = db.client.table('ip_whitelist')\
-                    .select('*')\
-                    .eq('company_id', company_id)\
-                    .eq('enabled', True)\
-                    .execute()
-                
-                if result.data:
-                    for entry in result.data:
-                        allowed_ip = entry.get('ip_address', '')
-                        
-                        # Suporte para CIDR (ex: 192.168.1.0/24)
-                        if '/' in allowed_ip:
-                            # TODO: Implementar verificação CIDR
-                            pass
-                        else:
-                            # Match exato
-                            if ip_address == allowed_ip:
-                                logger.info(f"✅ IP {ip_address} autorizado (whitelist empresa {company_id})")
-                                return True, None
+                matcher = await self.get_company_matcher(company_id)
+                if ip_address in matcher:
+                    logger.info(f"✅ IP {ip_address} autorizado (whitelist empresa {company_id})")
+                    return True, None
             
             except Exception as e:
                 logger.error(f"❌ Erro ao verificar IP whitelist: {e}")
@@ -80,6 +136,21 @@ class AdminAccessControl:
         logger.warning(f"🚫 IP {ip_address} NÃO autorizado para acessar admin")
         return False, f"IP {ip_address} não autorizado para acesso administrativo"
     
+    async def get_company_matcher(self, company_id: str) -> IPRangeMatcher:
+        """Whitelist compilada da empresa (entradas cacheadas, sem ida ao banco por request)"""
+        hit, entries, _negative = await _company_whitelist_cache.get(company_id)
+        if not hit:
+            db = get_supabase_service()
+            result = db.client.table('ip_whitelist')\
+                .select('ip_address')\
+                .eq('company_id', company_id)\
+                .eq('enabled', True)\
+                .execute()
+            entries = sorted({row.get('ip_address') or '' for row in (result.data or [])})
+            await _company_whitelist_cache.set(company_id, entries)
+        
+        return _compile_whitelist(tuple(entries))
+    
     async def log_admin_access(
         self,
         user_id: str,
@@ -3,14 +3,35 @@ Admin endpoints - Gerenciamento de usuários
 """
 from fastapi import APIRouter, HTTPException, Depends, Request
 from pydantic import BaseModel
-from typing import Optional
+from typing import AsyncIterator, List, Optional, Tuple
+import os
+import base64
+import asyncio
 import logging
 from security_utils import get_authenticated_user, require_role
-from supabase_service import get_supabase_service
+from supabase_service import get_supabase_service, is_missing_function
 from audit_service import get_audit_service
+from shared_cache import SharedCache
+from send_logging import get_send_logger
+from profiling import get_profiler
 
 logger = logging.getLogger(__name__)
 
+# Total de usuários do painel admin (count exato é caro; muda pouco)
+_users_total_cache = SharedCache(
+    'admin_users_total',
+    maxsize=4,
+    ttl=float(os.getenv('ADMIN_USERS_COUNT_TTL', '60'))
+)
+
+# Varredura de usuários órfãos
+ORPHAN_AUTH_PAGE_SIZE = int(os.getenv('ORPHAN_AUTH_PAGE_SIZE', '500'))  # GoTrue aceita até 1000
+ORPHAN_PROFILE_CHUNK = 200  # IDs por consulta in_() em profiles
+ORPHAN_DELETE_CONCURRENCY = int(os.getenv('ORPHAN_DELETE_CONCURRENCY', '5'))
+
+# IDs de campanha por delete in_() no fallback da deleção de usuário
+USER_DELETE_CHUNK = 100
+
 admin_router = APIRouter(prefix="/api/admin", tags=["admin"])
 
 
@@ -212,65 +233,166 @@ async def activate_user_account(
 async def list_all_users(
     auth_user: dict = Depends(require_role("super_admin")),
     limit: int = 50,
-    offset: int = 0
+    offset: int = 0,
+    cursor: Optional[str] = None
 ):
     """
     Lista todos os usuários com seus planos e status
     
+    Paginação: use `next_cursor` da resposta em `cursor` para a próxima página
+    (keyset por created_at/id). `offset` continua aceito para compatibilidade.
+    
     IMPORTANTE: Requer role super_admin
     """
     try:
         db = get_supabase_service()
+        limit = max(1, min(limit, 200))
         
-        # Buscar profiles com quotas (LEFT JOIN simulado)
-        profiles_result = db.client.table('profiles')\
-            .select('id, email, full_name, company_id, created_at')\
-            .order('created_at', desc=True)\
-            .range(offset, offset + limit - 1)\
-            .execute()
-        
-        users = []
-        for profile in (profiles_result.data or []):
-            user_id = profile['id']
-            
-            # Buscar quota do usuário
-            quota_result = db.client.table('user_quotas')\
-                .select('plan_type, plan_name, subscription_status, plan_expires_at')\
-                .eq('user_id', user_id)\
-                .maybe_single()\
-                .execute()
-            
-            quota = quota_result.data if quota_result.data else {}
-            
-            users.append({
-                'id': user_id,
-                'email': profile['email'],
-                'full_name': profile.get('full_name'),
-                'company_id': profile.get('company_id'),
-                'plan_type': quota.get('plan_type', 'sem_plano'),
-                'plan_name': quota.get('plan_name', 'Sem Plano'),
-                'status': quota.get('subscription_status', 'inactive'),
-                'expires_at': quota.get('plan_expires_at'),
-                'created_at': profile['created_at']
-            })
-        
-        # Contar total
-        count_result = db.client.table('profiles')\
-            .select('id', count='exact')\
-            .execute()
+        try:
+            # Perfil + quota + roles em um único SELECT
+            query = db.client.table('admin_user_overview')\
+                .select('id, email, full_name, company_id, created_at, plan_type, plan_name, subscription_status, plan_expires_at, roles')
+            rows = _paginate_users(query, limit, offset, cursor).execute().data or []
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.warning(f"View admin_user_overview not available, using fallback: {e}")
+            rows = _list_users_fallback(db, limit, offset, cursor)
+        
+        users = [{
+            'id': row['id'],
+            'email': row['email'],
+            'full_name': row.get('full_name'),
+            'company_id': row.get('company_id'),
+            'plan_type': row.get('plan_type') or 'sem_plano',
+            'plan_name': row.get('plan_name') or 'Sem Plano',
+            'status': row.get('subscription_status') or 'inactive',
+            'expires_at': row.get('plan_expires_at'),
+            'roles': row.get('roles') or [],
+            'created_at': row['created_at']
+        } for row in rows]
+        
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = _encode_user_cursor(rows[-1])
         
         return {
             'users': users,
-            'total': count_result.count or len(users),
+            'total': await _count_profiles(db) or len(users),
             'limit': limit,
-            'offset': offset
+            'offset': offset,
+            'next_cursor': next_cursor
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao listar usuários: {e}")
         raise HTTPException(status_code=500, detail=f"Erro ao listar: {str(e)}")
 
 
+def _encode_user_cursor(row: dict) -> str:
+    return base64.urlsafe_b64encode(f"{row['created_at']}|{row['id']}".encode()).decode()
+
+
+def _decode_user_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, user_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+        return created_at, user_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def _paginate_users(query, limit: int, offset: int, cursor: Optional[str]):
+    """Ordena por (created_at, id) desc e aplica cursor (keyset) ou offset"""
+    query = query.order('created_at', desc=True).order('id', desc=True)
+    if cursor:
+        created_at, user_id = _decode_user_cursor(cursor)
+        return query\
+            .or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{user_id})')\
+            .limit(limit)
+    return query.range(offset, offset + limit - 1)
+
+
+def _list_users_fallback(db, limit: int, offset: int, cursor: Optional[str]) -> list:
+    """Sem a view: perfis da página + quotas e roles em uma query cada (in_)"""
+    query = db.client.table('profiles').select('id, email, full_name, company_id, created_at')
+    profiles = _paginate_users(query, limit, offset, cursor).execute().data or []
+    user_ids = [p['id'] for p in profiles]
+    if not user_ids:
+        return []
+    
+    quotas = db.client.table('user_quotas')\
+        .select('user_id, plan_type, plan_name, subscription_status, plan_expires_at')\
+        .in_('user_id', user_ids)\
+        .execute().data or []
+    roles = db.client.table('user_roles')\
+        .select('user_id, role')\
+        .in_('user_id', user_ids)\
+        .execute().data or []
+    
+    quota_by_user = {q['user_id']: q for q in quotas}
+    roles_by_user: dict = {}
+    for r in roles:
+        roles_by_user.setdefault(r['user_id'], set()).add(r['role'])
+    
+    return [{
+        **profile,
+        **{k: v for k, v in quota_by_user.get(profile['id'], {}).items() if k != 'user_id'},
+        'roles': sorted(roles_by_user.get(profile['id'], set()))
+    } for profile in profiles]
+
+
+async def _count_profiles(db) -> int:
+    """Total de perfis (cacheado - o count exato varre a tabela)"""
+    hit, total, _negative = await _users_total_cache.get('profiles')
+    if hit:
+        return total
+    
+    count_result = db.client.table('profiles')\
+        .select('id', count='exact')\
+        .limit(1)\
+        .execute()
+    total = count_result.count or 0
+    await _users_total_cache.set('profiles', total)
+    return total
+
+
+async def iter_orphan_users(db) -> AsyncIterator[Tuple[List[dict], int]]:
+    """
+    Percorre auth.users página a página e, para cada página, confere os IDs
+    em profiles em blocos (nunca carrega a tabela inteira).
+    
+    Yields:
+        (órfãos da página, quantidade de usuários na página)
+    """
+    page = 1
+    while True:
+        auth_users = await asyncio.to_thread(
+            db.client.auth.admin.list_users, page=page, per_page=ORPHAN_AUTH_PAGE_SIZE
+        )
+        if not auth_users:
+            return
+        
+        user_ids = [user.id for user in auth_users]
+        with_profile = set()
+        for i in range(0, len(user_ids), ORPHAN_PROFILE_CHUNK):
+            chunk = user_ids[i:i + ORPHAN_PROFILE_CHUNK]
+            result = db.client.table('profiles').select('id').in_('id', chunk).execute()
+            with_profile.update(p['id'] for p in (result.data or []))
+        
+        orphans = [{
+            'id': user.id,
+            'email': user.email,
+            'created_at': user.created_at
+        } for user in auth_users if user.id not in with_profile]
+        
+        logger.info(f"🔎 Órfãos: página {page} de auth.users - {len(auth_users)} usuários, {len(orphans)} órfãos")
+        yield orphans, len(auth_users)
+        
+        if len(auth_users) < ORPHAN_AUTH_PAGE_SIZE:
+            return
+        page += 1
 
 
 @admin_router.get("/orphan-users")
@@ -285,33 +407,17 @@ async def get_orphan_users(
     try:
         db = get_supabase_service()
         
-        # Buscar todos os usuários do Auth
-        auth_response = db.client.auth.admin.list_users()
-        auth_users = auth_response if isinstance(auth_response, list) else []
-        
-        # Buscar todos os IDs de profiles
-        profiles_result = db.client.table('profiles').select('id').execute()
-        profile_ids = set([p['id'] for p in profiles_result.data]) if profiles_result.data else set()
-        
-        # Encontrar órfãos
+        total_auth_users = 0
         orphans = []
-        for user in auth_users:
-            user_id = user.id if hasattr(user, 'id') else user.get('id')
-            email = user.email if hasattr(user, 'email') else user.get('email')
-            created_at = user.created_at if hasattr(user, 'created_at') else user.get('created_at')
-            
-            if user_id not in profile_ids:
-                orphans.append({
-                    'id': user_id,
-                    'email': email,
-                    'created_at': created_at
-                })
+        async for page_orphans, page_size in iter_orphan_users(db):
+            total_auth_users += page_size
+            orphans.extend(page_orphans)
         
         logger.info(f"Admin {auth_user['email']} listou {len(orphans)} usuários órfãos")
         
         return {
-            'total_auth_users': len(auth_users),
-            'total_profiles': len(profile_ids),
+            'total_auth_users': total_auth_users,
+            'total_profiles': await _count_profiles(db),
             'orphans_found': len(orphans),
             'orphans': orphans
         }
@@ -334,20 +440,11 @@ async def cleanup_orphan_users(
     try:
         db = get_supabase_service()
         
-        # Buscar órfãos (mesmo código do endpoint GET)
-        auth_response = db.client.auth.admin.list_users()
-        auth_users = auth_response if isinstance(auth_response, list) else []
-        
-        profiles_result = db.client.table('profiles').select('id').execute()
-        profile_ids = set([p['id'] for p in profiles_result.data]) if profiles_result.data else set()
-        
+        # Varre tudo antes de deletar: apagar durante a paginação desloca as
+        # páginas seguintes e faria pular usuários
         orphans = []
-        for user in auth_users:
-            user_id = user.id if hasattr(user, 'id') else user.get('id')
-            email = user.email if hasattr(user, 'email') else user.get('email')
-            
-            if user_id not in profile_ids:
-                orphans.append({'id': user_id, 'email': email})
+        async for page_orphans, _page_size in iter_orphan_users(db):
+            orphans.extend(page_orphans)
         
         if not orphans:
             return {
@@ -357,20 +454,27 @@ async def cleanup_orphan_users(
                 'orphan_emails': []
             }
         
-        # Deletar órfãos
-        deleted_count = 0
+        # Deletar órfãos (concorrência limitada)
         deleted_emails = []
         failed = []
+        semaphore = asyncio.Semaphore(ORPHAN_DELETE_CONCURRENCY)
+        
+        async def delete_orphan(orphan: dict) -> None:
+            async with semaphore:
+                try:
+                    await asyncio.to_thread(db.client.auth.admin.delete_user, orphan['id'])
+                    deleted_emails.append(orphan['email'])
+                    logger.info(f"✅ Órfão deletado: {orphan['email']} (ID: {orphan['id']})")
+                except Exception as e:
+                    failed.append({'email': orphan['email'], 'error': str(e)})
+                    logger.error(f"❌ Erro ao deletar órfão {orphan['email']}: {e}")
+                
+                done = len(deleted_emails) + len(failed)
+                if done % 50 == 0 or done == len(orphans):
+                    logger.info(f"🧹 Limpeza de órfãos: {done}/{len(orphans)} processados ({len(failed)} falhas)")
         
-        for orphan in orphans:
-            try:
-                db.client.auth.admin.delete_user(orphan['id'])
-                deleted_count += 1
-                deleted_emails.append(orphan['email'])
-                logger.info(f"✅ Órfão deletado: {orphan['email']} (ID: {orphan['id']})")
-            except Exception as e:
-                failed.append({'email': orphan['email'], 'error': str(e)})
-                logger.error(f"❌ Erro ao deletar órfão {orphan['email']}: {e}")
+        await asyncio.gather(*(delete_orphan(orphan) for orphan in orphans))
+        deleted_count = len(deleted_emails)
         
         logger.warning(f"Admin {auth_user['email']} deletou {deleted_count} usuários órfãos")
         
@@ -388,6 +492,19 @@ async def cleanup_orphan_users(
         raise HTTPException(status_code=500, detail=f"Erro na limpeza: {str(e)}")
 
 
+class SendLoggingRequest(BaseModel):
+    mode: Optional[str] = None
+    sample_every: Optional[int] = None
+
+
+class ProfilingRequest(BaseModel):
+    enabled: Optional[bool] = None
+    routes: Optional[List[str]] = None
+    campaigns: Optional[bool] = None
+    sample_every: Optional[int] = None
+    engine: Optional[str] = None
+
+
 class UpdateQuotaRequest(BaseModel):
     plan_type: str
     plan_name: str
@@ -524,6 +641,46 @@ async def update_user_quota(
         raise HTTPException(status_code=500, detail=f"Erro ao atualizar quota: {str(e)}")
 
 
+def _delete_user_data_fallback(db, user_id: str) -> dict:
+    """
+    Sem a RPC delete_user_data: deletes set-based pelo PostgREST
+    (contatos/logs de todas as campanhas via in_() em blocos).
+    """
+    deleted_rows = {}
+    
+    def delete_rows(table: str, column: str, values) -> None:
+        try:
+            query = db.client.table(table).delete(returning='minimal', count='exact')
+            if isinstance(values, list):
+                query = query.in_(column, values)
+            else:
+                query = query.eq(column, values)
+            result = query.execute()
+            deleted_rows[table] = deleted_rows.get(table, 0) + (result.count or 0)
+        except Exception as e:
+            logger.warning(f"Erro ao deletar {table}: {e}")
+    
+    try:
+        campaigns = db.client.table('campaigns').select('id').eq('user_id', user_id).execute()
+        campaign_ids = [c['id'] for c in (campaigns.data or [])]
+    except Exception as e:
+        logger.warning(f"Erro ao buscar campanhas: {e}")
+        campaign_ids = []
+    
+    for i in range(0, len(campaign_ids), USER_DELETE_CHUNK):
+        chunk = campaign_ids[i:i + USER_DELETE_CHUNK]
+        delete_rows('campaign_contacts', 'campaign_id', chunk)
+        delete_rows('message_logs', 'campaign_id', chunk)
+    
+    for table in ('campaigns', 'leads', 'search_history', 'notifications', 'user_quotas', 'user_roles'):
+        delete_rows(table, 'user_id', user_id)
+    
+    # Profile por último (sem try: falha aqui deve abortar a deleção)
+    db.client.table('profiles').delete().eq('id', user_id).execute()
+    deleted_rows['profiles'] = 1
+    return deleted_rows
+
+
 @admin_router.delete("/users/{user_id}")
 async def delete_user_completely(
     request: Request,
@@ -576,69 +733,19 @@ async def delete_user_completely(
         
         logger.info(f"Admin {auth_user['email']} iniciando deleção de usuário {user_email} (ID: {user_id})")
         
-        # 2. Deletar user_quotas
-        try:
-            db.client.table('user_quotas').delete().eq('user_id', user_id).execute()
-            logger.info(f"✅ user_quotas deletado para {user_id}")
-        except Exception as e:
-            logger.warning(f"Erro ao deletar user_quotas: {e}")
-        
-        # 3. Deletar user_roles
-        try:
-            db.client.table('user_roles').delete().eq('user_id', user_id).execute()
-            logger.info(f"✅ user_roles deletado para {user_id}")
-        except Exception as e:
-            logger.warning(f"Erro ao deletar user_roles: {e}")
-        
-        # 4. Deletar campanhas do usuário (se houver)
-        try:
-            campaigns = db.client.table('campaigns')\
-                .select('id')\
-                .eq('user_id', user_id)\
-                .execute()
-            
-            if campaigns.data:
-                for campaign in campaigns.data:
-                    # Deletar contatos e logs da campanha
-                    db.client.table('campaign_contacts')\
-                        .delete()\
-                        .eq('campaign_id', campaign['id'])\
-                        .execute()
-                    db.client.table('message_logs')\
-                        .delete()\
-                        .eq('campaign_id', campaign['id'])\
-                        .execute()
-                
-                # Deletar campanhas
-                db.client.table('campaigns').delete().eq('user_id', user_id).execute()
-                logger.info(f"✅ Campanhas deletadas para {user_id}")
-        except Exception as e:
-            logger.warning(f"Erro ao deletar campanhas: {e}")
-        
-        # 5. Deletar leads do usuário
+        # 2-8. Dados do usuário (campanhas, contatos, logs, leads, quotas, roles, profile)
         try:
-            db.client.table('leads').delete().eq('user_id', user_id).execute()
-            logger.info(f"✅ Leads deletados para {user_id}")
+            result = db.client.rpc('delete_user_data', {'p_user_id': user_id}).execute()
+            deleted_rows = result.data or {}
         except Exception as e:
-            logger.warning(f"Erro ao deletar leads: {e}")
+            if not is_missing_function(e):
+                # Falha real dentro da transação (rollback) - o fallback deixaria o usuário pela metade
+                raise
+            logger.warning(f"RPC delete_user_data not available, using fallback: {e}")
+            deleted_rows = _delete_user_data_fallback(db, user_id)
         
-        # 6. Deletar histórico de busca
-        try:
-            db.client.table('search_history').delete().eq('user_id', user_id).execute()
-            logger.info(f"✅ Histórico de busca deletado para {user_id}")
-        except Exception as e:
-            logger.warning(f"Erro ao deletar search_history: {e}")
-        
-        # 7. Deletar notificações
-        try:
-            db.client.table('notifications').delete().eq('user_id', user_id).execute()
-            logger.info(f"✅ Notificações deletadas para {user_id}")
-        except Exception as e:
-            logger.warning(f"Erro ao deletar notificações: {e}")
-        
-        # 8. Deletar profile
-        db.client.table('profiles').delete().eq('id', user_id).execute()
-        logger.info(f"✅ Profile deletado para {user_id}")
+        await _users_total_cache.invalidate('profiles')
+        logger.info(f"✅ Dados removidos para {user_id}: {deleted_rows}")
         
         # 9. CRÍTICO: Deletar da tabela auth.users usando admin API
         try:
@@ -663,7 +770,8 @@ async def delete_user_completely(
             target_id=user_id,
             target_email=user_email,
             details={
-                'company_id': company_id
+                'company_id': company_id,
+                'deleted_rows': deleted_rows
             },
             ip_address=request.client.host if request.client else None,
             user_agent=request.headers.get('user-agent')
@@ -686,3 +794,109 @@ async def delete_user_completely(
             status_code=500,
             detail=f"Erro ao deletar usuário: {str(e)}"
         )
+
+
+@admin_router.get("/send-logging")
+async def get_send_logging(
+    auth_user: dict = Depends(require_role("super_admin"))
+):
+    """
+    Configuração atual dos logs de envio (admin only)
+    
+    IMPORTANTE: Requer role super_admin
+    """
+    return get_send_logger().settings()
+
+
+@admin_router.put("/send-logging")
+async def update_send_logging(
+    request: Request,
+    config: SendLoggingRequest,
+    auth_user: dict = Depends(require_role("super_admin"))
+):
+    """
+    Altera em runtime o volume de logs dos envios (full | sampled | summary).
+    Vale para o processo que atendeu a requisição.
+    
+    IMPORTANTE: Requer role super_admin
+    """
+    try:
+        settings = get_send_logger().configure(mode=config.mode, sample_every=config.sample_every)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await get_audit_service().log_action(
+        user_id=auth_user['user_id'],
+        user_email=auth_user['email'],
+        action='send_logging_updated',
+        target_type='settings',
+        details={'mode': settings['mode'], 'sample_every': settings['sample_every']},
+        ip_address=request.client.host if request.client else None,
+        user_agent=request.headers.get('user-agent')
+    )
+    
+    logger.info(f"Admin {auth_user['email']} alterou log de envios para {settings['mode']} (1/{settings['sample_every']})")
+    return settings
+
+
+@admin_router.get("/profiling")
+async def get_profiling(
+    auth_user: dict = Depends(require_role("super_admin"))
+):
+    """
+    Configuração do profiling e amostras coletadas por rota/campanha (admin only)
+    
+    IMPORTANTE: Requer role super_admin
+    """
+    return get_profiler().settings()
+
+
+@admin_router.put("/profiling")
+async def update_profiling(
+    request: Request,
+    config: ProfilingRequest,
+    auth_user: dict = Depends(require_role("super_admin"))
+):
+    """
+    Liga/desliga o profiling em runtime e escolhe rotas, amostragem e engine.
+    Vale para o processo que atendeu a requisição.
+    
+    IMPORTANTE: Requer role super_admin
+    """
+    try:
+        settings = get_profiler().configure(**config.model_dump(exclude_none=True))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await get_audit_service().log_action(
+        user_id=auth_user['user_id'],
+        user_email=auth_user['email'],
+        action='profiling_updated',
+        target_type='settings',
+        details=config.model_dump(exclude_none=True),
+        ip_address=request.client.host if request.client else None,
+        user_agent=request.headers.get('user-agent')
+    )
+    
+    logger.info(f"Admin {auth_user['email']} alterou profiling: {config.model_dump(exclude_none=True)}")
+    return settings
+
+
+@admin_router.post("/profiling/dump")
+async def dump_profiling(
+    top: int = 15,
+    reset: bool = False,
+    auth_user: dict = Depends(require_role("super_admin"))
+):
+    """
+    Grava as estatísticas (.prof, formato pstats) por rota/campanha e retorna
+    as funções mais caras de cada uma. Com reset=true zera as amostras.
+    
+    IMPORTANTE: Requer role super_admin
+    """
+    profiler = get_profiler()
+    # Cópia no event loop; a gravação/formatação vai para a thread sem tocar nos Stats vivos
+    dumped = await asyncio.to_thread(profiler.write, profiler.snapshot(), max(1, min(top, 100)))
+    if reset:
+        profiler.reset()
+    return {'output_dir': profiler.output_dir, 'profiles': dumped}
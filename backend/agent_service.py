@@ -1,10 +1,307 @@
 import os
-import httpx
+import time
+import asyncio
+import hashlib
 import logging
+from typing import Awaitable, Callable, Dict, List, Optional
 from supabase_service import get_supabase_service
+from shared_cache import SharedCache
+from n8n_forwarder import get_n8n_forwarder
+from webhook_queue import get_webhook_queue
 
 logger = logging.getLogger(__name__)
 
+# ========== Índice session_name -> contexto da empresa ==========
+# Evita 4-5 queries sequenciais por mensagem recebida.
+# Sessões sem empresa são guardadas como entradas negativas (TTL menor).
+# Só local: o contexto traz a chave da OpenAI e a do WAHA, que não vão para o Redis
+# (alterações feitas via outro worker valem após AGENT_CONTEXT_CACHE_TTL).
+_session_context_cache = SharedCache(
+    'agent_session_context',
+    maxsize=int(os.getenv('AGENT_CONTEXT_CACHE_MAXSIZE', '2000')),
+    ttl=int(os.getenv('AGENT_CONTEXT_CACHE_TTL', '300')),
+    negative_ttl=int(os.getenv('AGENT_CONTEXT_CACHE_NEGATIVE_TTL', '60')),
+    shared=False
+)
+
+
+async def invalidate_session_context(session_name: str) -> None:
+    """Remove o contexto em cache de uma sessão (config do agente ou sessão alterada)"""
+    if session_name:
+        await _session_context_cache.invalidate(session_name)
+
+
+async def _load_session_context(session_name: str) -> Optional[dict]:
+    """Busca no banco empresa, config do agente e credenciais WAHA de uma sessão"""
+    db = get_supabase_service()
+
+    company_id = None
+    waha_url = os.getenv("WAHA_DEFAULT_URL", "")
+    waha_api_key = os.getenv("WAHA_MASTER_KEY", "")
+
+    # Tenta buscar pelo company_settings (padrão novo) - já traz a config WAHA da empresa
+    settings_res = db.client.table("company_settings")\
+        .select("company_id, waha_api_url, waha_api_key")\
+        .eq("waha_session", session_name)\
+        .maybe_single().execute()
+
+    settings = settings_res.data if settings_res else None
+    if settings:
+        company_id = settings["company_id"]
+        if settings.get("waha_api_url"):
+            waha_url = settings["waha_api_url"]
+        if settings.get("waha_api_key"):
+            waha_api_key = settings["waha_api_key"]
+
+    # Fallback para waha_configs (legado)
+    if not company_id:
+        waha_res = db.client.table("waha_configs")\
+            .select("company_id")\
+            .eq("session_name", session_name)\
+            .maybe_single().execute()
+        if waha_res and waha_res.data:
+            company_id = waha_res.data["company_id"]
+
+        if not company_id:
+            return None
+
+        # Sessão legada: credenciais WAHA da empresa ficam em company_settings
+        company_waha_res = db.client.table("company_settings")\
+            .select("waha_api_url, waha_api_key")\
+            .eq("company_id", company_id)\
+            .maybe_single().execute()
+        if company_waha_res and company_waha_res.data:
+            if company_waha_res.data.get("waha_api_url"):
+                waha_url = company_waha_res.data["waha_api_url"]
+            if company_waha_res.data.get("waha_api_key"):
+                waha_api_key = company_waha_res.data["waha_api_key"]
+
+    agent_config = await db.get_agent_config(company_id)
+
+    company_res = db.client.table("companies")\
+        .select("name")\
+        .eq("id", company_id)\
+        .maybe_single().execute()
+    company_name = company_res.data.get("name", "") if company_res and company_res.data else ""
+
+    return {
+        "company_id": company_id,
+        "company_name": company_name,
+        "agent_config": agent_config,
+        "waha_url": waha_url,
+        "waha_api_key": waha_api_key,
+    }
+
+
+async def resolve_session_context(session_name: str) -> Optional[dict]:
+    """
+    Retorna o contexto da empresa dona da sessão (empresa, config do agente, WAHA),
+    usando o cache quando possível. None se a sessão não pertence a nenhuma empresa.
+    """
+    if not session_name:
+        return None
+
+    hit, context, negative = await _session_context_cache.get(session_name)
+    if hit:
+        return None if negative else context
+
+    context = await _load_session_context(session_name)
+    await _session_context_cache.set(session_name, context, negative=context is None)
+    return context
+
+
+# ========== Debounce de mensagens por contato ==========
+# Clientes costumam mandar 3-4 mensagens seguidas; agrupamos tudo que chega
+# dentro da janela (agent_configs.response_delay) em uma única chamada ao n8n.
+# O lote volta para a fila de webhooks (ordem por sessão, backpressure e retry).
+DEBOUNCE_MAX_WAIT = float(os.getenv('AGENT_DEBOUNCE_MAX_WAIT', '15'))  # segundos
+BATCH_EVENT = 'message.batch'
+
+
+class MessageDebouncer:
+    """Acumula eventos por chave e dispara um único flush após a janela de silêncio"""
+
+    def __init__(self, max_wait: float):
+        self.max_wait = max_wait
+        self._buffers: Dict[str, dict] = {}
+
+    async def submit(
+        self,
+        key: str,
+        window: float,
+        event: dict,
+        flush: Callable[[List[dict]], Awaitable[object]]
+    ) -> None:
+        entry = self._buffers.get(key)
+        if entry is None:
+            entry = {"events": [], "first_at": time.monotonic(), "task": None}
+            self._buffers[key] = entry
+
+        entry["events"].append(event)
+        entry["flush"] = flush
+        if entry["task"]:
+            entry["task"].cancel()
+
+        # Reinicia a janela a cada mensagem, sem passar de max_wait desde a primeira
+        remaining = entry["first_at"] + self.max_wait - time.monotonic()
+        entry["task"] = asyncio.create_task(self._flush_later(key, max(0.0, min(window, remaining))))
+
+    async def _flush_later(self, key: str, wait: float) -> None:
+        await asyncio.sleep(wait)
+        entry = self._buffers.pop(key, None)
+        if entry:
+            await self._run(entry)
+
+    async def _run(self, entry: dict) -> None:
+        try:
+            await entry["flush"](entry["events"])
+        except Exception as e:
+            logger.error(f"❌ Erro ao enviar mensagens agrupadas ao n8n: {e}")
+
+    async def flush_all(self) -> None:
+        """Envia imediatamente tudo que está pendente (usado no shutdown)"""
+        entries = list(self._buffers.values())
+        self._buffers.clear()
+        for entry in entries:
+            entry["task"].cancel()
+        await asyncio.gather(*(self._run(entry) for entry in entries))
+
+
+_message_debouncer: Optional[MessageDebouncer] = None
+
+
+def get_message_debouncer() -> MessageDebouncer:
+    """Retorna instância singleton do MessageDebouncer"""
+    global _message_debouncer
+    if _message_debouncer is None:
+        _message_debouncer = MessageDebouncer(DEBOUNCE_MAX_WAIT)
+    return _message_debouncer
+
+
+def _idempotency_key(session_name: Optional[str], events: List[dict]) -> Optional[str]:
+    """Chave estável para o lote: sessão + ids das mensagens WAHA"""
+    ids = []
+    for event in events:
+        message_id = (event.get("payload") or {}).get("id") or event.get("id")
+        if isinstance(message_id, dict):
+            message_id = message_id.get("_serialized")
+        if not message_id:
+            return None
+        ids.append(str(message_id))
+    if not ids:
+        return None
+    return hashlib.sha256(f"{session_name}|{','.join(ids)}".encode()).hexdigest()
+
+
+async def forward_messages_to_n8n(
+    n8n_url: str,
+    context: dict,
+    events: List[dict],
+    delay_applied: float = 0
+) -> bool:
+    """
+    Monta o payload do n8n (formato WAHA Trigger) para uma ou mais mensagens
+    do mesmo contato e envia em uma única chamada.
+
+    delay_applied: segundos já esperados no debounce - descontados do
+    response_delay enviado ao n8n para o atraso não ser aplicado duas vezes.
+    """
+    # Eventos agrupados viram uma única chamada: textos unidos, metadados da última mensagem
+    payload = events[-1]
+    msg_payload = payload.get("payload", {})
+    session_name = payload.get("session")
+    sender = msg_payload.get("from")
+    bodies = [e.get("payload", {}).get("body") for e in events]
+    body = "\n".join(b for b in bodies if b)
+    if len(events) > 1:
+        msg_payload = {**msg_payload, "body": body}
+        payload = {**payload, "payload": msg_payload}
+
+    company_id = context["company_id"]
+    company_name = context["company_name"]
+    agent_config = context["agent_config"]
+    waha_url = context["waha_url"]
+    waha_api_key = context["waha_api_key"]
+
+    # Extrair telefone normalizado
+    telefone_normalizado = sender.replace("@c.us", "").replace("@s.whatsapp.net", "")
+    
+    # Montar payload compatível com WAHA Trigger do n8n
+    # Este formato permite reutilizar workflows existentes com mínimas alterações
+    n8n_payload = {
+        # === Dados no formato WAHA Trigger ===
+        "payload": msg_payload,  # Payload original do WAHA
+        
+        # === Dados extraídos e normalizados ===
+        "telefone_normalizado": telefone_normalizado,
+        "texto_cliente": body,
+        
+        # === Variáveis para o workflow ===
+        "variaveis": {
+            "server_url": waha_url,
+            "instancia": session_name,
+            "api_key": waha_api_key,
+            "phone": telefone_normalizado,
+            "mensagem": body,
+        },
+        
+        # === Credenciais OpenAI do cliente ===
+        "openai": {
+            "api_key": agent_config.get("openai_api_key", ""),
+            "model": agent_config.get("model", "gpt-4.1-mini"),
+            "temperature": float(agent_config.get("temperature", 0.7)),
+        },
+        
+        # === Contexto da empresa (Client4You) ===
+        "client4you": {
+            "company_id": company_id,
+            "company_name": company_name,
+            "session_name": session_name,
+            "agent_config": {
+                "name": agent_config.get("name", "Assistente"),
+                "personality": agent_config.get("personality", ""),
+                "system_prompt": agent_config.get("system_prompt", ""),
+                "welcome_message": agent_config.get("welcome_message", ""),
+                "response_delay": max(0, float(agent_config.get("response_delay", 3) or 0) - delay_applied),
+                "max_response_length": agent_config.get("max_response_length", 500),
+                "tone": agent_config.get("tone", "professional"),
+                "language": agent_config.get("language", "pt-BR"),
+                "auto_qualify": agent_config.get("auto_qualify", True),
+                "qualification_questions": agent_config.get("qualification_questions", []),
+                "blocked_topics": agent_config.get("blocked_topics", []),
+                "working_hours": agent_config.get("working_hours", {}),
+                "model": agent_config.get("model", "gpt-4.1-mini"),
+                "temperature": float(agent_config.get("temperature", 0.7)),
+            }
+        },
+        
+        # === Metadados ===
+        "event": "message",
+        "session": session_name,
+        "sender": sender,
+        "contact_name": msg_payload.get("_data", {}).get("notifyName", "Cliente"),
+        "timestamp": msg_payload.get("timestamp"),
+        
+        # === Tipo de mensagem ===
+        "message_type": "audio" if msg_payload.get("hasMedia") and msg_payload.get("type") == "ptt" else "text",
+        "has_media": msg_payload.get("hasMedia", False),
+        "media_url": msg_payload.get("media", {}).get("url") if msg_payload.get("hasMedia") else None,
+        "mensagens_agrupadas": len(events),
+    }
+
+    # Log do payload para debug (sem expor a API key completa)
+    openai_key = agent_config.get("openai_api_key", "")
+    logger.info(f"📤 Payload OpenAI: model={agent_config.get('model')}, temp={agent_config.get('temperature')}, has_key={'Sim' if openai_key else 'Não'}")
+
+    # Envio via cliente compartilhado (keep-alive, retry, circuit breaker por empresa)
+    forwarded = await get_n8n_forwarder().forward(
+        n8n_url, company_id, n8n_payload, payload, idempotency_key=_idempotency_key(session_name, events)
+    )
+    if forwarded:
+        logger.info(f"🤖 Agente IA acionado para: {sender} (n8n)")
+    return forwarded
+
+
 async def process_waha_message_for_n8n(payload: dict):
     """
     Processa webhook do WAHA, valida se a empresa tem o agente ativo
@@ -22,6 +319,9 @@ async def process_waha_message_for_n8n(payload: dict):
 
         # 2. Extrair dados básicos
         event = payload.get("event")
+        if event == BATCH_EVENT:
+            await _forward_batch(n8n_url, payload)
+            return
         if event != "message": 
             return
         
@@ -38,34 +338,13 @@ async def process_waha_message_for_n8n(payload: dict):
         if not body or not sender: 
             return
 
-        db = get_supabase_service()
-
-        # 3. Identificar a Empresa pela Sessão
-        company_id = None
-        
-        # Tenta buscar pelo company_settings (padrão novo)
-        settings_res = db.client.table("company_settings")\
-            .select("company_id")\
-            .eq("waha_session", session_name)\
-            .maybe_single().execute()
-            
-        if settings_res.data:
-            company_id = settings_res.data["company_id"]
-        
-        # Fallback para waha_configs (legado)
-        if not company_id:
-            waha_res = db.client.table("waha_configs")\
-                .select("company_id")\
-                .eq("session_name", session_name)\
-                .maybe_single().execute()
-            if waha_res.data:
-                company_id = waha_res.data["company_id"]
-
-        if not company_id:
-            return 
+        # 3-5. Resolver empresa, config do agente e credenciais WAHA (cache por sessão)
+        context = await resolve_session_context(session_name)
+        if not context:
+            return
 
-        # 4. Buscar Configuração do Agente
-        agent_config = await db.get_agent_config(company_id)
+        company_id = context["company_id"]
+        agent_config = context["agent_config"]
         
         # Log de debug
         logger.info(f"🔍 Agent config para {company_id}: enabled={agent_config.get('enabled') if agent_config else 'None'}, openai_key={'Sim' if agent_config and agent_config.get('openai_api_key') else 'Não'}")
@@ -74,113 +353,45 @@ async def process_waha_message_for_n8n(payload: dict):
         if not agent_config or not agent_config.get("enabled"):
             return 
 
-        # 5. Buscar dados da empresa e WAHA config
-        company_res = db.client.table("companies")\
-            .select("name")\
-            .eq("id", company_id)\
-            .maybe_single().execute()
-        company_name = company_res.data.get("name", "") if company_res.data else ""
-        
-        # Buscar configurações do WAHA (URL e API Key)
-        waha_url = os.getenv("WAHA_DEFAULT_URL", "")
-        waha_api_key = os.getenv("WAHA_MASTER_KEY", "")
-        
-        # Tentar buscar config específica da empresa
-        company_waha_res = db.client.table("company_settings")\
-            .select("waha_api_url, waha_api_key")\
-            .eq("company_id", company_id)\
-            .maybe_single().execute()
-        
-        if company_waha_res.data:
-            if company_waha_res.data.get("waha_api_url"):
-                waha_url = company_waha_res.data["waha_api_url"]
-            if company_waha_res.data.get("waha_api_key"):
-                waha_api_key = company_waha_res.data["waha_api_key"]
-
-        # 6. Extrair telefone normalizado
-        telefone_normalizado = sender.replace("@c.us", "").replace("@s.whatsapp.net", "")
-        
-        # 7. Montar payload compatível com WAHA Trigger do n8n
-        # Este formato permite reutilizar workflows existentes com mínimas alterações
-        n8n_payload = {
-            # === Dados no formato WAHA Trigger ===
-            "payload": msg_payload,  # Payload original do WAHA
-            
-            # === Dados extraídos e normalizados ===
-            "telefone_normalizado": telefone_normalizado,
-            "texto_cliente": body,
-            
-            # === Variáveis para o workflow ===
-            "variaveis": {
-                "server_url": waha_url,
-                "instancia": session_name,
-                "api_key": waha_api_key,
-                "phone": telefone_normalizado,
-                "mensagem": body,
-            },
-            
-            # === Credenciais OpenAI do cliente ===
-            "openai": {
-                "api_key": agent_config.get("openai_api_key", ""),
-                "model": agent_config.get("model", "gpt-4.1-mini"),
-                "temperature": float(agent_config.get("temperature", 0.7)),
-            },
-            
-            # === Contexto da empresa (Client4You) ===
-            "client4you": {
-                "company_id": company_id,
-                "company_name": company_name,
-                "session_name": session_name,
-                "agent_config": {
-                    "name": agent_config.get("name", "Assistente"),
-                    "personality": agent_config.get("personality", ""),
-                    "system_prompt": agent_config.get("system_prompt", ""),
-                    "welcome_message": agent_config.get("welcome_message", ""),
-                    "response_delay": agent_config.get("response_delay", 3),
-                    "max_response_length": agent_config.get("max_response_length", 500),
-                    "tone": agent_config.get("tone", "professional"),
-                    "language": agent_config.get("language", "pt-BR"),
-                    "auto_qualify": agent_config.get("auto_qualify", True),
-                    "qualification_questions": agent_config.get("qualification_questions", []),
-                    "blocked_topics": agent_config.get("blocked_topics", []),
-                    "working_hours": agent_config.get("working_hours", {}),
-                    "model": agent_config.get("model", "gpt-4.1-mini"),
-                    "temperature": float(agent_config.get("temperature", 0.7)),
-                }
-            },
-            
-            # === Metadados ===
-            "event": "message",
-            "session": session_name,
-            "sender": sender,
-            "contact_name": msg_payload.get("_data", {}).get("notifyName", "Cliente"),
-            "timestamp": msg_payload.get("timestamp"),
-            
-            # === Tipo de mensagem ===
-            "message_type": "audio" if msg_payload.get("hasMedia") and msg_payload.get("type") == "ptt" else "text",
-            "has_media": msg_payload.get("hasMedia", False),
-            "media_url": msg_payload.get("media", {}).get("url") if msg_payload.get("hasMedia") else None,
-        }
+        # 6. Agrupar mensagens seguidas do mesmo contato (janela = response_delay)
+        window = min(float(agent_config.get("response_delay") or 0), DEBOUNCE_MAX_WAIT)
+        if window > 0:
+            await get_message_debouncer().submit(
+                f"{session_name}:{sender}",
+                window,
+                payload,
+                lambda events: _enqueue_batch(session_name, events, window)
+            )
+            return
 
-        # Log do payload para debug (sem expor a API key completa)
-        openai_key = agent_config.get("openai_api_key", "")
-        logger.info(f"📤 Payload OpenAI: model={agent_config.get('model')}, temp={agent_config.get('temperature')}, has_key={'Sim' if openai_key else 'Não'}")
-
-        # Disparo assíncrono (Fire & Forget)
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(n8n_url, json=n8n_payload, timeout=10.0)
-                if response.status_code in [200, 201, 204]:
-                    logger.info(f"🤖 Agente IA acionado para: {sender} (n8n)")
-                else:
-                    logger.warning(f"⚠️ n8n retornou status {response.status_code}")
-            except httpx.TimeoutException:
-                logger.warning(f"⚠️ Timeout ao chamar n8n para {sender}")
-            except Exception as e:
-                logger.error(f"❌ Erro ao chamar n8n: {e}")
+        await forward_messages_to_n8n(n8n_url, context, [payload])
 
     except Exception as e:
         logger.error(f"❌ Erro no processamento do agente: {e}")
+        raise  # a fila de webhooks faz o retry
+
+
+async def _enqueue_batch(session_name: str, events: List[dict], window: float) -> None:
+    """Devolve o lote agrupado para a fila de webhooks (mesmo consumidor da sessão)"""
+    # O WAHA já recebeu 200 e os ids estão no dedup: nada reenviaria um lote
+    # descartado, então espera vaga na fila (backpressure) em vez de descartar
+    await get_webhook_queue().enqueue({
+        "event": BATCH_EVENT,
+        "session": session_name,
+        "events": events,
+        "delay_applied": window,
+    }, wait=True)
+
+
+async def _forward_batch(n8n_url: str, payload: dict) -> None:
+    """Processa um lote do debounce dentro do consumidor da fila"""
+    events = payload.get("events") or []
+    if not events:
+        return
+    context = await resolve_session_context(payload.get("session"))
+    if not context or not (context.get("agent_config") or {}).get("enabled"):
+        return
+    await forward_messages_to_n8n(n8n_url, context, events, float(payload.get("delay_applied") or 0))
 
 
 async def get_agent_status(company_id: str) -> dict:
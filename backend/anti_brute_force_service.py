@@ -1,27 +1,155 @@
 """
 Anti-Brute Force Service
 Sistema de prevenção de ataques de força bruta em login
+
+Contadores de falhas em janela deslizante ficam em memória (por email, por IP
+e por email+IP). O banco só é lido no startup para reconstruir os contadores;
+as tentativas são gravadas em lote periodicamente.
 """
 import os
+import time
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from cachetools import TTLCache
 from supabase_service import get_supabase_service
 
 logger = logging.getLogger(__name__)
 
 
+class SlidingWindowCounter:
+    """Timestamps de falhas por chave, limitados à janela e a `limit` entradas"""
+    
+    def __init__(self, window: int, limit: int, maxsize: int):
+        self.window = window
+        self.limit = limit
+        # Chaves sem falhas novas expiram sozinhas após a janela
+        self._hits = TTLCache(maxsize=maxsize, ttl=window)
+    
+    def _trim(self, hits: deque, now: float) -> None:
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+    
+    def add(self, key: str, ts: float) -> None:
+        hits = self._hits.get(key)
+        if hits is None:
+            # Só as `limit` falhas mais recentes importam para o bloqueio
+            hits = deque(maxlen=self.limit)
+        hits.append(ts)
+        self._trim(hits, ts)
+        self._hits[key] = hits
+    
+    def count(self, key: str, now: float) -> Tuple[int, Optional[float]]:
+        """Retorna (falhas na janela, timestamp da última falha)"""
+        hits = self._hits.get(key)
+        if not hits:
+            return 0, None
+        self._trim(hits, now)
+        return len(hits), (hits[-1] if hits else None)
+    
+    def __len__(self) -> int:
+        return len(self._hits)
+
+
 class AntiBruteForceService:
     """Serviço de proteção contra brute force"""
     
     def __init__(self):
         # Configurações (podem ser sobrescritas via env vars)
         self.max_attempts = int(os.getenv('LOGIN_MAX_ATTEMPTS', '5'))
+        self.max_attempts_per_email = int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_EMAIL', str(self.max_attempts * 4)))
+        # Por IP é opt-in (0 = desligado): atrás de proxy sem TRUST_PROXY_HEADERS todos
+        # os logins chegam com o mesmo IP e o limite viraria um bloqueio global
+        self.max_attempts_per_ip = int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_IP', '0'))
         self.lockout_duration = int(os.getenv('LOGIN_LOCKOUT_DURATION', '1800'))  # 30 min
         self.window_duration = int(os.getenv('LOGIN_WINDOW_DURATION', '900'))  # 15 min
+        self.flush_interval = float(os.getenv('LOGIN_ATTEMPTS_FLUSH_INTERVAL', '5'))
+        self.warmup_limit = int(os.getenv('LOGIN_ATTEMPTS_WARMUP_LIMIT', '10000'))
+        tracker_maxsize = int(os.getenv('LOGIN_TRACKER_MAXSIZE', '100000'))
+        
+        self._by_pair = SlidingWindowCounter(self.window_duration, self.max_attempts, tracker_maxsize)
+        self._by_email = SlidingWindowCounter(self.window_duration, self.max_attempts_per_email, tracker_maxsize)
+        self._by_ip = SlidingWindowCounter(self.window_duration, self.max_attempts_per_ip, tracker_maxsize)
+        
+        self._pending: List[Dict] = []
+        self._flush_task: Optional[asyncio.Task] = None
         
         logger.info(f"🔒 Anti-Brute Force configurado: {self.max_attempts} tentativas em {self.window_duration}s, lockout de {self.lockout_duration}s")
     
+    # ========== Contadores em memória ==========
+    
+    def _track_failure(self, email: str, ip_address: str, ts: float) -> None:
+        self._by_pair.add(f"{email}|{ip_address}", ts)
+        self._by_email.add(email, ts)
+        if self.max_attempts_per_ip > 0:
+            self._by_ip.add(ip_address, ts)
+    
+    def get_failure_count(self, email: Optional[str] = None, ip_address: Optional[str] = None) -> int:
+        """Falhas dentro da janela para email, IP ou o par email+IP"""
+        now = time.time()
+        if email and ip_address:
+            return self._by_pair.count(f"{email}|{ip_address}", now)[0]
+        if email:
+            return self._by_email.count(email, now)[0]
+        if ip_address:
+            return self._by_ip.count(ip_address, now)[0]
+        return 0
+    
+    async def start(self) -> None:
+        """Reconstrói os contadores a partir do banco e inicia a gravação periódica"""
+        if self._flush_task is not None:
+            return
+        
+        try:
+            db = get_supabase_service()
+            window_start = datetime.utcnow() - timedelta(seconds=self.window_duration)
+            result = db.client.table('login_attempts')\
+                .select('email, ip_address, created_at')\
+                .eq('success', False)\
+                .gte('created_at', window_start.isoformat())\
+                .order('created_at')\
+                .limit(self.warmup_limit)\
+                .execute()
+            
+            for row in result.data or []:
+                created_at = datetime.fromisoformat(row['created_at'].replace('Z', '+00:00'))
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                self._track_failure(row['email'], row['ip_address'], created_at.timestamp())
+            
+            logger.info(f"🔒 Anti-Brute Force: {len(result.data or [])} falhas recentes carregadas do banco")
+        except Exception as e:
+            logger.error(f"❌ Erro ao carregar tentativas de login recentes: {e}", exc_info=True)
+        
+        self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self) -> None:
+        """Para a gravação periódica e grava o que estiver pendente"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        self.flush()
+    
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+    
+    def flush(self) -> None:
+        """Grava em lote as tentativas acumuladas"""
+        if not self._pending:
+            return
+        
+        batch, self._pending = self._pending, []
+        try:
+            db = get_supabase_service()
+            db.client.table('login_attempts').insert(batch, returning='minimal').execute()
+        except Exception as e:
+            logger.error(f"❌ Erro ao gravar {len(batch)} tentativas de login: {e}", exc_info=True)
+    
     async def check_login_allowed(self, email: str, ip_address: str) -> Tuple[bool, Optional[str], Optional[int]]:
         """
         Verifica se o login é permitido para este email/IP
@@ -33,40 +161,25 @@ class AntiBruteForceService:
             - retry_after: Segundos até poder tentar novamente
         """
         try:
-            db = get_supabase_service()
-            
-            # Buscar tentativas recentes (últimos 15 minutos)
-            window_start = datetime.utcnow() - timedelta(seconds=self.window_duration)
+            now = time.time()
+            checks = [
+                (self._by_pair, f"{email}|{ip_address}", f"Conta temporariamente bloqueada após {self.max_attempts} tentativas falhas"),
+                (self._by_email, email, f"Conta temporariamente bloqueada após {self.max_attempts_per_email} tentativas falhas"),
+            ]
+            if self.max_attempts_per_ip > 0:
+                checks.append((self._by_ip, ip_address, "Muitas tentativas falhas a partir deste endereço. Tente novamente mais tarde"))
             
-            # Buscar por email E IP (mais rigoroso)
-            attempts = db.client.table('login_attempts')\
-                .select('*')\
-                .eq('email', email)\
-                .eq('ip_address', ip_address)\
-                .eq('success', False)\
-                .gte('created_at', window_start.isoformat())\
-                .order('created_at', desc=True)\
-                .execute()
-            
-            failed_attempts = attempts.data if attempts.data else []
-            
-            # Contar tentativas falhadas
-            failed_count = len(failed_attempts)
-            
-            if failed_count >= self.max_attempts:
-                # Calcular tempo restante de lockout
-                last_attempt = datetime.fromisoformat(failed_attempts[0]['created_at'].replace('Z', '+00:00'))
-                lockout_until = last_attempt + timedelta(seconds=self.lockout_duration)
-                now = datetime.utcnow().replace(tzinfo=last_attempt.tzinfo)
+            for counter, key, reason in checks:
+                failed_count, last_failure = counter.count(key, now)
+                if failed_count < counter.limit:
+                    continue
                 
+                # Calcular tempo restante de lockout
+                lockout_until = last_failure + self.lockout_duration
                 if now < lockout_until:
-                    retry_after = int((lockout_until - now).total_seconds())
+                    retry_after = int(lockout_until - now)
                     logger.warning(f"🚫 Login bloqueado - {email} ({ip_address}) - {failed_count} tentativas - retry em {retry_after}s")
-                    return False, f"Conta temporariamente bloqueada após {self.max_attempts} tentativas falhas", retry_after
-                else:
-                    # Lockout expirou, pode tentar novamente
-                    logger.info(f"🔓 Lockout expirado para {email} ({ip_address})")
-                    return True, None, None
+                    return False, reason, retry_after
             
             # Permitido
             return True, None, None
@@ -99,7 +212,8 @@ class AntiBruteForceService:
             user_agent: User-Agent do browser
         """
         try:
-            db = get_supabase_service()
+            if not success:
+                self._track_failure(email, ip_address, time.time())
             
             attempt_data = {
                 'email': email,
@@ -112,7 +226,10 @@ class AntiBruteForceService:
                 'created_at': datetime.utcnow().isoformat()
             }
             
-            db.client.table('login_attempts').insert(attempt_data).execute()
+            self._pending.append(attempt_data)
+            if self._flush_task is None:
+                # Gravação periódica não iniciada (scripts/testes) - grava na hora
+                self.flush()
             
             if success:
                 logger.info(f"✅ Login bem-sucedido: {email} ({ip_address})")
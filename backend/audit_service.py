@@ -1,19 +1,122 @@
 """
 Audit Service
 Sistema de logs de auditoria para ações administrativas
+
+Os logs são gravados por um buffer em background (insert em lote a cada
+AUDIT_BATCH_SIZE entradas ou AUDIT_FLUSH_INTERVAL_MS), fora do caminho
+crítico das requisições.
 """
 import os
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Any
-from supabase_service import get_supabase_service
+from typing import Dict, List, Optional, Any
+from supabase_service import get_supabase_service, is_missing_function
+from shared_cache import SharedCache
 
 logger = logging.getLogger(__name__)
 
+# Estatísticas do dashboard de auditoria (curto, só para não recalcular a cada refresh)
+_stats_cache = SharedCache(
+    'audit_stats',
+    maxsize=16,
+    ttl=float(os.getenv('AUDIT_STATS_CACHE_TTL', '30'))
+)
+
 
 class AuditService:
     """Serviço de logs de auditoria"""
     
+    def __init__(self):
+        self.batch_size = int(os.getenv('AUDIT_BATCH_SIZE', '50'))
+        self.flush_interval = int(os.getenv('AUDIT_FLUSH_INTERVAL_MS', '500')) / 1000
+        self.buffer_max = int(os.getenv('AUDIT_BUFFER_MAX', '5000'))
+        
+        self._buffer: List[Dict[str, Any]] = []
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self.metrics: Dict[str, int] = {
+            'accepted': 0,
+            'written': 0,
+            'dropped': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+        }
+    
+    # ========== Buffer de escrita ==========
+    
+    async def start(self) -> None:
+        """Inicia o flush periódico em background"""
+        if self._task is not None:
+            return
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self) -> None:
+        """Para o flush periódico e grava o que estiver no buffer"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        while self._buffer:
+            await self.flush()
+    
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+            # Rajada: continua gravando enquanto houver lotes completos
+            while len(self._buffer) >= self.batch_size:
+                await self.flush()
+    
+    async def flush(self) -> None:
+        """Grava um lote do buffer em um único insert"""
+        if not self._buffer:
+            return
+        
+        async with self._flush_lock:
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:len(batch)]
+            if not batch:
+                return
+            
+            self.metrics['flushes'] += 1
+            db = get_supabase_service()
+            try:
+                await asyncio.to_thread(
+                    lambda: db.client.table('audit_logs').insert(batch, returning='minimal').execute()
+                )
+                self.metrics['written'] += len(batch)
+                return
+            except Exception as e:
+                self.metrics['failed_flushes'] += 1
+                logger.error(f"❌ Erro ao gravar lote de {len(batch)} audit logs, gravando um a um: {e}")
+            
+            # Isola a linha problemática em vez de perder o lote inteiro
+            for row in batch:
+                try:
+                    await asyncio.to_thread(
+                        lambda: db.client.table('audit_logs').insert(row, returning='minimal').execute()
+                    )
+                    self.metrics['written'] += 1
+                except Exception as e:
+                    self.metrics['dropped'] += 1
+                    logger.error(f"❌ Audit log descartado ({row.get('action')}): {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.metrics,
+            'buffered': len(self._buffer),
+            'running': self._task is not None,
+        }
+    
     async def log_action(
         self,
         user_id: str,
@@ -41,7 +144,7 @@ class AuditService:
             user_agent: User-Agent
         
         Returns:
-            True se registrado com sucesso
+            True se registrado (ou aceito no buffer) com sucesso
         """
         try:
             db = get_supabase_service()
@@ -59,7 +162,18 @@ class AuditService:
                 'created_at': datetime.utcnow().isoformat()
             }
             
-            db.client.table('audit_logs').insert(log_data).execute()
+            if self._task is None:
+                # Buffer não iniciado (scripts/testes) - grava na hora
+                db.client.table('audit_logs').insert(log_data).execute()
+            elif len(self._buffer) >= self.buffer_max:
+                self.metrics['dropped'] += 1
+                logger.warning(f"⚠️ Buffer de audit logs cheio - descartado: {user_email} - {action}")
+                return False
+            else:
+                self._buffer.append(log_data)
+                self.metrics['accepted'] += 1
+                if len(self._buffer) >= self.batch_size:
+                    self._flush_event.set()
             
             logger.info(f"📋 Audit log: {user_email} - {action} - {target_type} {target_id or ''}")
             return True
@@ -169,7 +283,7 @@ class AuditService:
             logger.error(f"❌ Erro ao limpar audit logs: {e}", exc_info=True)
             return 0
     
-    async def get_stats(self) -> Dict:
+    async def get_stats(self, top: int = 5) -> Dict:
         """
         Retorna estatísticas dos logs de auditoria
         
@@ -182,36 +296,25 @@ class AuditService:
                 "top_users": [{"user_email": str, "count": int}]
             }
         """
+        cache_key = str(top)
+        hit, cached, _negative = await _stats_cache.get(cache_key)
+        if hit:
+            return cached
+        
         try:
             db = get_supabase_service()
             
-            # Total de logs
-            total_result = db.client.table('audit_logs').select('*', count='exact').execute()
-            total_logs = total_result.count or 0
-            
-            # Logs hoje
-            today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-            today_result = db.client.table('audit_logs')\
-                .select('*', count='exact')\
-                .gte('created_at', today_start.isoformat())\
-                .execute()
-            logs_today = today_result.count or 0
-            
-            # Logs esta semana
-            week_start = datetime.utcnow() - timedelta(days=7)
-            week_result = db.client.table('audit_logs')\
-                .select('*', count='exact')\
-                .gte('created_at', week_start.isoformat())\
-                .execute()
-            logs_this_week = week_result.count or 0
+            try:
+                result = db.client.rpc('get_audit_stats', {'p_top': top}).execute()
+                stats = result.data
+            except Exception as e:
+                if not is_missing_function(e):
+                    raise
+                logger.warning(f"RPC get_audit_stats not available, using fallback: {e}")
+                stats = self._get_stats_fallback(db)
             
-            return {
-                'total_logs': total_logs,
-                'logs_today': logs_today,
-                'logs_this_week': logs_this_week,
-                'top_actions': [],  # TODO: Implementar agregação
-                'top_users': []  # TODO: Implementar agregação
-            }
+            await _stats_cache.set(cache_key, stats)
+            return stats
         
         except Exception as e:
             logger.error(f"❌ Erro ao buscar stats de auditoria: {e}", exc_info=True)
@@ -222,6 +325,38 @@ class AuditService:
                 'top_actions': [],
                 'top_users': []
             }
+    
+    def _get_stats_fallback(self, db) -> Dict:
+        """Contagens diretas em audit_logs (sem o rollup da migration 009)"""
+        # Total de logs
+        total_result = db.client.table('audit_logs').select('id', count='exact').limit(1).execute()
+        total_logs = total_result.count or 0
+        
+        # Logs hoje
+        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        today_result = db.client.table('audit_logs')\
+            .select('id', count='exact')\
+            .gte('created_at', today_start.isoformat())\
+            .limit(1)\
+            .execute()
+        logs_today = today_result.count or 0
+        
+        # Logs esta semana
+        week_start = datetime.utcnow() - timedelta(days=7)
+        week_result = db.client.table('audit_logs')\
+            .select('id', count='exact')\
+            .gte('created_at', week_start.isoformat())\
+            .limit(1)\
+            .execute()
+        logs_this_week = week_result.count or 0
+        
+        return {
+            'total_logs': total_logs,
+            'logs_today': logs_today,
+            'logs_this_week': logs_this_week,
+            'top_actions': [],
+            'top_users': []
+        }
 
 
 # Singleton global
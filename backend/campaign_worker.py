@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import random
+from time import monotonic
 from datetime import datetime, time, timedelta
 from typing import Optional, Dict, Any
 from zoneinfo import ZoneInfo
@@ -11,7 +12,13 @@ from models import (
 )
 from waha_service import WahaService, replace_variables
 from supabase_service import SupabaseService
-from email_service import get_email_service
+from email_outbox import get_email_outbox
+from media_staging import get_media_stager, MediaStagingError
+from send_logging import get_send_logger
+from profiling import get_profiler
+from metrics import (
+    CAMPAIGN_ITERATION_SECONDS, CAMPAIGN_MESSAGES, CAMPAIGN_MESSAGES_PER_SECOND, classify_send_error
+)
 
 logger = logging.getLogger(__name__)
 
@@ -115,6 +122,12 @@ async def process_campaign(
     
     wait_cycles = 0
     campaign_tz = None
+    send_log = get_send_logger()
+    end_state = "stopped"
+    worker_started = monotonic()
+    messages_sent = 0
+    profiler = get_profiler()
+    profile_sample = None
     
     try:
         # 1. Fetch campaign data once at start
@@ -148,13 +161,48 @@ async def process_campaign(
             "message_type": campaign_data.get("message_type", "text"),
             "media_url": campaign_data.get("media_url"),
             "media_filename": campaign_data.get("media_filename"),
+            "staged_media": None,
+            "media_mimetype": None,
         }
 
+        # Mídia: baixa/valida uma vez e reusa a cópia para todos os contatos
+        if cached_message["message_type"] in ("image", "document") and cached_message["media_url"]:
+            stager = get_media_stager()
+            try:
+                if stager.enabled:
+                    try:
+                        # Limite de 16MB é o de imagem do WhatsApp; documento maior vai pela URL
+                        cached_message["staged_media"] = await stager.stage(
+                            cached_message["media_url"],
+                            cached_message["media_filename"],
+                            oversize_fatal=cached_message["message_type"] == "image"
+                        )
+                    except MediaStagingError as e:
+                        if e.fatal:
+                            raise
+                        logger.warning(f"Campaign {campaign_id}: could not stage media ({e}), sending by URL")
+
+                if not cached_message["staged_media"]:
+                    # Modo URL (WAHA baixa a mídia): mimetype/tamanho uma vez por URL;
+                    # imagem acima do limite do WhatsApp falharia em todo contato
+                    probe = await stager.probe(
+                        cached_message["media_url"],
+                        enforce_limit=cached_message["message_type"] == "image"
+                    )
+                    cached_message["media_mimetype"] = probe.mimetype
+            except MediaStagingError as e:
+                if e.fatal:
+                    # Mídia inválida: falha antes do primeiro envio (pausa + notificação)
+                    raise ValueError(f"Mídia da campanha inválida: {e}") from e
+                logger.warning(f"Campaign {campaign_id}: could not inspect media ({e})")
+
         # Track daily count locally to reduce COUNT queries
         daily_sent_count = await db.count_messages_sent_today(campaign_id)
         daily_count_date = datetime.now(campaign_tz).date()
 
         while True:
+            iteration_started = monotonic()
+
             # Check campaign status (lightweight query)
             status_result = db.client.table('campaigns')\
                 .select('status, pending_count')\
@@ -239,6 +287,7 @@ async def process_campaign(
                     "completed_at": datetime.now(campaign_tz).isoformat()
                 })
                 logger.info(f"Campaign {campaign_id} completed - all contacts processed")
+                end_state = "completed"
 
                 # ENVIAR EMAIL DE CONCLUSÃO
                 try:
@@ -251,8 +300,9 @@ async def process_campaign(
                             .execute()
 
                         if user_result.data:
-                            email_service = get_email_service()
-                            await email_service.send_campaign_completed(
+                            # Enfileira na outbox: o envio acontece em background
+                            await get_email_outbox().enqueue(
+                                'campaign_completed',
                                 user_email=user_result.data.get('email'),
                                 user_name=user_result.data.get('full_name', 'Usuário'),
                                 campaign_name=campaign_final.get('name', 'Campanha'),
@@ -261,12 +311,16 @@ async def process_campaign(
                                 total_contacts=campaign_final.get('total_contacts', 0),
                                 campaign_id=campaign_id
                             )
-                            logger.info(f"Email de conclusão enviado para {user_result.data.get('email')}")
+                            logger.info(f"Email de conclusão enfileirado para {user_result.data.get('email')}")
                 except Exception as e:
-                    logger.error(f"Erro ao enviar email de conclusão: {e}")
+                    logger.error(f"Erro ao enfileirar email de conclusão: {e}")
 
                 break
 
+            # Profiling opt-in da parte de CPU da iteração (personalização -> envio -> logs)
+            if profiler.campaigns:
+                profile_sample = profiler.begin(f"campaign:{campaign_id}")
+
             # Prepare message with variables (using cached message template)
             extra_data = contact_data.get("extra_data", {})
             message_data = {
@@ -286,6 +340,7 @@ async def process_campaign(
             # Send message based on type
             message_type = cached_message["message_type"]
             result: Dict[str, Any]
+            send_started = monotonic()
 
             if message_type == "text":
                 result = await waha_service.send_text_message(
@@ -293,21 +348,51 @@ async def process_campaign(
                     final_message
                 )
             elif message_type == "image":
-                result = await waha_service.send_image_message(
-                    contact_data["phone"],
-                    final_message,
-                    image_url=cached_message["media_url"]
-                )
+                staged = cached_message["staged_media"]
+                if staged:
+                    result = await waha_service.send_image_message(
+                        contact_data["phone"],
+                        final_message,
+                        image_base64=staged.data_base64,
+                        mimetype=staged.mimetype
+                    )
+                else:
+                    result = await waha_service.send_image_message(
+                        contact_data["phone"],
+                        final_message,
+                        image_url=cached_message["media_url"],
+                        mimetype=cached_message["media_mimetype"]
+                    )
             elif message_type == "document":
-                result = await waha_service.send_document_message(
-                    contact_data["phone"],
-                    final_message,
-                    document_url=cached_message["media_url"],
-                    filename=cached_message["media_filename"] or "document"
-                )
+                staged = cached_message["staged_media"]
+                if staged:
+                    result = await waha_service.send_document_message(
+                        contact_data["phone"],
+                        final_message,
+                        document_base64=staged.data_base64,
+                        filename=cached_message["media_filename"] or "document",
+                        mimetype=staged.mimetype
+                    )
+                else:
+                    result = await waha_service.send_document_message(
+                        contact_data["phone"],
+                        final_message,
+                        document_url=cached_message["media_url"],
+                        filename=cached_message["media_filename"] or "document",
+                        mimetype=cached_message["media_mimetype"]
+                    )
             else:
                 result = {"success": False, "error": "Unknown message type"}
 
+            send_log.record(
+                campaign_id,
+                contact_data["phone"],
+                message_type,
+                bool(result.get("success")),
+                monotonic() - send_started,
+                result.get("error")
+            )
+
             # Update contact status
             now_iso = datetime.now(campaign_tz).isoformat()
 
@@ -319,13 +404,13 @@ async def process_campaign(
                 await db.increment_campaign_counter(campaign_id, "sent_count", 1)
                 await db.increment_campaign_counter(campaign_id, "pending_count", -1)
                 daily_sent_count += 1
-                logger.info(f"Message sent to {contact_data['phone']} successfully")
+                messages_sent += 1
+                CAMPAIGN_MESSAGES.inc(message_type=message_type, outcome="sent", cause="ok")
             else:
                 new_status = "error"
                 raw_error = result.get("error", "Unknown error")
                 error_msg = sanitize_error_message(raw_error)
-
-                logger.warning(f"Failed to send message to {contact_data['phone']}: {raw_error}")
+                CAMPAIGN_MESSAGES.inc(message_type=message_type, outcome="error", cause=classify_send_error(raw_error))
 
                 # Atomic counter increments
                 await db.increment_campaign_counter(campaign_id, "error_count", 1)
@@ -351,22 +436,32 @@ async def process_campaign(
             }
             await db.create_message_log(log_data)
 
+            profiler.end(profile_sample)
+            profile_sample = None
+
+            now_monotonic = monotonic()
+            CAMPAIGN_ITERATION_SECONDS.observe(now_monotonic - iteration_started, message_type=message_type)
+            CAMPAIGN_MESSAGES_PER_SECOND.set(messages_sent / (now_monotonic - worker_started), campaign_id=campaign_id)
+
             # Wait for random interval only if there are more contacts
             if pending_count > 1:
                 interval = random.randint(
                     settings.get("interval_min", 30),
                     settings.get("interval_max", 60)
                 )
-                logger.info(f"Waiting {interval} seconds before next message... ({pending_count - 1} remaining)")
+                if send_log.verbose:
+                    logger.info("Waiting %d seconds before next message... (%d remaining)", interval, pending_count - 1)
                 await asyncio.sleep(interval)
             else:
                 logger.info("Last message sent, campaign will complete in next iteration")
     
     except asyncio.CancelledError:
         logger.info(f"Campaign {campaign_id} worker cancelled")
+        end_state = "cancelled"
         raise  # Re-raise to be handled in finally
     except Exception as e:
         logger.error(f"Error in campaign worker {campaign_id}: {e}", exc_info=True)
+        end_state = "error"
         # Mark campaign as paused due to error
         try:
             await db.update_campaign(campaign_id, {
@@ -386,6 +481,10 @@ async def process_campaign(
         except Exception as notification_error:
             logger.error(f"Failed to create error notification: {notification_error}")
     finally:
+        profiler.end(profile_sample)
+        send_log.finish(campaign_id, end_state)
+        CAMPAIGN_MESSAGES_PER_SECOND.remove(campaign_id=campaign_id)
+
         # Always remove from tracking, even in case of error
         async with _campaigns_lock:
             if campaign_id in running_campaigns:
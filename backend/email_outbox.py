@@ -0,0 +1,311 @@
+"""
+Email Outbox
+Fila de saída de emails transacionais, desacoplada dos endpoints e do worker
+de campanhas.
+
+- enqueue() grava na tabela 'email_outbox' e retorna na hora
+- Worker em background envia via EmailService com retry + backoff
+- Limite de envios por minuto (protege a reputação/limites do SMTP)
+- Linhas pendentes (crash/shutdown) são retomadas no próximo startup;
+  cada linha é "reivindicada" antes do envio, então vários processos
+  do uvicorn não enviam o mesmo email duas vezes
+- Campos secretos (senha temporária) ficam só em memória, nunca na tabela
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+from supabase_service import get_supabase_service
+from email_service import get_email_service
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_TABLE = 'email_outbox'
+
+# kind -> método do EmailService
+EMAIL_KINDS = {
+    'campaign_completed': 'send_campaign_completed',
+    'purchase_confirmation': 'send_purchase_confirmation',
+    'welcome_with_credentials': 'send_welcome_with_credentials',
+}
+
+# kind -> campos que não são gravados em 'payload' (linhas 'failed' ficam na
+# tabela sem prazo). Se o processo cair antes do envio, o email não é retomado.
+SENSITIVE_FIELDS = {
+    'welcome_with_credentials': ('temp_password',),
+}
+
+
+class _RateLimiter:
+    """Espaça os envios para no máximo `per_minute` emails por minuto"""
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class EmailOutbox:
+    """Outbox durável com worker de envio em background"""
+
+    def __init__(self):
+        self.workers = int(os.getenv('EMAIL_OUTBOX_WORKERS', '2'))
+        self.max_attempts = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '5'))
+        self.retry_delay = float(os.getenv('EMAIL_OUTBOX_RETRY_DELAY', '30'))
+        self.retry_delay_max = float(os.getenv('EMAIL_OUTBOX_RETRY_DELAY_MAX', '900'))
+        self.stale_after = float(os.getenv('EMAIL_OUTBOX_STALE_AFTER', '600'))  # 'sending' travado
+        self.drain_timeout = float(os.getenv('EMAIL_OUTBOX_DRAIN_TIMEOUT', '10'))
+        self._rate = _RateLimiter(int(os.getenv('EMAIL_RATE_PER_MINUTE', '60')))
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._retry_tasks = set()
+        self._running = False
+        self.metrics: Dict[str, int] = {
+            'enqueued': 0,
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'restored': 0,
+        }
+
+    async def start(self) -> None:
+        """Inicia os workers e retoma emails pendentes de execuções anteriores"""
+        if self._running:
+            return
+
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+        self._running = True
+        logger.info(f"📧 Outbox de emails iniciada: {self.workers} workers")
+
+        await self._restore_pending()
+
+    async def stop(self) -> None:
+        """Para os workers; o que não foi enviado continua 'pending' na tabela"""
+        if not self._running:
+            return
+
+        self._running = False
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Timeout ao drenar outbox de emails ({self._queue.qsize()} pendentes ficam na tabela)")
+
+        for task in [*self._tasks, *self._retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retry_tasks, return_exceptions=True)
+
+        self._tasks = []
+        self._retry_tasks = set()
+        self._queue = None
+
+    async def enqueue(self, kind: str, **kwargs: Any) -> None:
+        """
+        Enfileira um email para envio em background.
+
+        Args:
+            kind: Tipo do email (chave de EMAIL_KINDS)
+            **kwargs: Argumentos do método correspondente do EmailService
+        """
+        if kind not in EMAIL_KINDS:
+            raise ValueError(f"Tipo de email desconhecido: {kind}")
+
+        row_id = self._persist(kind, kwargs)
+        self.metrics['enqueued'] += 1
+
+        if not self._running:
+            # Outbox não iniciada (scripts/testes) - envia inline
+            await self._handle((row_id, kind, kwargs, 0))
+            return
+
+        self._queue.put_nowait((row_id, kind, kwargs, 0))
+
+    def _persist(self, kind: str, kwargs: Dict[str, Any]) -> Optional[int]:
+        try:
+            db = get_supabase_service()
+            result = db.client.table(OUTBOX_TABLE).insert({
+                'kind': kind,
+                'to_email': kwargs.get('user_email'),
+                'payload': {k: v for k, v in kwargs.items() if k not in SENSITIVE_FIELDS.get(kind, ())},
+                'status': 'pending'
+            }).execute()
+            return result.data[0]['id'] if result.data else None
+        except Exception as e:
+            # Sem tabela/DB o email segue só em memória
+            logger.warning(f"⚠️ Erro ao gravar email na outbox (seguindo em memória): {e}")
+            return None
+
+    def _update(self, row_id: Optional[int], data: Dict[str, Any], expected_status: Optional[str] = None) -> Optional[bool]:
+        """
+        Atualiza a linha; com expected_status funciona como 'claim' atômico.
+
+        Returns:
+            True se atualizou, False se nenhuma linha estava no expected_status,
+            None se a atualização falhou (DB/rede)
+        """
+        if row_id is None:
+            return True
+        try:
+            db = get_supabase_service()
+            query = db.client.table(OUTBOX_TABLE)\
+                .update({**data, 'updated_at': datetime.utcnow().isoformat()})\
+                .eq('id', row_id)
+            if expected_status:
+                query = query.eq('status', expected_status)
+            result = query.execute()
+            return bool(result.data) if expected_status else True
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao atualizar outbox #{row_id}: {e}")
+            return None
+
+    def _delete(self, row_id: Optional[int]) -> None:
+        if row_id is None:
+            return
+        try:
+            db = get_supabase_service()
+            db.client.table(OUTBOX_TABLE).delete().eq('id', row_id).execute()
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao remover outbox #{row_id}: {e}")
+
+    async def _consume(self) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._handle(item)
+            except Exception as e:
+                logger.error(f"❌ Erro inesperado na outbox de emails: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _handle(self, item: Tuple[Optional[int], str, Dict[str, Any], int]) -> None:
+        row_id, kind, kwargs, attempts = item
+
+        claimed = self._update(row_id, {'status': 'sending'}, expected_status='pending')
+        if claimed is False:
+            # Outro processo já pegou (ou já enviou) este email
+            return
+        if claimed is None:
+            # Falha ao reivindicar não é "já enviado": descartar perderia o email
+            # (e a senha temporária, que só existe em memória) - envia assim mesmo
+            logger.warning(f"⚠️ Outbox #{row_id} não pôde ser reivindicada, enviando '{kind}' assim mesmo")
+
+        email_service = get_email_service()
+        if not email_service.is_configured():
+            self.metrics['failed'] += 1
+            self._update(row_id, {'status': 'failed', 'last_error': 'SMTP não configurado'})
+            logger.error(f"❌ Email '{kind}' para {kwargs.get('user_email')} não enviado: SMTP não configurado")
+            return
+
+        await self._rate.acquire()
+
+        error = None
+        try:
+            sent = await getattr(email_service, EMAIL_KINDS[kind])(**kwargs)
+            if not sent:
+                error = 'SMTP recusou o envio'
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+
+        if error is None:
+            self.metrics['sent'] += 1
+            self._delete(row_id)
+            logger.info(f"📧 Email '{kind}' enviado para {kwargs.get('user_email')}")
+            return
+
+        attempts += 1
+        if attempts >= self.max_attempts:
+            self.metrics['failed'] += 1
+            self._update(row_id, {'status': 'failed', 'attempts': attempts, 'last_error': error})
+            logger.error(f"❌ Email '{kind}' para {kwargs.get('user_email')} falhou após {attempts} tentativas: {error}")
+            return
+
+        delay = min(self.retry_delay_max, self.retry_delay * (2 ** (attempts - 1)))
+        self.metrics['retried'] += 1
+        self._update(row_id, {
+            'status': 'pending',
+            'attempts': attempts,
+            'last_error': error,
+            'next_attempt_at': (datetime.utcnow() + timedelta(seconds=delay)).isoformat()
+        })
+        logger.warning(f"⚠️ Email '{kind}' para {kwargs.get('user_email')} falhou ({error}), nova tentativa em {delay:.0f}s")
+
+        if self._running:
+            task = asyncio.create_task(self._requeue_later((row_id, kind, kwargs, attempts), delay))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+
+    async def _requeue_later(self, item, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if self._running:
+            self._queue.put_nowait(item)
+
+    async def _restore_pending(self, batch_size: int = 500) -> None:
+        try:
+            db = get_supabase_service()
+
+            # Linhas presas em 'sending' (processo morreu no meio do envio)
+            stale_before = (datetime.utcnow() - timedelta(seconds=self.stale_after)).isoformat()
+            db.client.table(OUTBOX_TABLE)\
+                .update({'status': 'pending'})\
+                .eq('status', 'sending')\
+                .lt('updated_at', stale_before)\
+                .execute()
+
+            result = db.client.table(OUTBOX_TABLE)\
+                .select('id, kind, payload, attempts')\
+                .eq('status', 'pending')\
+                .order('id')\
+                .limit(batch_size)\
+                .execute()
+
+            for row in result.data or []:
+                if row['kind'] not in EMAIL_KINDS:
+                    continue
+                payload = row['payload'] or {}
+                missing = [f for f in SENSITIVE_FIELDS.get(row['kind'], ()) if f not in payload]
+                if missing:
+                    # Segredo não foi persistido - não dá para reenviar este email
+                    self._update(row['id'], {'status': 'failed', 'last_error': 'Campos sensíveis não persistidos; reenviar manualmente'})
+                    logger.error(f"❌ Email '{row['kind']}' #{row['id']} não pode ser retomado (campos sensíveis não persistidos)")
+                    continue
+                self._queue.put_nowait((row['id'], row['kind'], payload, row.get('attempts') or 0))
+                self.metrics['restored'] += 1
+
+            if self.metrics['restored']:
+                logger.info(f"📧 {self.metrics['restored']} emails pendentes retomados da outbox")
+        except Exception as e:
+            logger.error(f"❌ Erro ao retomar outbox de emails: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.metrics,
+            'running': self._running,
+            'depth': self._queue.qsize() if self._queue else 0,
+            'retrying': len(self._retry_tasks),
+        }
+
+
+# Singleton global
+_email_outbox: Optional[EmailOutbox] = None
+
+
+def get_email_outbox() -> EmailOutbox:
+    """Retorna instância singleton da outbox de emails"""
+    global _email_outbox
+    if _email_outbox is None:
+        _email_outbox = EmailOutbox()
+    return _email_outbox
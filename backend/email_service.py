@@ -1,18 +1,69 @@
 """
 Email Service - Envio de emails via SMTP
-Suporta templates HTML e envio assíncrono
+Suporta templates HTML, envio assíncrono e pool de conexões SMTP
 """
 import os
 import ssl
+import time
+import asyncio
 import logging
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
+import tempfile
 import aiosmtplib
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 logger = logging.getLogger(__name__)
 
+# ========== Templates ==========
+# Templates ficam em email_templates/ e são compilados uma única vez:
+# o Environment guarda os templates compilados em memória e o bytecode cache
+# evita recompilar no restart do processo.
+EMAIL_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_templates')
+EMAIL_TEMPLATE_CACHE_DIR = os.getenv(
+    'EMAIL_TEMPLATE_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'client4you_email_templates')
+)
+
+
+def _build_template_env() -> Environment:
+    bytecode_cache = None
+    try:
+        os.makedirs(EMAIL_TEMPLATE_CACHE_DIR, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(EMAIL_TEMPLATE_CACHE_DIR)
+    except OSError as e:
+        logger.warning(f"⚠️ Bytecode cache de templates desativado: {e}")
+
+    return Environment(
+        loader=FileSystemLoader(EMAIL_TEMPLATES_DIR),
+        bytecode_cache=bytecode_cache,
+        auto_reload=False,
+        cache_size=-1
+    )
+
+
+_template_env = _build_template_env()
+
+
+def render_email_template(name: str, **context: Any) -> str:
+    """Renderiza um template de email já compilado"""
+    return _template_env.get_template(name).render(**context)
+
+
+def precompile_email_templates() -> None:
+    """Compila todos os templates de email (chamado no startup)"""
+    for name in _template_env.list_templates(extensions=['html']):
+        _template_env.get_template(name)
+
+
+class _PooledSMTP:
+    """Conexão SMTP autenticada mantida no pool"""
+
+    def __init__(self, smtp: aiosmtplib.SMTP):
+        self.smtp = smtp
+        self.last_used = time.monotonic()
+
 
 class EmailService:
     def __init__(self):
@@ -24,9 +75,151 @@ class EmailService:
         self.from_name = os.getenv('SMTP_FROM_NAME', 'Client4You')
         self.use_tls = os.getenv('SMTP_USE_TLS', 'true').lower() == 'true'
         
+        # Pool de conexões SMTP (conexão lazy, reaproveitada entre envios)
+        self.pool_size = int(os.getenv('SMTP_POOL_SIZE', '2'))
+        self.idle_timeout = float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))  # fecha conexões ociosas
+        self.noop_interval = float(os.getenv('SMTP_NOOP_INTERVAL', '15'))  # health check antes de reusar
+        self._idle: List[_PooledSMTP] = []
+        self._slots = asyncio.Semaphore(self.pool_size)
+        
         if not all([self.smtp_host, self.smtp_user, self.smtp_password]):
             logger.warning("SMTP não configurado completamente. Emails não serão enviados.")
     
+    def is_configured(self) -> bool:
+        return all([self.smtp_host, self.smtp_user, self.smtp_password])
+    
+    # ========== Pool de conexões ==========
+    
+    async def _connect(self) -> _PooledSMTP:
+        """Abre conexão SMTP (TLS + login)"""
+        if self.use_tls:
+            context = ssl.create_default_context()
+            smtp = aiosmtplib.SMTP(
+                hostname=self.smtp_host,
+                port=self.smtp_port,
+                use_tls=True,
+                tls_context=context
+            )
+        else:
+            smtp = aiosmtplib.SMTP(
+                hostname=self.smtp_host,
+                port=self.smtp_port
+            )
+        
+        await smtp.connect()
+        await smtp.login(self.smtp_user, self.smtp_password)
+        return _PooledSMTP(smtp)
+    
+    async def _discard(self, conn: _PooledSMTP) -> None:
+        try:
+            await conn.smtp.quit()
+        except Exception:
+            conn.smtp.close()
+    
+    async def _acquire(self) -> _PooledSMTP:
+        """Pega uma conexão ociosa saudável do pool ou abre uma nova"""
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                idle_for = time.monotonic() - conn.last_used
+                
+                if idle_for > self.idle_timeout or not conn.smtp.is_connected:
+                    await self._discard(conn)
+                    continue
+                
+                if idle_for > self.noop_interval:
+                    try:
+                        await conn.smtp.noop()
+                    except Exception:
+                        await self._discard(conn)
+                        continue
+                
+                return conn
+            
+            return await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+    
+    async def _release(self, conn: _PooledSMTP, healthy: bool = True) -> None:
+        if healthy:
+            conn.last_used = time.monotonic()
+            self._idle.append(conn)
+        else:
+            await self._discard(conn)
+        self._slots.release()
+    
+    async def close(self) -> None:
+        """Fecha todas as conexões ociosas (shutdown)"""
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await self._discard(conn)
+    
+    # ========== Envio ==========
+    
+    def _build_message(
+        self,
+        to_email: str,
+        subject: str,
+        html_body: str,
+        plain_body: Optional[str] = None
+    ) -> MIMEMultipart:
+        message = MIMEMultipart('alternative')
+        message['From'] = f"{self.from_name} <{self.from_email}>"
+        message['To'] = to_email
+        message['Subject'] = subject
+        
+        # Adicionar corpo em texto simples (fallback)
+        if plain_body:
+            part1 = MIMEText(plain_body, 'plain', 'utf-8')
+            message.attach(part1)
+        
+        # Adicionar corpo HTML
+        part2 = MIMEText(html_body, 'html', 'utf-8')
+        message.attach(part2)
+        return message
+    
+    async def _send_over_session(self, messages: List[MIMEMultipart]) -> List[bool]:
+        """
+        Envia várias mensagens na mesma sessão autenticada.
+        Se a conexão cair no meio, reconecta uma vez e continua de onde parou.
+        """
+        results: List[bool] = []
+        reconnected = False
+        conn = await self._acquire()
+        healthy = True
+        try:
+            index = 0
+            while index < len(messages):
+                message = messages[index]
+                try:
+                    await conn.smtp.send_message(message)
+                    results.append(True)
+                    logger.info(f"✅ Email enviado com sucesso para {message['To']}")
+                    index += 1
+                except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, ConnectionError) as e:
+                    if reconnected:
+                        raise
+                    logger.warning(f"Conexão SMTP perdida ({e}), reconectando...")
+                    await self._discard(conn)
+                    conn = await self._connect()
+                    reconnected = True
+                except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPResponseException) as e:
+                    # Recusa desta mensagem (destinatário, 552, erro no DATA...), não da
+                    # conexão: o aiosmtplib já fez RSET, segue na mesma sessão
+                    logger.error(f"❌ Erro ao enviar email para {message['To']}: {e}")
+                    results.append(False)
+                    index += 1
+        except Exception as e:
+            healthy = False
+            for message in messages[len(results):]:
+                logger.error(f"❌ Erro ao enviar email para {message['To']}: {e}")
+                results.append(False)
+        finally:
+            await self._release(conn, healthy)
+        return results
+    
     async def send_email(
         self,
         to_email: str,
@@ -35,7 +228,7 @@ class EmailService:
         plain_body: Optional[str] = None
     ) -> bool:
         """
-        Envia email via SMTP
+        Envia email via SMTP (reaproveitando conexão do pool)
         
         Args:
             to_email: Email do destinatário
@@ -46,54 +239,47 @@ class EmailService:
         Returns:
             True se enviado com sucesso, False caso contrário
         """
-        if not all([self.smtp_host, self.smtp_user, self.smtp_password]):
+        if not self.is_configured():
             logger.error("SMTP não configurado. Email não enviado.")
             return False
         
         try:
-            # Criar mensagem
-            message = MIMEMultipart('alternative')
-            message['From'] = f"{self.from_name} <{self.from_email}>"
-            message['To'] = to_email
-            message['Subject'] = subject
-            
-            # Adicionar corpo em texto simples (fallback)
-            if plain_body:
-                part1 = MIMEText(plain_body, 'plain', 'utf-8')
-                message.attach(part1)
-            
-            # Adicionar corpo HTML
-            part2 = MIMEText(html_body, 'html', 'utf-8')
-            message.attach(part2)
-            
-            # Configurar SSL/TLS
-            if self.use_tls:
-                context = ssl.create_default_context()
-                smtp = aiosmtplib.SMTP(
-                    hostname=self.smtp_host,
-                    port=self.smtp_port,
-                    use_tls=True,
-                    tls_context=context
-                )
-            else:
-                smtp = aiosmtplib.SMTP(
-                    hostname=self.smtp_host,
-                    port=self.smtp_port
-                )
-            
-            # Conectar e enviar
-            await smtp.connect()
-            await smtp.login(self.smtp_user, self.smtp_password)
-            await smtp.send_message(message)
-            await smtp.quit()
-            
-            logger.info(f"✅ Email enviado com sucesso para {to_email}")
-            return True
-            
+            message = self._build_message(to_email, subject, html_body, plain_body)
+            results = await self._send_over_session([message])
+            return results[0]
         except Exception as e:
             logger.error(f"❌ Erro ao enviar email para {to_email}: {e}")
             return False
     
+    async def send_bulk(self, emails: List[Dict[str, Any]]) -> List[bool]:
+        """
+        Envia vários emails em uma única sessão SMTP autenticada
+        
+        Args:
+            emails: Lista de dicts com to_email, subject, html_body e plain_body (opcional)
+        
+        Returns:
+            Lista de resultados (True/False), na mesma ordem da entrada
+        """
+        if not emails:
+            return []
+        
+        if not self.is_configured():
+            logger.error("SMTP não configurado. Emails não enviados.")
+            return [False] * len(emails)
+        
+        try:
+            messages = [
+                self._build_message(
+                    e['to_email'], e['subject'], e['html_body'], e.get('plain_body')
+                )
+                for e in emails
+            ]
+            return await self._send_over_session(messages)
+        except Exception as e:
+            logger.error(f"❌ Erro no envio em lote ({len(emails)} emails): {e}")
+            return [False] * len(emails)
+    
     async def send_purchase_confirmation(
         self,
         user_email: str,
@@ -107,141 +293,8 @@ class EmailService:
         """
         subject = f"🎉 Bem-vindo ao {plan_name}!"
         
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                body { 
-                    font-family: Arial, sans-serif; 
-                    line-height: 1.6; 
-                    color: #333;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                }
-                .container { 
-                    max-width: 600px; 
-                    margin: 20px auto; 
-                    background: #ffffff;
-                    border-radius: 10px;
-                    overflow: hidden;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-                }
-                .header { 
-                    background: linear-gradient(135deg, #FF8C00 0%, #FFC300 100%);
-                    color: white; 
-                    padding: 30px 20px; 
-                    text-align: center;
-                }
-                .header h1 {
-                    margin: 0;
-                    font-size: 28px;
-                }
-                .content { 
-                    padding: 30px 20px;
-                }
-                .plan-box {
-                    background: #f8f9fa;
-                    border-left: 4px solid #FF8C00;
-                    padding: 20px;
-                    margin: 20px 0;
-                    border-radius: 5px;
-                }
-                .plan-box h2 {
-                    margin-top: 0;
-                    color: #FF8C00;
-                }
-                .features {
-                    list-style: none;
-                    padding: 0;
-                }
-                .features li {
-                    padding: 8px 0;
-                    padding-left: 25px;
-                    position: relative;
-                }
-                .features li:before {
-                    content: "✓";
-                    position: absolute;
-                    left: 0;
-                    color: #28a745;
-                    font-weight: bold;
-                }
-                .button {
-                    display: inline-block;
-                    padding: 12px 30px;
-                    background: linear-gradient(135deg, #FF8C00 0%, #FFC300 100%);
-                    color: white;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin: 20px 0;
-                    font-weight: bold;
-                }
-                .footer {
-                    background: #f8f9fa;
-                    padding: 20px;
-                    text-align: center;
-                    color: #666;
-                    font-size: 12px;
-                }
-                .order-id {
-                    background: #e9ecef;
-                    padding: 10px;
-                    border-radius: 5px;
-                    font-family: monospace;
-                    margin: 10px 0;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🎉 Compra Confirmada!</h1>
-                </div>
-                
-                <div class="content">
-                    <p>Olá <strong>{{ user_name }}</strong>,</p>
-                    
-                    <p>Sua compra foi aprovada com sucesso! Agora você tem acesso completo ao <strong>{{ plan_name }}</strong>.</p>
-                    
-                    <div class="plan-box">
-                        <h2>{{ plan_name }}</h2>
-                        <p><strong>O que você pode fazer agora:</strong></p>
-                        <ul class="features">
-                        {% for feature in plan_features %}
-                            <li>{{ feature }}</li>
-                        {% endfor %}
-                        </ul>
-                    </div>
-                    
-                    <div style="text-align: center;">
-                        <a href="https://whatsapp-agent-flow.preview.emergentagent.com/login" class="button">
-                            Acessar Plataforma
-                        </a>
-                    </div>
-                    
-                    <p><strong>Número do Pedido:</strong></p>
-                    <div class="order-id">{{ order_id }}</div>
-                    
-                    <p style="margin-top: 30px;">Se tiver qualquer dúvida, estamos aqui para ajudar!</p>
-                    
-                    <p>Atenciosamente,<br>
-                    <strong>Equipe Client4You</strong></p>
-                </div>
-                
-                <div class="footer">
-                    <p>Este é um email automático, por favor não responda.</p>
-                    <p>© 2025 Client4You - Todos os direitos reservados</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        template = Template(html_template)
-        html_body = template.render(
+        html_body = render_email_template(
+            'purchase_confirmation.html',
             user_name=user_name,
             plan_name=plan_name,
             plan_features=plan_features,
@@ -281,167 +334,8 @@ class EmailService:
         
         subject = f"✅ Campanha '{campaign_name}' Concluída"
         
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                body { 
-                    font-family: Arial, sans-serif; 
-                    line-height: 1.6; 
-                    color: #333;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                }
-                .container { 
-                    max-width: 600px; 
-                    margin: 20px auto; 
-                    background: #ffffff;
-                    border-radius: 10px;
-                    overflow: hidden;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-                }
-                .header { 
-                    background: linear-gradient(135deg, #28a745 0%, #20c997 100%);
-                    color: white; 
-                    padding: 30px 20px; 
-                    text-align: center;
-                }
-                .header h1 {
-                    margin: 0;
-                    font-size: 28px;
-                }
-                .content { 
-                    padding: 30px 20px;
-                }
-                .stats-grid {
-                    display: grid;
-                    grid-template-columns: repeat(2, 1fr);
-                    gap: 15px;
-                    margin: 25px 0;
-                }
-                .stat-box {
-                    background: #f8f9fa;
-                    padding: 20px;
-                    border-radius: 8px;
-                    text-align: center;
-                    border: 2px solid #e9ecef;
-                }
-                .stat-number {
-                    font-size: 32px;
-                    font-weight: bold;
-                    color: #FF8C00;
-                    margin: 10px 0;
-                }
-                .stat-label {
-                    color: #666;
-                    font-size: 14px;
-                }
-                .success-rate {
-                    background: #d4edda;
-                    border: 2px solid #28a745;
-                    color: #155724;
-                    padding: 15px;
-                    border-radius: 8px;
-                    text-align: center;
-                    font-size: 18px;
-                    font-weight: bold;
-                    margin: 20px 0;
-                }
-                .button {
-                    display: inline-block;
-                    padding: 12px 30px;
-                    background: linear-gradient(135deg, #FF8C00 0%, #FFC300 100%);
-                    color: white;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin: 20px 0;
-                    font-weight: bold;
-                }
-                .footer {
-                    background: #f8f9fa;
-                    padding: 20px;
-                    text-align: center;
-                    color: #666;
-                    font-size: 12px;
-                }
-                .campaign-name {
-                    background: #e9ecef;
-                    padding: 15px;
-                    border-radius: 5px;
-                    font-size: 18px;
-                    font-weight: bold;
-                    color: #495057;
-                    margin: 15px 0;
-                    text-align: center;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>✅ Campanha Concluída!</h1>
-                </div>
-                
-                <div class="content">
-                    <p>Olá <strong>{{ user_name }}</strong>,</p>
-                    
-                    <p>Sua campanha de WhatsApp foi concluída com sucesso!</p>
-                    
-                    <div class="campaign-name">
-                        {{ campaign_name }}
-                    </div>
-                    
-                    <div class="success-rate">
-                        Taxa de Sucesso: {{ success_rate }}%
-                    </div>
-                    
-                    <div class="stats-grid">
-                        <div class="stat-box">
-                            <div class="stat-label">Total de Contatos</div>
-                            <div class="stat-number">{{ total_contacts }}</div>
-                        </div>
-                        <div class="stat-box">
-                            <div class="stat-label">Enviados com Sucesso</div>
-                            <div class="stat-number" style="color: #28a745;">{{ total_sent }}</div>
-                        </div>
-                        <div class="stat-box">
-                            <div class="stat-label">Com Erro</div>
-                            <div class="stat-number" style="color: #dc3545;">{{ total_errors }}</div>
-                        </div>
-                        <div class="stat-box">
-                            <div class="stat-label">Pendentes</div>
-                            <div class="stat-number" style="color: #ffc107;">{{ total_pending }}</div>
-                        </div>
-                    </div>
-                    
-                    <p>Você pode visualizar os detalhes completos e logs da campanha na plataforma.</p>
-                    
-                    <div style="text-align: center;">
-                        <a href="https://whatsapp-agent-flow.preview.emergentagent.com/disparador" class="button">
-                            Ver Detalhes da Campanha
-                        </a>
-                    </div>
-                    
-                    <p style="margin-top: 30px;">Continue aproveitando todas as funcionalidades da plataforma!</p>
-                    
-                    <p>Atenciosamente,<br>
-                    <strong>Equipe Client4You</strong></p>
-                </div>
-                
-                <div class="footer">
-                    <p>Este é um email automático, por favor não responda.</p>
-                    <p>© 2025 Client4You - Todos os direitos reservados</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        template = Template(html_template)
-        html_body = template.render(
+        html_body = render_email_template(
+            'campaign_completed.html',
             user_name=user_name,
             campaign_name=campaign_name,
             total_contacts=total_contacts,
@@ -486,193 +380,8 @@ class EmailService:
         """
         subject = f"🔐 Suas Credenciais de Acesso - {plan_name}"
         
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                body { 
-                    font-family: Arial, sans-serif; 
-                    line-height: 1.6; 
-                    color: #333;
-                    background-color: #f4f4f4;
-                    margin: 0;
-                    padding: 0;
-                }
-                .container { 
-                    max-width: 600px; 
-                    margin: 20px auto; 
-                    background: #ffffff;
-                    border-radius: 10px;
-                    overflow: hidden;
-                    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-                }
-                .header { 
-                    background: linear-gradient(135deg, #FF8C00 0%, #FFC300 100%);
-                    color: white; 
-                    padding: 30px 20px; 
-                    text-align: center;
-                }
-                .header h1 {
-                    margin: 0;
-                    font-size: 28px;
-                }
-                .content { 
-                    padding: 30px 20px;
-                }
-                .credentials-box {
-                    background: linear-gradient(135deg, #1e3a5f 0%, #2c5282 100%);
-                    color: white;
-                    padding: 25px;
-                    margin: 25px 0;
-                    border-radius: 10px;
-                    text-align: center;
-                }
-                .credentials-box h2 {
-                    margin-top: 0;
-                    font-size: 20px;
-                    border-bottom: 1px solid rgba(255,255,255,0.3);
-                    padding-bottom: 15px;
-                }
-                .credential-item {
-                    background: rgba(255,255,255,0.1);
-                    padding: 12px 20px;
-                    margin: 10px 0;
-                    border-radius: 5px;
-                    font-family: monospace;
-                    font-size: 16px;
-                }
-                .credential-label {
-                    font-size: 12px;
-                    opacity: 0.8;
-                    margin-bottom: 5px;
-                }
-                .warning-box {
-                    background: #fff3cd;
-                    border: 1px solid #ffc107;
-                    color: #856404;
-                    padding: 15px;
-                    border-radius: 5px;
-                    margin: 20px 0;
-                    font-size: 14px;
-                }
-                .plan-box {
-                    background: #f8f9fa;
-                    border-left: 4px solid #FF8C00;
-                    padding: 20px;
-                    margin: 20px 0;
-                    border-radius: 5px;
-                }
-                .plan-box h3 {
-                    margin-top: 0;
-                    color: #FF8C00;
-                }
-                .features {
-                    list-style: none;
-                    padding: 0;
-                }
-                .features li {
-                    padding: 8px 0;
-                    padding-left: 25px;
-                    position: relative;
-                }
-                .features li:before {
-                    content: "✓";
-                    position: absolute;
-                    left: 0;
-                    color: #28a745;
-                    font-weight: bold;
-                }
-                .button {
-                    display: inline-block;
-                    padding: 15px 40px;
-                    background: linear-gradient(135deg, #FF8C00 0%, #FFC300 100%);
-                    color: white;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin: 20px 0;
-                    font-weight: bold;
-                    font-size: 18px;
-                }
-                .footer {
-                    background: #f8f9fa;
-                    padding: 20px;
-                    text-align: center;
-                    color: #666;
-                    font-size: 12px;
-                }
-                .order-id {
-                    background: #e9ecef;
-                    padding: 10px;
-                    border-radius: 5px;
-                    font-family: monospace;
-                    margin: 10px 0;
-                    font-size: 12px;
-                }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🎉 Bem-vindo ao Client4You!</h1>
-                </div>
-                
-                <div class="content">
-                    <p>Olá <strong>{{ user_name }}</strong>,</p>
-                    
-                    <p>Sua compra foi aprovada! Sua conta foi criada automaticamente e você já pode começar a usar a plataforma.</p>
-                    
-                    <div class="credentials-box">
-                        <h2>🔐 Suas Credenciais de Acesso</h2>
-                        
-                        <div class="credential-label">EMAIL / LOGIN</div>
-                        <div class="credential-item">{{ user_email }}</div>
-                        
-                        <div class="credential-label">SENHA TEMPORÁRIA</div>
-                        <div class="credential-item">{{ temp_password }}</div>
-                    </div>
-                    
-                    <div class="warning-box">
-                        ⚠️ <strong>Importante:</strong> Por segurança, recomendamos que você altere sua senha após o primeiro acesso.
-                    </div>
-                    
-                    <div style="text-align: center;">
-                        <a href="{{ login_url }}" class="button">
-                            Acessar Minha Conta
-                        </a>
-                    </div>
-                    
-                    <div class="plan-box">
-                        <h3>{{ plan_name }}</h3>
-                        <p><strong>O que você pode fazer:</strong></p>
-                        <ul class="features">
-                        {% for feature in plan_features %}
-                            <li>{{ feature }}</li>
-                        {% endfor %}
-                        </ul>
-                    </div>
-                    
-                    <p><strong>Número do Pedido:</strong></p>
-                    <div class="order-id">{{ order_id }}</div>
-                    
-                    <p style="margin-top: 30px;">Se tiver qualquer dúvida, estamos aqui para ajudar!</p>
-                    
-                    <p>Atenciosamente,<br>
-                    <strong>Equipe Client4You</strong></p>
-                </div>
-                
-                <div class="footer">
-                    <p>Este é um email automático, por favor não responda.</p>
-                    <p>© 2025 Client4You - Todos os direitos reservados</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        template = Template(html_template)
-        html_body = template.render(
+        html_body = render_email_template(
+            'welcome_credentials.html',
             user_name=user_name,
             user_email=user_email,
             temp_password=temp_password,
@@ -13,14 +13,15 @@ import logging
 import secrets
 import string
 import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
 load_dotenv()
 
-from supabase_service import SupabaseService
-from email_service import get_email_service
+from supabase_service import get_supabase_service, is_missing_function
+from email_outbox import get_email_outbox
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +31,11 @@ webhook_router = APIRouter(prefix="/api")
 # Configuração Kiwify
 KIWIFY_WEBHOOK_SECRET = os.environ.get('KIWIFY_WEBHOOK_SECRET', '')
 
+# Ledger de idempotência (order_id, event_type)
+KIWIFY_LEDGER_TABLE = 'kiwify_processed_events'
+# Evento 'processing' mais antigo que isso é considerado abandonado (crash)
+KIWIFY_LEDGER_STALE_SECONDS = int(os.environ.get('KIWIFY_LEDGER_STALE_SECONDS', '300'))
+
 # Mapeamento por nome do plano (como aparece no Kiwify)
 PLAN_NAME_MAP = {
     'básico': 'basico',
@@ -114,7 +120,7 @@ def generate_temporary_password(length=12):
 async def get_user_by_email(email: str) -> Optional[Dict]:
     """Busca usuário pelo email"""
     try:
-        db = SupabaseService()
+        db = get_supabase_service()
         result = db.client.table('profiles').select('*').eq('email', email).maybe_single().execute()
         return result.data
     except Exception as e:
@@ -127,7 +133,7 @@ async def create_new_user(email: str, name: str) -> Dict:
     Cria um novo usuário no Supabase Auth e retorna os dados
     """
     try:
-        db = SupabaseService()
+        db = get_supabase_service()
         password = generate_temporary_password()
         
         logger.info(f"🆕 Criando novo usuário para: {email}")
@@ -162,48 +168,92 @@ async def create_new_user(email: str, name: str) -> Dict:
         raise e
 
 
+def build_quota_data(plan: str, subscription_id: str, order_id: str) -> Dict[str, Any]:
+    """Monta os dados da cota do plano (sem user_id)"""
+    # Calcular data de expiração (30 dias para planos pagos)
+    valid_until = (datetime.now() + timedelta(days=30)).isoformat()
+    
+    # Buscar configuração do plano
+    plan_key = plan.lower()
+    plan_config = PLAN_LIMITS.get(plan_key, PLAN_LIMITS['basico'])
+    
+    return {
+        'plan_type': plan_key,
+        'plan_name': plan_config['name'],
+        'leads_limit': plan_config['leads_limit'],
+        'campaigns_limit': plan_config['campaigns_limit'],
+        'messages_limit': plan_config['messages_limit'],
+        'plan_expires_at': valid_until,
+        'subscription_id': subscription_id,
+        'order_id': order_id,
+        'updated_at': datetime.now().isoformat()
+    }
+
+
 async def upgrade_user_to_plan(user_id: str, plan: str, subscription_id: str, order_id: str):
     """
     Upgrade do plano do usuário (Usando UPSERT para garantir criação)
     """
     try:
-        db = SupabaseService()
-        
-        # Calcular data de expiração (30 dias para planos pagos)
-        valid_until = (datetime.now() + timedelta(days=30)).isoformat()
-        
-        # Buscar configuração do plano
-        plan_key = plan.lower()
-        plan_config = PLAN_LIMITS.get(plan_key, PLAN_LIMITS['demo'])
+        db = get_supabase_service()
         
         # Dados para atualização/inserção
         quota_data = {
             'user_id': user_id,
-            'plan_type': plan_key,
-            'plan_name': plan_config['name'],
-            'leads_limit': plan_config['leads_limit'],
-            'campaigns_limit': plan_config['campaigns_limit'],
-            'messages_limit': plan_config['messages_limit'],
-            'plan_expires_at': valid_until,
-            'subscription_id': subscription_id,
-            'order_id': order_id,
-            'updated_at': datetime.now().isoformat()
+            **build_quota_data(plan, subscription_id, order_id)
         }
         
         # UPSERT: Atualiza se existir, Cria se não existir
         db.client.table('user_quotas').upsert(quota_data, on_conflict='user_id').execute()
         
-        logger.info(f"✅ Usuário {user_id} atualizado/criado com plano {plan_config['name']}")
+        logger.info(f"✅ Usuário {user_id} atualizado/criado com plano {quota_data['plan_name']}")
         
     except Exception as e:
         logger.error(f"Erro ao fazer upgrade: {e}")
         raise
 
 
+async def apply_plan_by_email(email: str, plan: str, subscription_id: str, order_id: str) -> Optional[str]:
+    """
+    Busca o usuário pelo email e aplica o plano em uma única chamada RPC.
+    
+    Returns:
+        user_id do usuário atualizado, ou None se não existir conta com esse email
+    """
+    db = get_supabase_service()
+    quota_data = build_quota_data(plan, subscription_id, order_id)
+    
+    try:
+        result = db.client.rpc('apply_plan_by_email', {
+            'p_email': email,
+            'p_quota': quota_data
+        }).execute()
+        user_id = result.data
+        if user_id:
+            logger.info(f"✅ Usuário {user_id} atualizado/criado com plano {quota_data['plan_name']}")
+        return user_id
+    except Exception as e:
+        if not is_missing_function(e):
+            raise
+        logger.warning(f"RPC apply_plan_by_email not available, using fallback: {e}")
+    
+    existing_user = await get_user_by_email(email)
+    if not existing_user:
+        return None
+    
+    await upgrade_user_to_plan(
+        user_id=existing_user['id'],
+        plan=plan,
+        subscription_id=subscription_id,
+        order_id=order_id
+    )
+    return existing_user['id']
+
+
 async def downgrade_user_to_suspended(user_id: str, reason: str):
     """Suspende a conta do usuário (sem acesso a nenhuma funcionalidade)"""
     try:
-        db = SupabaseService()
+        db = get_supabase_service()
         
         # Usar plan_type='suspended' como marcador (não temos coluna subscription_status)
         db.client.table('user_quotas').update({
@@ -226,7 +276,7 @@ async def downgrade_user_to_suspended(user_id: str, reason: str):
 async def log_webhook_event(event_type: str, payload: Dict[str, Any], status: str, error: Optional[str] = None):
     """Registra evento de webhook para auditoria"""
     try:
-        db = SupabaseService()
+        db = get_supabase_service()
         db.client.table('webhook_logs').insert({
             'event_type': event_type,
             'payload': payload,
@@ -238,6 +288,237 @@ async def log_webhook_event(event_type: str, payload: Dict[str, Any], status: st
         logger.error(f"Erro ao logar webhook: {e}")
 
 
+# ========== Idempotência ==========
+
+_customer_locks: Dict[str, asyncio.Lock] = {}
+_customer_lock_users: Dict[str, int] = {}
+
+
+@asynccontextmanager
+async def customer_lock(email: str):
+    """Lock assíncrono por email do cliente (removido quando ninguém mais usa)"""
+    key = (email or '').strip().lower()
+    lock = _customer_locks.setdefault(key, asyncio.Lock())
+    _customer_lock_users[key] = _customer_lock_users.get(key, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _customer_lock_users[key] -= 1
+        if _customer_lock_users[key] == 0:
+            del _customer_lock_users[key]
+            del _customer_locks[key]
+
+
+def claim_kiwify_event(order_id: str, event_type: str) -> str:
+    """
+    Reivindica o evento no ledger de idempotência.
+    
+    Returns:
+        'claimed' se este processo deve tratar o evento,
+        'done' se já foi processado (replay) ou
+        'in_progress' se outro processo está tratando agora
+    """
+    db = get_supabase_service()
+    now = datetime.utcnow()
+    
+    try:
+        result = db.client.table(KIWIFY_LEDGER_TABLE)\
+            .select('status, updated_at')\
+            .eq('order_id', order_id)\
+            .eq('event_type', event_type)\
+            .limit(1)\
+            .execute()
+    except Exception as e:
+        # Sem ledger (tabela não criada) o webhook segue sem deduplicação
+        logger.warning(f"Ledger Kiwify indisponível, processando sem deduplicação: {e}")
+        return 'claimed'
+    
+    if result.data:
+        row = result.data[0]
+        if row['status'] == 'done':
+            return 'done'
+        
+        # 'processing' abandonado: assume o evento se ninguém atualizou há muito tempo
+        stale_before = (now - timedelta(seconds=KIWIFY_LEDGER_STALE_SECONDS)).isoformat()
+        taken = db.client.table(KIWIFY_LEDGER_TABLE)\
+            .update({'status': 'processing', 'updated_at': now.isoformat()})\
+            .eq('order_id', order_id)\
+            .eq('event_type', event_type)\
+            .eq('status', 'processing')\
+            .lt('updated_at', stale_before)\
+            .execute()
+        return 'claimed' if taken.data else 'in_progress'
+    
+    try:
+        db.client.table(KIWIFY_LEDGER_TABLE).insert({
+            'order_id': order_id,
+            'event_type': event_type,
+            'status': 'processing',
+            'created_at': now.isoformat(),
+            'updated_at': now.isoformat()
+        }, returning='minimal').execute()
+        return 'claimed'
+    except Exception as e:
+        if getattr(e, 'code', None) == '23505':
+            # Outro processo inseriu primeiro
+            return 'in_progress'
+        logger.warning(f"Erro ao gravar ledger Kiwify, processando sem deduplicação: {e}")
+        return 'claimed'
+
+
+def complete_kiwify_event(order_id: str, event_type: str, result_status: Optional[str]) -> None:
+    """Marca o evento como processado (replays passam a ser ignorados)"""
+    try:
+        db = get_supabase_service()
+        db.client.table(KIWIFY_LEDGER_TABLE).update({
+            'status': 'done',
+            'result_status': result_status,
+            'updated_at': datetime.utcnow().isoformat()
+        }).eq('order_id', order_id).eq('event_type', event_type).execute()
+    except Exception as e:
+        logger.error(f"Erro ao concluir evento no ledger Kiwify: {e}")
+
+
+def release_kiwify_event(order_id: str, event_type: str) -> None:
+    """Libera o evento após falha para que o retry da Kiwify reprocesse"""
+    try:
+        db = get_supabase_service()
+        db.client.table(KIWIFY_LEDGER_TABLE)\
+            .delete()\
+            .eq('order_id', order_id)\
+            .eq('event_type', event_type)\
+            .eq('status', 'processing')\
+            .execute()
+    except Exception as e:
+        logger.error(f"Erro ao liberar evento no ledger Kiwify: {e}")
+
+
+async def process_kiwify_event(payload: KiwifyWebhookPayload, payload_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Processa um evento Kiwify já validado e retorna a resposta do webhook"""
+    user_id = None
+    new_password = None
+    is_new_user = False
+    
+    if payload.event_type == 'order.paid':
+        # PAGAMENTO APROVADO - UPGRADE
+        product_name_lower = payload.product_name.lower().strip()
+        plan_key = PLAN_NAME_MAP.get(product_name_lower)
+        
+        if not plan_key:
+            for name, key in PLAN_NAME_MAP.items():
+                if name in product_name_lower:
+                    plan_key = key
+                    break
+        
+        if not plan_key:
+            plan_key = 'basico'
+        
+        subscription_id = payload.subscription_id or payload.order_id
+        
+        # 1. Usuário existente: busca + upsert da cota em uma única RPC
+        user_id = await apply_plan_by_email(
+            email=payload.customer_email,
+            plan=plan_key,
+            subscription_id=subscription_id,
+            order_id=payload.order_id
+        )
+        
+        if user_id:
+            logger.info(f"👤 Usuário existente encontrado: {user_id}")
+        else:
+            # 2. Se não existe, criar conta!
+            try:
+                new_user_data = await create_new_user(payload.customer_email, payload.customer_name)
+                user_id = new_user_data['id']
+                new_password = new_user_data['password']
+                is_new_user = True
+                logger.info(f"✨ Nova conta criada com sucesso: {user_id}")
+            except Exception as e:
+                logger.error(f"Falha crítica ao criar usuário: {e}")
+                raise HTTPException(status_code=500, detail="Failed to create user account")
+            
+            # Atualiza ou Insere a cota (Upsert)
+            await upgrade_user_to_plan(
+                user_id=user_id,
+                plan=plan_key,
+                subscription_id=subscription_id,
+                order_id=payload.order_id
+            )
+        
+        # ENVIAR EMAIL (via outbox - não segura a resposta para a Kiwify)
+        try:
+            plan_config = PLAN_LIMITS.get(plan_key, {})
+            email_outbox = get_email_outbox()
+            
+            # Montar lista de features do plano
+            features = []
+            if plan_config.get('leads_limit') == -1:
+                features.append("Buscas de leads ilimitadas")
+            if plan_config.get('campaigns_limit', 0) == -1:
+                features.append("Disparador WhatsApp ilimitado")
+            if plan_key == 'avancado':
+                features.append("Agente IA para atendimento automático")
+                features.append("Múltiplas instâncias WhatsApp")
+            
+            # URL de login (usar variável de ambiente ou padrão)
+            login_url = os.environ.get('FRONTEND_URL', 'https://app.client4you.com.br') + '/login'
+            
+            if is_new_user and new_password:
+                # NOVO USUÁRIO: Email especial com credenciais em destaque
+                await email_outbox.enqueue(
+                    'welcome_with_credentials',
+                    user_email=payload.customer_email,
+                    user_name=payload.customer_name,
+                    temp_password=new_password,
+                    plan_name=plan_config.get('name', plan_key),
+                    plan_features=features,
+                    order_id=payload.order_id,
+                    login_url=login_url
+                )
+                logger.info(f"📧 Email de boas-vindas COM CREDENCIAIS enfileirado para {payload.customer_email}")
+            else:
+                # USUÁRIO EXISTENTE: Email normal de upgrade
+                await email_outbox.enqueue(
+                    'purchase_confirmation',
+                    user_email=payload.customer_email,
+                    user_name=payload.customer_name,
+                    plan_name=plan_config.get('name', plan_key),
+                    plan_features=features,
+                    order_id=payload.order_id
+                )
+                logger.info(f"📧 Email de upgrade enfileirado para {payload.customer_email}")
+            
+        except Exception as e:
+            logger.error(f"❌ Erro ao enfileirar email: {e}")
+        
+        await log_webhook_event(payload.event_type, payload_dict, 'success')
+        
+        return {
+            "status": "success",
+            "message": "User processed successfully",
+            "is_new_user": is_new_user
+        }
+    
+    elif payload.event_type in ['order.refunded', 'subscription.canceled']:
+        # REEMBOLSO/CANCELAMENTO - SUSPENDER CONTA
+        existing_user = await get_user_by_email(payload.customer_email)
+        if not existing_user:
+            # Cancelamento/reembolso de user que não existe, ignora
+            logger.warning(f"⚠️ Evento {payload.event_type} para usuário inexistente ignorado.")
+            return {"status": "ignored", "message": "User not found"}
+        
+        await downgrade_user_to_suspended(
+            user_id=existing_user['id'],
+            reason=f'Evento: {payload.event_type}'
+        )
+        await log_webhook_event(payload.event_type, payload_dict, 'success')
+        return {"status": "success", "message": "User suspended"}
+    
+    else:
+        return {"status": "ignored", "message": f"Unknown event: {payload.event_type}"}
+
+
 @webhook_router.post("/webhook/kiwify")
 async def kiwify_webhook(
     request: Request,
@@ -264,120 +545,30 @@ async def kiwify_webhook(
         
         logger.info(f"📩 Webhook recebido: {payload.event_type} - {payload.customer_email}")
         
-        # 1. Tentar buscar usuário existente
-        existing_user = await get_user_by_email(payload.customer_email)
-        
-        user_id = None
-        new_password = None
-        is_new_user = False
-        
-        if existing_user:
-            user_id = existing_user['id']
-            logger.info(f"👤 Usuário existente encontrado: {user_id}")
-        else:
-            # 2. Se não existe e for pagamento aprovado, criar conta!
-            if payload.event_type == 'order.paid':
-                try:
-                    new_user_data = await create_new_user(payload.customer_email, payload.customer_name)
-                    user_id = new_user_data['id']
-                    new_password = new_user_data['password']
-                    is_new_user = True
-                    logger.info(f"✨ Nova conta criada com sucesso: {user_id}")
-                except Exception as e:
-                    logger.error(f"Falha crítica ao criar usuário: {e}")
-                    raise HTTPException(status_code=500, detail="Failed to create user account")
-            else:
-                # Se for cancelamento/reembolso de user que não existe, ignora
-                logger.warning(f"⚠️ Evento {payload.event_type} para usuário inexistente ignorado.")
-                return {"status": "ignored", "message": "User not found"}
-        
-        # Processar evento
-        if payload.event_type == 'order.paid':
-            # PAGAMENTO APROVADO - UPGRADE
-            product_name_lower = payload.product_name.lower().strip()
-            plan_key = PLAN_NAME_MAP.get(product_name_lower)
-            
-            if not plan_key:
-                for name, key in PLAN_NAME_MAP.items():
-                    if name in product_name_lower:
-                        plan_key = key
-                        break
+        # Serializa entregas simultâneas do mesmo cliente (retries da Kiwify
+        # chegando juntos não podem criar a conta duas vezes)
+        async with customer_lock(payload.customer_email):
+            ledger_status = claim_kiwify_event(payload.order_id, payload.event_type)
             
-            if not plan_key:
-                plan_key = 'basico'
+            if ledger_status == 'done':
+                logger.info(f"🔁 Evento {payload.event_type} do pedido {payload.order_id} já processado - ignorando replay")
+                return {"status": "duplicate", "message": "Event already processed"}
             
-            # Atualiza ou Insere a cota (Upsert)
-            await upgrade_user_to_plan(
-                user_id=user_id,
-                plan=plan_key,
-                subscription_id=payload.subscription_id or payload.order_id,
-                order_id=payload.order_id
-            )
+            if ledger_status == 'in_progress':
+                # Outro processo está tratando este evento - a Kiwify tenta de novo depois
+                raise HTTPException(status_code=409, detail="Event already being processed")
             
-            # ENVIAR EMAIL
             try:
-                plan_config = PLAN_LIMITS.get(plan_key, {})
-                email_service = get_email_service()
-                
-                # Montar lista de features do plano
-                features = []
-                if plan_config.get('leads_limit') == -1:
-                    features.append("Buscas de leads ilimitadas")
-                if plan_config.get('campaigns_limit', 0) == -1:
-                    features.append("Disparador WhatsApp ilimitado")
-                if plan_key == 'avancado':
-                    features.append("Agente IA para atendimento automático")
-                    features.append("Múltiplas instâncias WhatsApp")
-                
-                # URL de login (usar variável de ambiente ou padrão)
-                login_url = os.environ.get('FRONTEND_URL', 'https://app.client4you.com.br') + '/login'
-                
-                if is_new_user and new_password:
-                    # NOVO USUÁRIO: Email especial com credenciais em destaque
-                    await email_service.send_welcome_with_credentials(
-                        user_email=payload.customer_email,
-                        user_name=payload.customer_name,
-                        temp_password=new_password,
-                        plan_name=plan_config.get('name', plan_key),
-                        plan_features=features,
-                        order_id=payload.order_id,
-                        login_url=login_url
-                    )
-                    logger.info(f"📧 Email de boas-vindas COM CREDENCIAIS enviado para {payload.customer_email}")
-                else:
-                    # USUÁRIO EXISTENTE: Email normal de upgrade
-                    await email_service.send_purchase_confirmation(
-                        user_email=payload.customer_email,
-                        user_name=payload.customer_name,
-                        plan_name=plan_config.get('name', plan_key),
-                        plan_features=features,
-                        order_id=payload.order_id
-                    )
-                    logger.info(f"📧 Email de upgrade enviado para {payload.customer_email}")
-                
-            except Exception as e:
-                logger.error(f"❌ Erro ao enviar email: {e}")
-            
-            await log_webhook_event(payload.event_type, payload_dict, 'success')
+                result = await process_kiwify_event(payload, payload_dict)
+            except Exception:
+                release_kiwify_event(payload.order_id, payload.event_type)
+                raise
             
-            return {
-                "status": "success",
-                "message": "User processed successfully",
-                "is_new_user": is_new_user
-            }
-        
-        elif payload.event_type in ['order.refunded', 'subscription.canceled']:
-            # REEMBOLSO/CANCELAMENTO - SUSPENDER CONTA
-            await downgrade_user_to_suspended(
-                user_id=user_id,
-                reason=f'Evento: {payload.event_type}'
-            )
-            await log_webhook_event(payload.event_type, payload_dict, 'success')
-            return {"status": "success", "message": "User suspended"}
-        
-        else:
-            return {"status": "ignored", "message": f"Unknown event: {payload.event_type}"}
+            complete_kiwify_event(payload.order_id, payload.event_type, result.get('status'))
+            return result
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Erro no webhook: {e}")
         await log_webhook_event('error', {}, 'failed', str(e))
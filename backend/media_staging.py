@@ -0,0 +1,280 @@
+"""
+Media Staging
+Baixa a mídia de campanhas de imagem/documento uma única vez no início da
+campanha e reaproveita a cópia para todos os destinatários.
+
+- URL validada (SSRF) em cada salto de redirect
+- Download em streaming com limite de tamanho
+- Cópia cacheada por hash do conteúdo (campanhas com a mesma mídia dividem
+  a mesma cópia) e enviada ao WAHA como base64, sem o WAHA baixar a URL
+  de novo a cada envio
+- Com o staging desligado, probe() faz um GET parcial (Range) por URL e
+  descobre mimetype (pelo conteúdo, via libmagic) e tamanho antes dos envios
+"""
+import os
+import base64
+import asyncio
+import hashlib
+import logging
+import mimetypes
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urljoin, urlparse
+import httpx
+from cachetools import LRUCache, TTLCache
+from security_utils import validate_media_url
+
+try:
+    import magic
+except ImportError:  # libmagic ausente no sistema - cai para header/extensão
+    magic = None
+
+logger = logging.getLogger(__name__)
+
+
+class MediaStagingError(Exception):
+    """Mídia inválida/inacessível para a campanha"""
+
+    def __init__(self, message: str, fatal: bool = True):
+        super().__init__(message)
+        # fatal=False: falha transitória (rede) - dá para seguir enviando pela URL
+        self.fatal = fatal
+
+
+def sniff_mimetype(head: bytes, content_type: Optional[str], url: str) -> str:
+    """
+    Detecta o mimetype da mídia: conteúdo (libmagic) > Content-Type > extensão.
+
+    A extensão da URL é o último recurso - URLs de CDN com query string ou
+    sem extensão não dizem nada sobre o arquivo.
+    """
+    if magic is not None and head:
+        try:
+            detected = magic.from_buffer(head, mime=True)
+            if detected and detected != 'application/octet-stream':
+                return detected
+        except Exception as e:
+            logger.debug(f"libmagic falhou para {url}: {e}")
+
+    declared = (content_type or '').split(';', 1)[0].strip().lower()
+    if declared and declared != 'application/octet-stream':
+        return declared
+
+    return mimetypes.guess_type(urlparse(url).path)[0] or 'application/octet-stream'
+
+
+class MediaProbe:
+    """Mimetype/tamanho de uma URL de mídia (sem baixar o arquivo)"""
+
+    def __init__(self, url: str, mimetype: str, size: Optional[int]):
+        self.url = url
+        self.mimetype = mimetype
+        self.size = size
+
+
+class StagedMedia:
+    """Mídia baixada e pronta para reenvio"""
+
+    def __init__(self, url: str, content: bytes, mimetype: str, filename: Optional[str]):
+        self.url = url
+        self.sha256 = hashlib.sha256(content).hexdigest()
+        self.size = len(content)
+        self.mimetype = mimetype
+        self.filename = filename
+        self.data_base64 = base64.b64encode(content).decode('ascii')
+
+
+class MediaStager:
+    """Download único + cache por hash de conteúdo"""
+
+    MAX_REDIRECTS = 3
+    SNIFF_BYTES = 2048  # suficiente para as assinaturas do libmagic
+
+    def __init__(self):
+        self.enabled = os.getenv('MEDIA_STAGING_ENABLED', 'true').lower() == 'true'
+        self.max_bytes = int(os.getenv('MEDIA_MAX_BYTES', str(16 * 1024 * 1024)))  # limite de imagem do WhatsApp
+        self.timeout = float(os.getenv('MEDIA_DOWNLOAD_TIMEOUT', '30'))
+        cache_bytes = int(os.getenv('MEDIA_STAGING_CACHE_BYTES', str(256 * 1024 * 1024)))
+
+        # hash -> StagedMedia (limitado pelo tamanho total em memória)
+        self._by_hash: LRUCache = LRUCache(maxsize=cache_bytes, getsizeof=lambda m: len(m.data_base64))
+        # url -> hash (a mesma URL pode mudar de conteúdo, então expira)
+        self._by_url: TTLCache = TTLCache(maxsize=1024, ttl=float(os.getenv('MEDIA_STAGING_URL_TTL', '3600')))
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # url -> MediaProbe (modo URL: WAHA baixa a mídia, só precisamos dos metadados)
+        self._probes: TTLCache = TTLCache(maxsize=1024, ttl=float(os.getenv('MEDIA_STAGING_URL_TTL', '3600')))
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout, follow_redirects=False)
+        return self._client
+
+    def get_cached(self, url: str) -> Optional[StagedMedia]:
+        content_hash = self._by_url.get(url)
+        return self._by_hash.get(content_hash) if content_hash else None
+
+    async def stage(self, url: str, filename: Optional[str] = None, oversize_fatal: bool = True) -> StagedMedia:
+        """
+        Baixa e valida a mídia (ou devolve a cópia já em cache).
+
+        Args:
+            oversize_fatal: False para documentos - acima de MEDIA_MAX_BYTES o erro
+                sai com fatal=False e a campanha segue enviando pela URL
+
+        Raises:
+            MediaStagingError: URL bloqueada, mídia grande demais ou download falhou
+        """
+        staged = self.get_cached(url)
+        if staged:
+            return staged
+
+        # Campanhas iniciando juntas com a mesma URL baixam uma vez só
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        try:
+            async with lock:
+                staged = self.get_cached(url)
+                if staged:
+                    return staged
+
+                content, content_type = await self._download(url, oversize_fatal)
+                mimetype = sniff_mimetype(content[:self.SNIFF_BYTES], content_type, url)
+
+                staged = StagedMedia(url, content, mimetype, filename)
+                existing = self._by_hash.get(staged.sha256)
+                if existing:
+                    staged = existing
+                else:
+                    try:
+                        self._by_hash[staged.sha256] = staged
+                    except ValueError:
+                        # Maior que o cache inteiro - usa sem guardar
+                        pass
+                self._by_url[url] = staged.sha256
+
+                logger.info(f"📦 Mídia preparada: {url} ({staged.mimetype}, {staged.size} bytes, sha256={staged.sha256[:12]})")
+                return staged
+        finally:
+            self._release_lock(url, lock)
+
+    async def probe(self, url: str, enforce_limit: bool = False) -> MediaProbe:
+        """
+        Descobre mimetype e tamanho com um GET parcial (Range), uma vez por URL.
+
+        Args:
+            enforce_limit: True para imagens - acima de MEDIA_MAX_BYTES (limite do
+                WhatsApp) o erro é fatal antes do primeiro envio. Documentos não
+                têm esse limite no modo URL (o WAHA baixa a mídia)
+
+        Raises:
+            MediaStagingError: URL bloqueada, imagem grande demais ou requisição falhou
+        """
+        probe = self._probes.get(url) or await self._fetch_probe(url)
+        if enforce_limit and probe.size is not None and probe.size > self.max_bytes:
+            raise self._too_large()
+        return probe
+
+    async def _fetch_probe(self, url: str) -> MediaProbe:
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        try:
+            async with lock:
+                probe = self._probes.get(url)
+                if probe:
+                    return probe
+
+                headers = {'Range': f'bytes=0-{self.SNIFF_BYTES - 1}'}
+                async with self._open(url, headers=headers) as response:
+                    size = self._total_size(response)
+
+                    head = b''
+                    async for chunk in response.aiter_bytes():
+                        head += chunk
+                        if len(head) >= self.SNIFF_BYTES:
+                            break  # servidor ignorou o Range - não baixa o resto
+                    content_type = response.headers.get('content-type')
+
+                probe = MediaProbe(url, sniff_mimetype(head[:self.SNIFF_BYTES], content_type, url), size)
+                self._probes[url] = probe
+
+                logger.info(f"🔎 Mídia verificada: {url} ({probe.mimetype}, {probe.size if probe.size is not None else '?'} bytes)")
+                return probe
+        finally:
+            self._release_lock(url, lock)
+
+    async def _download(self, url: str, oversize_fatal: bool = True):
+        async with self._open(url) as response:
+            declared = self._total_size(response)
+            if declared is not None and declared > self.max_bytes:
+                raise self._too_large(oversize_fatal)
+
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise self._too_large(oversize_fatal)
+                chunks.append(chunk)
+
+            return b''.join(chunks), response.headers.get('content-type')
+
+    @asynccontextmanager
+    async def _open(self, url: str, headers: Optional[Dict[str, str]] = None) -> AsyncIterator[httpx.Response]:
+        """GET em streaming, validando (SSRF) cada salto de redirect"""
+        current = url
+        for _ in range(self.MAX_REDIRECTS + 1):
+            is_valid, error = await validate_media_url(current)
+            if not is_valid:
+                raise MediaStagingError(error)
+
+            try:
+                async with self._get_client().stream('GET', current, headers=headers) as response:
+                    if response.is_redirect:
+                        current = urljoin(current, response.headers.get('location', ''))
+                        continue
+
+                    if response.status_code not in (200, 206):
+                        raise MediaStagingError(
+                            f"Download da mídia falhou: HTTP {response.status_code}",
+                            fatal=response.status_code in (401, 403, 404, 410)
+                        )
+
+                    yield response
+                    return
+            except httpx.HTTPError as e:
+                raise MediaStagingError(f"Download da mídia falhou: {e}", fatal=False) from e
+
+        raise MediaStagingError("Redirecionamentos demais ao baixar a mídia")
+
+    @staticmethod
+    def _total_size(response: httpx.Response) -> Optional[int]:
+        """Tamanho total do arquivo (Content-Range em respostas 206, Content-Length em 200)"""
+        if response.status_code == 206:
+            total = response.headers.get('content-range', '').rpartition('/')[2]
+            return int(total) if total.isdigit() else None
+        declared = response.headers.get('content-length')
+        return int(declared) if declared and declared.isdigit() else None
+
+    def _release_lock(self, url: str, lock: asyncio.Lock) -> None:
+        # Sempre remove (também em falha), senão URLs com erro acumulam locks
+        if self._locks.get(url) is lock:
+            del self._locks[url]
+
+    def _too_large(self, fatal: bool = True) -> MediaStagingError:
+        return MediaStagingError(f"Mídia excede o limite de {self.max_bytes // (1024 * 1024)}MB", fatal=fatal)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Singleton global
+_media_stager: Optional[MediaStager] = None
+
+
+def get_media_stager() -> MediaStager:
+    """Retorna instância singleton do MediaStager"""
+    global _media_stager
+    if _media_stager is None:
+        _media_stager = MediaStager()
+    return _media_stager
@@ -0,0 +1,269 @@
+"""
+Metrics
+Métricas em memória no formato de exposição do Prometheus (texto), servidas
+em /metrics sem depender de serviços externos ou bibliotecas extras.
+
+- Histogramas: latência das chamadas ao WAHA (por endpoint), das queries ao
+  Supabase (por tabela/método) e de cada iteração do loop de campanhas
+- Contadores: mensagens enviadas/com erro por causa, chamadas WAHA e queries
+  Supabase por resultado
+- Gauge: mensagens por segundo de cada campanha em execução
+
+As métricas são por processo: com vários workers do uvicorn, o Prometheus
+deve raspar cada processo (ou somar as séries).
+"""
+import re
+import time
+import bisect
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+import httpx
+
+# Buckets de latência (segundos) - de queries rápidas a envios de mídia lentos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """Base: série por combinação de labels, protegida por lock (hooks rodam em threads)"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: labels esperados {self.labelnames}, recebidos {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels_text(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(f'{extra[0]}="{extra[1]}"')
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def remove(self, **labels: str) -> None:
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key: Tuple[str, ...], value) -> List[str]:
+        return [f'{self.name}{self._labels_text(key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _HistogramSeries:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = _HistogramSeries(len(self.buckets) + 1)
+            series.counts[index] += 1
+            series.total += value
+            series.count += 1
+
+    def _render_series(self, key: Tuple[str, ...], series: _HistogramSeries) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), series.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{self._labels_text(key, ("le", _format_value(bound)))} {cumulative}')
+        lines.append(f'{self.name}_sum{self._labels_text(key)} {_format_value(series.total)}')
+        lines.append(f'{self.name}_count{self._labels_text(key)} {series.count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+WAHA_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'waha_request_duration_seconds', 'Latência das chamadas ao WAHA', ['endpoint']
+))
+WAHA_REQUESTS = REGISTRY.register(Counter(
+    'waha_requests_total', 'Chamadas ao WAHA por resultado', ['endpoint', 'outcome']
+))
+SUPABASE_QUERY_SECONDS = REGISTRY.register(Histogram(
+    'supabase_query_duration_seconds', 'Latência das queries ao Supabase (PostgREST)', ['table', 'method']
+))
+SUPABASE_QUERIES = REGISTRY.register(Counter(
+    'supabase_queries_total', 'Queries ao Supabase por resultado', ['table', 'method', 'outcome']
+))
+CAMPAIGN_ITERATION_SECONDS = REGISTRY.register(Histogram(
+    'campaign_loop_iteration_seconds', 'Duração de uma iteração do worker de campanha (sem o intervalo entre envios)',
+    ['message_type']
+))
+CAMPAIGN_MESSAGES = REGISTRY.register(Counter(
+    'campaign_messages_total', 'Mensagens de campanha por resultado e causa', ['message_type', 'outcome', 'cause']
+))
+CAMPAIGN_MESSAGES_PER_SECOND = REGISTRY.register(Gauge(
+    'campaign_messages_per_second', 'Mensagens enviadas por segundo (desde o início do worker) por campanha em execução',
+    ['campaign_id']
+))
+
+
+def _outcome_for_exception(exc: BaseException) -> str:
+    if isinstance(exc, httpx.TimeoutException):
+        return 'timeout'
+    if isinstance(exc, httpx.TransportError):
+        return 'network'
+    return 'exception'
+
+
+class WahaCallTimer:
+    """
+    Mede uma chamada ao WAHA:
+
+        with WahaCallTimer('sendText') as call:
+            response = await client.post(...)
+            call.status = response.status_code
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.status: Optional[int] = None
+
+    def __enter__(self) -> 'WahaCallTimer':
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        WAHA_REQUEST_SECONDS.observe(time.perf_counter() - self._started, endpoint=self.endpoint)
+        if exc is not None:
+            outcome = _outcome_for_exception(exc)
+        elif self.status is not None:
+            outcome = f'{self.status // 100}xx'
+        else:
+            outcome = 'unknown'
+        WAHA_REQUESTS.inc(endpoint=self.endpoint, outcome=outcome)
+        return False
+
+
+_HTTP_STATUS = re.compile(r'HTTP (\d)\d\d')
+
+
+def classify_send_error(error: Optional[str]) -> str:
+    """Causa de uma falha de envio a partir da mensagem de erro do WahaService"""
+    if not error:
+        return 'unknown'
+    match = _HTTP_STATUS.search(error)
+    if match:
+        return f'http_{match.group(1)}xx'
+    lowered = error.lower()
+    if 'timeout' in lowered or 'timed out' in lowered:
+        return 'timeout'
+    if 'connect' in lowered or 'network' in lowered:
+        return 'network'
+    if 'provided' in lowered or 'unknown message type' in lowered:
+        return 'invalid'
+    return 'other'
+
+
+# ========== Supabase (PostgREST) via event hooks do httpx ==========
+
+_POSTGREST_METHODS = {'GET': 'select', 'HEAD': 'count', 'PATCH': 'update', 'DELETE': 'delete'}
+
+
+def _postgrest_labels(request: httpx.Request) -> Tuple[str, str]:
+    path = request.url.path.split('/rest/v1/', 1)[-1].strip('/')
+    if path.startswith('rpc/'):
+        return path[4:], 'rpc'
+    table = path.split('/', 1)[0] or 'unknown'
+    if request.method == 'POST':
+        prefer = request.headers.get('prefer', '')
+        return table, 'upsert' if 'resolution=' in prefer else 'insert'
+    return table, _POSTGREST_METHODS.get(request.method, request.method.lower())
+
+
+def _on_postgrest_request(request: httpx.Request) -> None:
+    request.extensions['metrics_started'] = time.perf_counter()
+
+
+def _on_postgrest_response(response: httpx.Response) -> None:
+    started = response.request.extensions.get('metrics_started')
+    if started is None:
+        return
+    table, method = _postgrest_labels(response.request)
+    SUPABASE_QUERY_SECONDS.observe(time.perf_counter() - started, table=table, method=method)
+    SUPABASE_QUERIES.inc(table=table, method=method, outcome=f'{response.status_code // 100}xx')
+
+
+def instrument_postgrest_session(session: httpx.Client) -> None:
+    """Adiciona os hooks de latência à sessão httpx do PostgREST (idempotente)"""
+    hooks = session.event_hooks
+    if _on_postgrest_request in hooks['request']:
+        return
+    session.event_hooks = {
+        'request': [*hooks['request'], _on_postgrest_request],
+        'response': [*hooks['response'], _on_postgrest_response],
+    }
@@ -0,0 +1,49 @@
+-- =====================================================
+-- Client4You - Migration para criação atômica de campanhas
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Cria a campanha e todos os contatos em uma única transação
+-- (uma única chamada RPC em vez de insert + N batches + update + select).
+-- Se qualquer contato falhar, nada é gravado.
+CREATE OR REPLACE FUNCTION public.create_campaign_with_contacts(
+    p_campaign jsonb,
+    p_contacts jsonb
+)
+RETURNS SETOF public.campaigns
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    v_campaign public.campaigns;
+    v_count integer := jsonb_array_length(coalesce(p_contacts, '[]'::jsonb));
+BEGIN
+    INSERT INTO public.campaigns (
+        id, company_id, user_id, name, status,
+        message_type, message_text, media_url, media_filename,
+        interval_min, interval_max, start_time, end_time, daily_limit, working_days,
+        total_contacts, sent_count, error_count, pending_count
+    )
+    SELECT
+        coalesce(r.id, gen_random_uuid()), r.company_id, r.user_id, r.name, coalesce(r.status, 'draft'),
+        r.message_type, r.message_text, r.media_url, r.media_filename,
+        r.interval_min, r.interval_max, r.start_time, r.end_time, r.daily_limit, r.working_days,
+        v_count, 0, 0, v_count
+    FROM jsonb_populate_record(NULL::public.campaigns, p_campaign) r
+    RETURNING * INTO v_campaign;
+
+    IF v_count > 0 THEN
+        INSERT INTO public.campaign_contacts (campaign_id, name, phone, category, extra_data, status)
+        SELECT v_campaign.id, c.name, c.phone, c.category, coalesce(c.extra_data, '{}'::jsonb), 'pending'
+        FROM jsonb_populate_recordset(NULL::public.campaign_contacts, p_contacts) c;
+    END IF;
+
+    RETURN NEXT v_campaign;
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.create_campaign_with_contacts(jsonb, jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.create_campaign_with_contacts(jsonb, jsonb) TO service_role;
+
+COMMENT ON FUNCTION public.create_campaign_with_contacts(jsonb, jsonb) IS 'Cria campanha + contatos atomicamente e retorna a linha final da campanha';
@@ -0,0 +1,18 @@
+-- =====================================================
+-- Client4You - Migration para spill durável da fila de webhooks WAHA
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Eventos que não couberam na fila em memória (ou que estavam pendentes
+-- no shutdown) ficam aqui até o próximo startup do backend.
+-- Só é usada com WAHA_QUEUE_SPILL=true.
+CREATE TABLE IF NOT EXISTS public.waha_webhook_spill (
+    id bigserial PRIMARY KEY,
+    session text,
+    payload jsonb NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE public.waha_webhook_spill ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE public.waha_webhook_spill IS 'Webhooks WAHA pendentes (overflow/shutdown) para reprocessamento';
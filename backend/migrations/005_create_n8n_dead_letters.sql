@@ -0,0 +1,24 @@
+-- =====================================================
+-- Client4You - Migration para dead-letter do agente IA (n8n)
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Mensagens que o n8n não aceitou após todos os retries (ou com o
+-- circuito da empresa aberto). Guarda o evento WAHA original, sem
+-- credenciais, para reprocessamento manual.
+CREATE TABLE IF NOT EXISTS public.n8n_dead_letters (
+    id bigserial PRIMARY KEY,
+    company_id uuid,
+    session text,
+    payload jsonb NOT NULL,
+    error_message text,
+    attempts integer NOT NULL DEFAULT 0,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_n8n_dead_letters_company_created
+    ON public.n8n_dead_letters (company_id, created_at DESC);
+
+ALTER TABLE public.n8n_dead_letters ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE public.n8n_dead_letters IS 'Mensagens do agente IA que falharam ao chegar no n8n';
@@ -0,0 +1,29 @@
+-- =====================================================
+-- Client4You - Migration para outbox de emails
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Emails transacionais enfileirados (conclusão de campanha, boas-vindas,
+-- confirmação de compra). O backend grava a linha, responde na hora e um
+-- worker em background envia com retry. Linhas enviadas são removidas;
+-- linhas 'pending' são retomadas no próximo startup.
+CREATE TABLE IF NOT EXISTS public.email_outbox (
+    id bigserial PRIMARY KEY,
+    kind text NOT NULL,
+    to_email text,
+    payload jsonb NOT NULL,
+    status text NOT NULL DEFAULT 'pending',  -- pending | sending | failed
+    attempts integer NOT NULL DEFAULT 0,
+    last_error text,
+    next_attempt_at timestamptz NOT NULL DEFAULT now(),
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_status
+    ON public.email_outbox (status, next_attempt_at);
+
+-- O payload pode conter senha temporária: acesso apenas via service role
+ALTER TABLE public.email_outbox ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE public.email_outbox IS 'Fila durável de emails transacionais enviados em background';
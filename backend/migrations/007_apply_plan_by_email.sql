@@ -0,0 +1,57 @@
+-- =====================================================
+-- Client4You - Migration para aplicar plano Kiwify por email
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Busca o usuário pelo email e faz upsert da cota em uma única chamada RPC
+-- (antes: select em profiles + upsert em user_quotas, cada um em um round-trip).
+-- Retorna o user_id, ou NULL se não existir perfil com esse email - nesse caso
+-- o backend cria a conta via Auth Admin API e aplica a cota pelo user_id.
+CREATE OR REPLACE FUNCTION public.apply_plan_by_email(
+    p_email text,
+    p_quota jsonb
+)
+RETURNS uuid
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    v_user_id uuid;
+BEGIN
+    SELECT p.id INTO v_user_id
+    FROM public.profiles p
+    WHERE p.email = p_email
+    LIMIT 1;
+
+    IF v_user_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO public.user_quotas (
+        user_id, plan_type, plan_name, leads_limit, campaigns_limit, messages_limit,
+        plan_expires_at, subscription_id, order_id, updated_at
+    )
+    SELECT
+        v_user_id, q.plan_type, q.plan_name, q.leads_limit, q.campaigns_limit, q.messages_limit,
+        q.plan_expires_at, q.subscription_id, q.order_id, coalesce(q.updated_at, now())
+    FROM jsonb_populate_record(NULL::public.user_quotas, p_quota) q
+    ON CONFLICT (user_id) DO UPDATE SET
+        plan_type = EXCLUDED.plan_type,
+        plan_name = EXCLUDED.plan_name,
+        leads_limit = EXCLUDED.leads_limit,
+        campaigns_limit = EXCLUDED.campaigns_limit,
+        messages_limit = EXCLUDED.messages_limit,
+        plan_expires_at = EXCLUDED.plan_expires_at,
+        subscription_id = EXCLUDED.subscription_id,
+        order_id = EXCLUDED.order_id,
+        updated_at = EXCLUDED.updated_at;
+
+    RETURN v_user_id;
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.apply_plan_by_email(text, jsonb) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.apply_plan_by_email(text, jsonb) TO service_role;
+
+COMMENT ON FUNCTION public.apply_plan_by_email(text, jsonb) IS 'Busca usuário por email e aplica a cota do plano (upsert) em uma transação';
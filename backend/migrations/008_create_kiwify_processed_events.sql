@@ -0,0 +1,21 @@
+-- =====================================================
+-- Client4You - Migration para idempotência do webhook Kiwify
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- A Kiwify reenvia webhooks. Cada (order_id, event_type) é registrado aqui
+-- antes do processamento; replays de eventos 'done' são ignorados com uma
+-- única busca pela chave primária.
+CREATE TABLE IF NOT EXISTS public.kiwify_processed_events (
+    order_id text NOT NULL,
+    event_type text NOT NULL,
+    status text NOT NULL DEFAULT 'processing',  -- processing | done
+    result_status text,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (order_id, event_type)
+);
+
+ALTER TABLE public.kiwify_processed_events ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE public.kiwify_processed_events IS 'Ledger de idempotência dos webhooks Kiwify (order_id, event_type)';
@@ -0,0 +1,124 @@
+-- =====================================================
+-- Client4You - Migration para estatísticas agregadas de auditoria
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Rollup diário de audit_logs por (dia, ação, usuário), mantido por triggers
+-- de statement (um UPDATE por lote inserido, não por linha). O dashboard de
+-- auditoria lê só esta tabela em vez de varrer audit_logs inteira.
+CREATE TABLE IF NOT EXISTS public.audit_log_daily (
+    day date NOT NULL,
+    action text NOT NULL,
+    user_email text NOT NULL DEFAULT '',
+    count bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, action, user_email)
+);
+
+ALTER TABLE public.audit_log_daily ENABLE ROW LEVEL SECURITY;
+
+CREATE OR REPLACE FUNCTION public.audit_log_daily_on_insert()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    INSERT INTO public.audit_log_daily (day, action, user_email, count)
+    SELECT (n.created_at AT TIME ZONE 'UTC')::date, n.action, coalesce(n.user_email, ''), count(*)
+    FROM new_rows n
+    GROUP BY 1, 2, 3
+    ON CONFLICT (day, action, user_email)
+    DO UPDATE SET count = public.audit_log_daily.count + EXCLUDED.count;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.audit_log_daily_on_delete()
+RETURNS trigger
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    UPDATE public.audit_log_daily r
+    SET count = greatest(r.count - o.cnt, 0)
+    FROM (
+        SELECT (created_at AT TIME ZONE 'UTC')::date AS day, action, coalesce(user_email, '') AS user_email, count(*) AS cnt
+        FROM old_rows
+        GROUP BY 1, 2, 3
+    ) o
+    WHERE r.day = o.day AND r.action = o.action AND r.user_email = o.user_email;
+
+    DELETE FROM public.audit_log_daily WHERE count = 0;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trigger_audit_log_daily_insert ON public.audit_logs;
+CREATE TRIGGER trigger_audit_log_daily_insert
+    AFTER INSERT ON public.audit_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION public.audit_log_daily_on_insert();
+
+DROP TRIGGER IF EXISTS trigger_audit_log_daily_delete ON public.audit_logs;
+CREATE TRIGGER trigger_audit_log_daily_delete
+    AFTER DELETE ON public.audit_logs
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION public.audit_log_daily_on_delete();
+
+-- Backfill (uma única varredura de audit_logs)
+TRUNCATE public.audit_log_daily;
+INSERT INTO public.audit_log_daily (day, action, user_email, count)
+SELECT (created_at AT TIME ZONE 'UTC')::date, action, coalesce(user_email, ''), count(*)
+FROM public.audit_logs
+GROUP BY 1, 2, 3;
+
+-- Totais + top N ações/usuários em uma única chamada
+CREATE OR REPLACE FUNCTION public.get_audit_stats(p_top integer DEFAULT 5)
+RETURNS jsonb
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+    SELECT jsonb_build_object(
+        'total_logs', coalesce((SELECT sum(count) FROM public.audit_log_daily), 0),
+        'logs_today', coalesce((
+            SELECT sum(count) FROM public.audit_log_daily
+            WHERE day = (now() AT TIME ZONE 'UTC')::date
+        ), 0),
+        'logs_this_week', coalesce((
+            SELECT sum(count) FROM public.audit_log_daily
+            WHERE day > (now() AT TIME ZONE 'UTC')::date - 7
+        ), 0),
+        'top_actions', coalesce((
+            SELECT jsonb_agg(jsonb_build_object('action', action, 'count', total) ORDER BY total DESC)
+            FROM (
+                SELECT action, sum(count) AS total
+                FROM public.audit_log_daily
+                GROUP BY action
+                ORDER BY total DESC
+                LIMIT p_top
+            ) a
+        ), '[]'::jsonb),
+        'top_users', coalesce((
+            SELECT jsonb_agg(jsonb_build_object('user_email', user_email, 'count', total) ORDER BY total DESC)
+            FROM (
+                SELECT user_email, sum(count) AS total
+                FROM public.audit_log_daily
+                WHERE user_email <> ''
+                GROUP BY user_email
+                ORDER BY total DESC
+                LIMIT p_top
+            ) u
+        ), '[]'::jsonb)
+    );
+$$;
+
+REVOKE ALL ON FUNCTION public.get_audit_stats(integer) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.get_audit_stats(integer) TO service_role;
+
+COMMENT ON TABLE public.audit_log_daily IS 'Contagem diária de audit_logs por ação/usuário (mantida por trigger)';
+COMMENT ON FUNCTION public.get_audit_stats(integer) IS 'Estatísticas de auditoria (totais + top N) a partir do rollup diário';
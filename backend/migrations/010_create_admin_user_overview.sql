@@ -0,0 +1,35 @@
+-- =====================================================
+-- Client4You - Migration para listagem de usuários do admin
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Perfil + cota + roles de cada usuário em uma única linha, para o painel
+-- admin buscar uma página inteira em um único SELECT (antes: 1 query de
+-- quota por perfil).
+CREATE OR REPLACE VIEW public.admin_user_overview
+WITH (security_invoker = true) AS
+SELECT
+    p.id,
+    p.email,
+    p.full_name,
+    p.company_id,
+    p.created_at,
+    q.plan_type,
+    q.plan_name,
+    q.subscription_status,
+    q.plan_expires_at,
+    coalesce(
+        (SELECT array_agg(DISTINCT r.role::text) FROM public.user_roles r WHERE r.user_id = p.id),
+        '{}'::text[]
+    ) AS roles
+FROM public.profiles p
+LEFT JOIN public.user_quotas q ON q.user_id = p.id;
+
+REVOKE ALL ON public.admin_user_overview FROM PUBLIC, anon, authenticated;
+GRANT SELECT ON public.admin_user_overview TO service_role;
+
+-- Paginação por cursor (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_profiles_created_at_id
+    ON public.profiles (created_at DESC, id DESC);
+
+COMMENT ON VIEW public.admin_user_overview IS 'Usuários com plano e roles (painel super admin)';
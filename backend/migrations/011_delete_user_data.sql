@@ -0,0 +1,60 @@
+-- =====================================================
+-- Client4You - Migration para deleção em cascata de usuários
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- Remove todos os dados de um usuário (exceto auth.users, que é removido pela
+-- Auth Admin API) em uma única transação e com deletes set-based, em vez de
+-- dois deletes por campanha feitos pelo backend.
+-- Tabelas/colunas que não existirem nesta instalação são ignoradas.
+-- Retorna a quantidade de linhas removidas por tabela.
+CREATE OR REPLACE FUNCTION public.delete_user_data(p_user_id uuid)
+RETURNS jsonb
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    v_result jsonb := '{}'::jsonb;
+    v_count bigint;
+    v_table text;
+BEGIN
+    -- Contatos e logs de todas as campanhas do usuário de uma vez
+    BEGIN
+        DELETE FROM public.campaign_contacts
+        WHERE campaign_id IN (SELECT id FROM public.campaigns WHERE user_id = p_user_id);
+        GET DIAGNOSTICS v_count = ROW_COUNT;
+        v_result := v_result || jsonb_build_object('campaign_contacts', v_count);
+    EXCEPTION WHEN undefined_table OR undefined_column THEN NULL;
+    END;
+
+    BEGIN
+        DELETE FROM public.message_logs
+        WHERE campaign_id IN (SELECT id FROM public.campaigns WHERE user_id = p_user_id);
+        GET DIAGNOSTICS v_count = ROW_COUNT;
+        v_result := v_result || jsonb_build_object('message_logs', v_count);
+    EXCEPTION WHEN undefined_table OR undefined_column THEN NULL;
+    END;
+
+    FOREACH v_table IN ARRAY ARRAY['campaigns', 'leads', 'search_history', 'notifications', 'user_quotas', 'user_roles']
+    LOOP
+        BEGIN
+            EXECUTE format('DELETE FROM public.%I WHERE user_id = $1', v_table) USING p_user_id;
+            GET DIAGNOSTICS v_count = ROW_COUNT;
+            v_result := v_result || jsonb_build_object(v_table, v_count);
+        EXCEPTION WHEN undefined_table OR undefined_column THEN NULL;
+        END;
+    END LOOP;
+
+    DELETE FROM public.profiles WHERE id = p_user_id;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    v_result := v_result || jsonb_build_object('profiles', v_count);
+
+    RETURN v_result;
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.delete_user_data(uuid) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.delete_user_data(uuid) TO service_role;
+
+COMMENT ON FUNCTION public.delete_user_data(uuid) IS 'Remove em cascata (set-based) todos os dados de um usuário, exceto auth.users';
@@ -0,0 +1,14 @@
+-- =====================================================
+-- Client4You - Migration para remover segredos da outbox de emails
+-- Execute este SQL no Supabase SQL Editor
+-- =====================================================
+
+-- O backend não grava mais a senha temporária em email_outbox.payload
+-- (fica só em memória até o envio). Remove as senhas já gravadas; linhas
+-- pendentes de boas-vindas ficam 'failed', pois não podem mais ser enviadas.
+UPDATE public.email_outbox
+SET status = 'failed',
+    last_error = coalesce(last_error, 'Campos sensíveis removidos; reenviar manualmente'),
+    payload = payload - 'temp_password',
+    updated_at = now()
+WHERE payload ? 'temp_password';
@@ -0,0 +1,225 @@
+"""
+n8n Forwarder
+Encaminha mensagens do agente IA para o webhook do n8n.
+
+- Um único httpx.AsyncClient com keep-alive (pool de conexões)
+- Limite de requisições simultâneas ao n8n
+- Retry com backoff exponencial + jitter em 5xx e falhas de conexão; timeout
+  de leitura não é repetido (o n8n pode já ter executado o workflow)
+- Cada envio leva uma chave de idempotência (header Idempotency-Key e campo
+  'idempotency_key' no payload, derivada dos ids das mensagens WAHA): o
+  workflow do n8n deve descartar chaves já processadas, pois um retry após
+  5xx pode repetir uma execução que chegou a responder o cliente
+- Circuit breaker por empresa: um workflow lento não trava os outros tenants
+- Mensagens que esgotam as tentativas vão para a tabela 'n8n_dead_letters'
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
+import httpx
+from supabase_service import get_supabase_service
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTER_TABLE = 'n8n_dead_letters'
+
+
+class CircuitBreaker:
+    """Circuit breaker simples (closed -> open -> half-open)"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # Half-open: deixa passar uma tentativa depois do reset_timeout
+        if time.monotonic() - self.opened_at >= self.reset_timeout and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """Libera a tentativa half-open que terminou sem resultado (cancelada/erro inesperado)"""
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+
+class N8nForwarder:
+    """Cliente compartilhado para o webhook do n8n"""
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self):
+        self.timeout = float(os.getenv('N8N_TIMEOUT', '10'))
+        self.max_retries = int(os.getenv('N8N_MAX_RETRIES', '3'))
+        self.backoff_base = float(os.getenv('N8N_RETRY_BACKOFF', '0.5'))
+        self.backoff_max = float(os.getenv('N8N_RETRY_BACKOFF_MAX', '8'))
+        self.max_concurrency = int(os.getenv('N8N_MAX_CONCURRENCY', '20'))
+        self.breaker_threshold = int(os.getenv('N8N_BREAKER_THRESHOLD', '5'))
+        self.breaker_reset = float(os.getenv('N8N_BREAKER_RESET', '60'))
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                    keepalive_expiry=60
+                )
+            )
+        return self._client
+
+    def _breaker(self, company_id: str) -> CircuitBreaker:
+        breaker = self._breakers.get(company_id)
+        if breaker is None:
+            breaker = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            self._breakers[company_id] = breaker
+        return breaker
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: espalha os retries de vários tenants no tempo
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def forward(
+        self,
+        url: str,
+        company_id: str,
+        n8n_payload: Dict[str, Any],
+        source_event: Dict[str, Any],
+        idempotency_key: Optional[str] = None
+    ) -> bool:
+        """
+        Envia o payload ao n8n com retry.
+
+        Args:
+            url: URL do webhook do n8n
+            company_id: Empresa (chave do circuit breaker)
+            n8n_payload: Payload montado para o workflow
+            source_event: Evento WAHA original (vai para a dead-letter, sem credenciais)
+            idempotency_key: Igual em todas as tentativas - o n8n deduplica por ela
+
+        Returns:
+            True se o n8n aceitou a mensagem
+        """
+        breaker = self._breaker(company_id)
+        if not breaker.allow():
+            logger.warning(f"⚡ Circuito do n8n aberto para empresa {company_id} - mensagem enviada para dead-letter")
+            await self._dead_letter(company_id, source_event, 'circuit_open', 0)
+            return False
+        # Com o circuito aberto, allow() só deixa passar o trial half-open
+        holds_trial = breaker.opened_at is not None
+
+        headers = {}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+            n8n_payload = {**n8n_payload, 'idempotency_key': idempotency_key}
+
+        try:
+            last_error = None
+            attempt = 0
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with self._semaphore:
+                        response = await self._get_client().post(url, json=n8n_payload, headers=headers)
+
+                    if response.status_code in [200, 201, 204]:
+                        breaker.record_success()
+                        return True
+
+                    last_error = f"HTTP {response.status_code}"
+                    if response.status_code not in self.RETRYABLE_STATUS:
+                        # Erro do workflow (4xx) - não adianta repetir
+                        break
+                except (httpx.ConnectTimeout, httpx.PoolTimeout):
+                    # A requisição não chegou ao n8n - seguro repetir
+                    last_error = "timeout"
+                except httpx.TimeoutException:
+                    # Leitura/escrita: o workflow pode já ter rodado - não repete
+                    last_error = "timeout"
+                    break
+                except httpx.HTTPError as e:
+                    last_error = str(e) or e.__class__.__name__
+
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self._backoff(attempt))
+
+            breaker.record_failure()
+            logger.warning(f"⚠️ n8n falhou para empresa {company_id} após {attempt + 1} tentativas: {last_error}")
+            await self._dead_letter(company_id, source_event, last_error, attempt + 1)
+            return False
+        finally:
+            # Sem isso um trial cancelado (shutdown) deixaria o circuito aberto para sempre
+            if holds_trial:
+                breaker.release_trial()
+
+    async def _dead_letter(self, company_id: str, source_event: Dict[str, Any], error: Optional[str], attempts: int) -> None:
+        try:
+            db = get_supabase_service()
+            db.client.table(DEAD_LETTER_TABLE).insert({
+                'company_id': company_id,
+                'session': source_event.get('session'),
+                'payload': source_event,
+                'error_message': error,
+                'attempts': attempts,
+                'created_at': datetime.utcnow().isoformat()
+            }, returning='minimal').execute()
+        except Exception as e:
+            logger.error(f"❌ Erro ao gravar dead-letter do n8n: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'breakers': {
+                company_id: breaker.state
+                for company_id, breaker in self._breakers.items()
+                if breaker.state != 'closed'
+            }
+        }
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Singleton global
+_n8n_forwarder: Optional[N8nForwarder] = None
+
+
+def get_n8n_forwarder() -> N8nForwarder:
+    """Retorna instância singleton do N8nForwarder"""
+    global _n8n_forwarder
+    if _n8n_forwarder is None:
+        _n8n_forwarder = N8nForwarder()
+    return _n8n_forwarder
@@ -0,0 +1,272 @@
+"""
+Profiling
+Modo de profiling opt-in para achar hotspots de CPU em produção sem redeploy
+(ex.: replace_variables, sanitize_template_value, import do pandas, JWT).
+
+- Ativado por PROFILING_ENABLED=true ou em runtime via /api/admin/profiling
+- Perfila rotas selecionadas (PROFILING_ROUTES, prefixos separados por vírgula;
+  vazio = todas) e as iterações de envio do worker de campanhas
+- Amostragem: 1 a cada PROFILING_SAMPLE_EVERY chamadas por chave, e só uma
+  amostra ativa por vez (as demais seguem sem profiling)
+- Engine: cProfile (padrão) ou yappi (PROFILING_ENGINE=yappi, se instalado)
+- Estatísticas agregadas por rota/campanha e gravadas em formato pstats
+  (PROFILING_DIR/<chave>.prof), abríveis com pstats/snakeviz
+- No máximo PROFILING_MAX_KEYS chaves (cada campanha é uma); as mais antigas
+  são descartadas
+
+O profiler é do processo inteiro: coroutines que rodarem no event loop
+durante uma amostra entram na conta dela.
+"""
+import io
+import os
+import re
+import time
+import cProfile
+import pstats
+import logging
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+try:
+    import yappi
+except ImportError:  # yappi é opcional
+    yappi = None
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENGINES = ('cprofile', 'yappi')
+
+
+class ProfileSample:
+    """Uma janela de profiling de uma rota/campanha"""
+
+    def __init__(self, key: str, engine: str):
+        self.key = key
+        self.engine = engine
+        self.started = time.perf_counter()
+        self._profile: Optional[cProfile.Profile] = None
+
+
+class Profiler:
+    """Profiling amostrado com estatísticas agregadas por chave"""
+
+    def __init__(self):
+        self.enabled = False
+        self.routes: List[str] = []
+        self.campaigns = True
+        self.sample_every = 10
+        self.engine = 'cprofile'
+        self.output_dir = os.getenv('PROFILING_DIR') or os.path.join(tempfile.gettempdir(), 'client4you-profiles')
+        self.max_keys = max(1, int(os.getenv('PROFILING_MAX_KEYS', '200')))
+
+        self._calls: Dict[str, int] = {}
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._samples: Dict[str, int] = {}
+        self._seconds: Dict[str, float] = {}
+        self._active = threading.Lock()
+
+        try:
+            self.configure(
+                enabled=os.getenv('PROFILING_ENABLED', 'false').lower() == 'true',
+                routes=os.getenv('PROFILING_ROUTES', ''),
+                campaigns=os.getenv('PROFILING_CAMPAIGNS', 'true').lower() == 'true',
+                sample_every=int(os.getenv('PROFILING_SAMPLE_EVERY', '10')),
+                engine=os.getenv('PROFILING_ENGINE', 'cprofile')
+            )
+        except ValueError as e:
+            logger.warning(f"⚠️ Configuração de profiling inválida ({e}), profiling desligado")
+            self.enabled = False
+
+    def configure(
+        self,
+        enabled: Optional[bool] = None,
+        routes: Optional[Any] = None,
+        campaigns: Optional[bool] = None,
+        sample_every: Optional[int] = None,
+        engine: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Altera a configuração em runtime.
+
+        Raises:
+            ValueError: engine desconhecida/indisponível ou amostragem < 1
+        """
+        if engine is not None:
+            engine = engine.lower()
+            if engine not in PROFILING_ENGINES:
+                raise ValueError(f"Engine inválida: {engine} (use {', '.join(PROFILING_ENGINES)})")
+            if engine == 'yappi' and yappi is None:
+                raise ValueError("yappi não está instalado")
+        if sample_every is not None and sample_every < 1:
+            raise ValueError("sample_every deve ser >= 1")
+
+        if routes is not None:
+            if isinstance(routes, str):
+                routes = routes.split(',')
+            self.routes = [route.strip() for route in routes if route.strip()]
+        if campaigns is not None:
+            self.campaigns = campaigns
+        if sample_every is not None:
+            self.sample_every = sample_every
+        if engine is not None:
+            self.engine = engine
+        if enabled is not None and enabled != self.enabled:
+            self.enabled = enabled
+            logger.info(f"🔬 Profiling {'ativado' if enabled else 'desativado'} ({self.engine}, 1/{self.sample_every})")
+        return self.settings()
+
+    def settings(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'routes': self.routes,
+            'campaigns': self.campaigns,
+            'sample_every': self.sample_every,
+            'engine': self.engine,
+            'output_dir': self.output_dir,
+            'max_keys': self.max_keys,
+            'yappi_available': yappi is not None,
+            'samples': dict(self._samples),
+        }
+
+    def wants_route(self, path: str) -> bool:
+        if not self.enabled:
+            return False
+        return not self.routes or any(path.startswith(prefix) for prefix in self.routes)
+
+    def begin(self, key: str) -> Optional[ProfileSample]:
+        """
+        Inicia uma amostra se for a vez desta chave e não houver outra ativa.
+        Retorna None quando a chamada não deve ser perfilada.
+        """
+        if not self.enabled:
+            return None
+
+        # Reinsere no fim: a ordem do dict vira a de uso e o mais antigo sai primeiro
+        calls = self._calls.pop(key, 0) + 1
+        self._calls[key] = calls
+        if len(self._calls) > self.max_keys:
+            del self._calls[next(iter(self._calls))]
+        if calls % self.sample_every:
+            return None
+        if not self._active.acquire(blocking=False):
+            return None
+
+        sample = ProfileSample(key, self.engine)
+        try:
+            if sample.engine == 'yappi':
+                yappi.clear_stats()
+                yappi.set_clock_type('cpu')
+                yappi.start()
+            else:
+                sample._profile = cProfile.Profile()
+                sample._profile.enable()
+        except Exception as e:
+            # Outro profiler ativo no processo (debugger, coverage...)
+            self._active.release()
+            logger.warning(f"⚠️ Não foi possível iniciar o profiling de {key}: {e}")
+            return None
+        return sample
+
+    def end(self, sample: Optional[ProfileSample]) -> None:
+        """Encerra a amostra e agrega as estatísticas na chave dela"""
+        if sample is None:
+            return
+        try:
+            if sample.engine == 'yappi':
+                yappi.stop()
+                with tempfile.NamedTemporaryFile(suffix='.prof') as tmp:
+                    yappi.get_func_stats().save(tmp.name, type='pstat')
+                    stats = pstats.Stats(tmp.name)
+            else:
+                sample._profile.disable()
+                stats = pstats.Stats(sample._profile)
+
+            if sample.key in self._stats:
+                self._stats[sample.key].add(stats)
+            else:
+                self._stats[sample.key] = stats
+                if len(self._stats) > self.max_keys:
+                    self._forget(next(iter(self._stats)))
+            self._samples[sample.key] = self._samples.get(sample.key, 0) + 1
+            self._seconds[sample.key] = self._seconds.get(sample.key, 0.0) + time.perf_counter() - sample.started
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao coletar profiling de {sample.key}: {e}")
+        finally:
+            self._active.release()
+
+    @asynccontextmanager
+    async def profile(self, key: str) -> AsyncIterator[Optional[ProfileSample]]:
+        sample = self.begin(key)
+        try:
+            yield sample
+        finally:
+            self.end(sample)
+
+    def snapshot(self) -> List[Tuple[str, pstats.Stats, int, float]]:
+        """
+        Cópia das estatísticas atuais. Chamar no event loop (onde end() agrega):
+        a cópia pode ser formatada em outra thread sem disputar com novas amostras.
+        """
+        copies = []
+        for key, stats in self._stats.items():
+            copy = pstats.Stats()
+            copy.add(stats)
+            copies.append((key, copy, self._samples.get(key, 0), self._seconds.get(key, 0.0)))
+        return copies
+
+    def write(self, snapshot: List[Tuple[str, pstats.Stats, int, float]], top: int = 15) -> List[Dict[str, Any]]:
+        """Grava um .prof (pstats) por chave do snapshot e devolve as funções mais caras de cada uma"""
+        if not snapshot:
+            return []
+        os.makedirs(self.output_dir, exist_ok=True)
+        dumped = []
+        for key, stats, samples, seconds in snapshot:
+            path = os.path.join(self.output_dir, f"{_safe_filename(key)}.prof")
+            stats.dump_stats(path)
+
+            report = io.StringIO()
+            stats.stream = report
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+
+            dumped.append({
+                'key': key,
+                'file': path,
+                'samples': samples,
+                'profiled_seconds': round(seconds, 3),
+                'top': report.getvalue(),
+            })
+        logger.info(f"🔬 Profiling gravado em {self.output_dir} ({len(dumped)} arquivos)")
+        return dumped
+
+    def dump(self, top: int = 15) -> List[Dict[str, Any]]:
+        """snapshot() + write() na mesma thread (ex.: shutdown)"""
+        return self.write(self.snapshot(), top)
+
+    def _forget(self, key: str) -> None:
+        self._stats.pop(key, None)
+        self._samples.pop(key, None)
+        self._seconds.pop(key, None)
+
+    def reset(self) -> None:
+        self._calls.clear()
+        self._stats.clear()
+        self._samples.clear()
+        self._seconds.clear()
+
+
+def _safe_filename(key: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', key).strip('_') or 'profile'
+
+
+# Singleton global
+_profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Profiler:
+    """Retorna instância singleton do Profiler"""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
@@ -8,7 +8,7 @@ from typing import Optional
 import logging
 from datetime import datetime
 
-from security_utils import get_authenticated_user, require_role
+from security_utils import get_authenticated_user, require_role, get_client_ip
 from turnstile_service import get_turnstile_service
 from anti_brute_force_service import get_anti_brute_force_service
 from audit_service import get_audit_service
@@ -166,7 +166,7 @@ async def validate_login(
     """
     try:
         # Extrair IP e User-Agent
-        ip_address = request.client.host if request.client else "unknown"
+        ip_address = get_client_ip(request)
         user_agent = request.headers.get("user-agent", "unknown")
         
         brute_force = get_anti_brute_force_service()
@@ -206,14 +206,8 @@ async def validate_login(
                     "turnstile_error": turnstile_result.get("error")
                 }
         else:
-            # Buscar tentativas recentes para decidir se exige Turnstile
-            recent_attempts = await brute_force.get_recent_attempts(
-                email=data.email,
-                limit=10
-            )
-            
-            # Contar falhas recentes
-            recent_failures = sum(1 for a in recent_attempts if not a['success'])
+            # Falhas recentes do email (contador em memória, sem ir ao banco)
+            recent_failures = brute_force.get_failure_count(email=data.email)
             
             # Exigir Turnstile após 3 tentativas falhas
             if recent_failures >= 3:
@@ -242,7 +236,7 @@ async def record_login_attempt(
     """
     try:
         # Extrair IP e User-Agent
-        ip_address = request.client.host if request.client else "unknown"
+        ip_address = get_client_ip(request)
         user_agent = request.headers.get("user-agent", "unknown")
         
         brute_force = get_anti_brute_force_service()
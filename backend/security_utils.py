@@ -2,6 +2,8 @@
 Security utilities for authentication, validation and sanitization
 """
 import os
+import socket
+import asyncio
 import logging
 import ipaddress
 import re
@@ -11,6 +13,7 @@ from typing import Optional, Dict, Any
 from urllib.parse import urlparse
 from fastapi import HTTPException, Request, Depends
 from supabase import create_client
+from shared_cache import SharedCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +21,25 @@ logger = logging.getLogger(__name__)
 _token_cache: Dict[str, tuple[dict, float]] = {}
 TOKEN_CACHE_TTL = 300  # 5 minutos
 
+# Atrás do nginx/Coolify request.client.host é o IP do proxy para todo mundo
+TRUST_PROXY_HEADERS = os.getenv('TRUST_PROXY_HEADERS', 'false').lower() == 'true'
+
+
+def get_client_ip(request: Request) -> str:
+    """
+    IP real do cliente. Com TRUST_PROXY_HEADERS=true usa o X-Real-IP definido
+    pelo nginx; só ative se o backend não for acessível sem passar pelo proxy
+    (senão o header pode ser forjado).
+    """
+    if TRUST_PROXY_HEADERS:
+        real_ip = request.headers.get('x-real-ip', '').strip()
+        if real_ip:
+            try:
+                return str(ipaddress.ip_address(real_ip))
+            except ValueError:
+                logger.warning(f"⚠️ X-Real-IP inválido ignorado: {real_ip[:64]}")
+    return request.client.host if request.client else "unknown"
+
 # ========== AUTHENTICATION ==========
 
 async def get_authenticated_user(request: Request) -> dict:
@@ -387,7 +409,58 @@ def sanitize_csv_value(value: Any) -> str:
 
 # ========== URL VALIDATION (SSRF PREVENTION) ==========
 
-def validate_media_url(url: str) -> tuple[bool, Optional[str]]:
+MEDIA_BLOCKED_HOSTNAMES = frozenset({
+    'localhost',
+    '127.0.0.1',
+    '0.0.0.0',
+    'metadata.google.internal',  # GCP metadata
+    '169.254.169.254',  # AWS/Azure metadata
+    'metadata.azure.com',
+    'metadata',
+})
+
+MEDIA_ALLOWED_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf', '.doc', '.docx', '.xls', '.xlsx'
+})
+_MEDIA_ALLOWED_EXTENSIONS_TEXT = ', '.join(sorted(MEDIA_ALLOWED_EXTENSIONS))
+
+# hostname -> IPs resolvidos (A + AAAA). Falhas de resolução ficam pouco tempo.
+_dns_cache = SharedCache(
+    'media_dns',
+    maxsize=int(os.getenv('MEDIA_DNS_CACHE_MAXSIZE', '1024')),
+    ttl=float(os.getenv('MEDIA_DNS_CACHE_TTL', '300')),
+    negative_ttl=30
+)
+
+
+def _is_blocked_ip(ip: ipaddress._BaseAddress) -> bool:
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_unspecified
+
+
+async def resolve_hostname(hostname: str) -> list[str]:
+    """
+    Resolve todos os registros A/AAAA do hostname sem bloquear o event loop
+    (getaddrinfo roda no executor). Resultado cacheado por hostname.
+    """
+    hit, addresses, _negative = await _dns_cache.get(hostname)
+    if hit:
+        return addresses
+    
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        await _dns_cache.set(hostname, [], negative=True)
+        return []
+    
+    addresses = sorted({info[4][0].split('%', 1)[0] for info in infos})
+    await _dns_cache.set(hostname, addresses)
+    return addresses
+
+
+async def validate_media_url(url: str) -> tuple[bool, Optional[str]]:
     """
     Valida URL de mídia para prevenir SSRF.
     Bloqueia IPs privados, localhost, cloud metadata, etc.
@@ -411,48 +484,31 @@ def validate_media_url(url: str) -> tuple[bool, Optional[str]]:
             return False, "URL inválida"
         
         # 3. Lista de hostnames bloqueados
-        blocked_hostnames = [
-            'localhost',
-            '127.0.0.1',
-            '0.0.0.0',
-            'metadata.google.internal',  # GCP metadata
-            '169.254.169.254',  # AWS/Azure metadata
-            'metadata.azure.com',
-            'metadata',
-        ]
-        
         hostname_lower = hostname.lower()
-        if hostname_lower in blocked_hostnames:
+        if hostname_lower in MEDIA_BLOCKED_HOSTNAMES:
             return False, "Hostname bloqueado por política de segurança"
         
         # 4. Bloquear IPs privados e reservados
         try:
             # Tenta tratar como IP
             ip = ipaddress.ip_address(hostname)
-            if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved:
+            if _is_blocked_ip(ip):
                 return False, "IPs privados/reservados não são permitidos"
         except ValueError:
-            # Não é IP, é hostname - validar através de DNS
-            import socket
-            try:
-                resolved_ip = socket.gethostbyname(hostname)
-                ip = ipaddress.ip_address(resolved_ip)
-                if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved:
-                    return False, "URL resolve para IP privado/reservado"
-            except (socket.gaierror, ValueError):
-                # Não conseguiu resolver ou IP inválido
-                pass
+            # Não é IP, é hostname - validar todos os IPs para os quais resolve
+            for resolved_ip in await resolve_hostname(hostname_lower):
+                try:
+                    if _is_blocked_ip(ipaddress.ip_address(resolved_ip)):
+                        return False, "URL resolve para IP privado/reservado"
+                except ValueError:
+                    continue
         
         # 5. Validar extensão de arquivo (whitelist)
-        path = parsed.path.lower()
-        allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf', '.doc', '.docx', '.xls', '.xlsx']
-        
         # URL pode não ter extensão (ex: CDN com query string)
-        # Então validamos apenas se tiver extensão clara
-        if '.' in path:
-            has_valid_ext = any(path.endswith(ext) for ext in allowed_extensions)
-            if not has_valid_ext:
-                return False, f"Extensão de arquivo não permitida. Use: {', '.join(allowed_extensions)}"
+        # Então validamos apenas se o arquivo tiver extensão clara
+        extension = os.path.splitext(parsed.path.lower())[1]
+        if extension and extension not in MEDIA_ALLOWED_EXTENSIONS:
+            return False, f"Extensão de arquivo não permitida. Use: {_MEDIA_ALLOWED_EXTENSIONS_TEXT}"
         
         # 6. Bloquear caracteres suspeitos que podem indicar bypass
         suspicious_chars = ['@', '#']
@@ -0,0 +1,156 @@
+"""
+Send Logging
+Logs dos caminhos de envio (WAHA + worker de campanhas) em formato estruturado
+(chave=valor) e amostrado, para que milhares de envios por hora não inundem
+os logs nem gastem CPU formatando strings que ninguém lê.
+
+Modos (SEND_LOG_MODE, alterável em runtime via /api/admin/send-logging):
+- full: uma linha por envio + detalhes do payload no WahaService
+- sampled: 1 a cada SEND_LOG_SAMPLE_EVERY envios bem-sucedidos (padrão)
+- summary: nenhuma linha por envio bem-sucedido
+
+Falhas são sempre logadas. Em todos os modos cada campanha emite uma linha
+de resumo a cada SEND_LOG_SUMMARY_INTERVAL segundos e ao terminar.
+"""
+import os
+import time
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SEND_LOG_MODES = ('full', 'sampled', 'summary')
+
+
+class _CampaignSendStats:
+    """Contadores de envio de uma campanha desde o último resumo"""
+
+    __slots__ = ('sent', 'failed', 'elapsed', 'window_start', 'total_sent', 'total_failed')
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.elapsed = 0.0
+        self.window_start = time.monotonic()
+        self.total_sent = 0
+        self.total_failed = 0
+
+
+class SendLogger:
+    """Logger amostrado dos envios + resumo periódico por campanha"""
+
+    def __init__(self):
+        self.mode = 'sampled'
+        self.sample_every = 100
+        self.summary_interval = float(os.getenv('SEND_LOG_SUMMARY_INTERVAL', '300'))
+        self._seen = 0
+        self._campaigns: Dict[str, _CampaignSendStats] = {}
+
+        try:
+            self.configure(
+                mode=os.getenv('SEND_LOG_MODE', 'sampled'),
+                sample_every=int(os.getenv('SEND_LOG_SAMPLE_EVERY', '100'))
+            )
+        except ValueError as e:
+            logger.warning(f"⚠️ Configuração de log de envios inválida ({e}), usando 'sampled'")
+
+    @property
+    def verbose(self) -> bool:
+        """Detalhes por envio (payload, mimetype, resposta) só no modo 'full'"""
+        return self.mode == 'full'
+
+    def configure(self, mode: Optional[str] = None, sample_every: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Altera o modo em runtime.
+
+        Raises:
+            ValueError: modo desconhecido ou amostragem < 1
+        """
+        if mode is not None:
+            mode = mode.lower()
+            if mode not in SEND_LOG_MODES:
+                raise ValueError(f"Modo inválido: {mode} (use {', '.join(SEND_LOG_MODES)})")
+        if sample_every is not None and sample_every < 1:
+            raise ValueError("sample_every deve ser >= 1")
+
+        if mode is not None:
+            self.mode = mode
+        if sample_every is not None:
+            self.sample_every = sample_every
+        return self.settings()
+
+    def settings(self) -> Dict[str, Any]:
+        return {
+            'mode': self.mode,
+            'sample_every': self.sample_every,
+            'summary_interval': self.summary_interval,
+            'active_campaigns': len(self._campaigns),
+        }
+
+    def record(
+        self,
+        campaign_id: str,
+        phone: str,
+        message_type: str,
+        success: bool,
+        elapsed: float,
+        error: Optional[str] = None
+    ) -> None:
+        """Registra um envio; loga conforme o modo e emite o resumo quando vence"""
+        stats = self._campaigns.get(campaign_id)
+        if stats is None:
+            stats = self._campaigns[campaign_id] = _CampaignSendStats()
+
+        stats.elapsed += elapsed
+        if success:
+            stats.sent += 1
+            stats.total_sent += 1
+            self._seen += 1
+            if self.mode == 'full' or (self.mode == 'sampled' and self._seen % self.sample_every == 0):
+                logger.info(
+                    "send campaign=%s phone=%s type=%s status=sent ms=%.0f",
+                    campaign_id, phone, message_type, elapsed * 1000
+                )
+        else:
+            stats.failed += 1
+            stats.total_failed += 1
+            logger.warning(
+                "send campaign=%s phone=%s type=%s status=error ms=%.0f error=%s",
+                campaign_id, phone, message_type, elapsed * 1000, error
+            )
+
+        if time.monotonic() - stats.window_start >= self.summary_interval:
+            self._summary(campaign_id, stats)
+
+    def finish(self, campaign_id: str, reason: str) -> None:
+        """Resumo final da campanha (concluída, pausada, cancelada...)"""
+        stats = self._campaigns.pop(campaign_id, None)
+        if stats is not None:
+            self._summary(campaign_id, stats, reason=reason)
+
+    def _summary(self, campaign_id: str, stats: _CampaignSendStats, reason: str = 'running') -> None:
+        window = time.monotonic() - stats.window_start
+        count = stats.sent + stats.failed
+        logger.info(
+            "send_summary campaign=%s state=%s sent=%d failed=%d avg_ms=%.0f per_min=%.1f total_sent=%d total_failed=%d",
+            campaign_id, reason, stats.sent, stats.failed,
+            (stats.elapsed / count * 1000) if count else 0,
+            (count / window * 60) if window > 0 else 0,
+            stats.total_sent, stats.total_failed
+        )
+        stats.sent = 0
+        stats.failed = 0
+        stats.elapsed = 0.0
+        stats.window_start = time.monotonic()
+
+
+# Singleton global
+_send_logger: Optional[SendLogger] = None
+
+
+def get_send_logger() -> SendLogger:
+    """Retorna instância singleton do SendLogger"""
+    global _send_logger
+    if _send_logger is None:
+        _send_logger = SendLogger()
+    return _send_logger
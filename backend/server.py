@@ -1,17 +1,18 @@
 from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, BackgroundTasks, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.exceptions import RequestValidationError
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 import os
+import hmac
 import logging
 from pathlib import Path
 from typing import List, Optional
 from datetime import datetime
-import time as time_module
 import pandas as pd
 import io
 import uuid
@@ -38,7 +39,17 @@ from security_utils import (
 from kiwify_webhook import webhook_router
 from admin_endpoints import admin_router
 from security_endpoints import security_router
-from agent_service import process_waha_message_for_n8n
+from agent_service import invalidate_session_context, get_message_debouncer
+from shared_cache import SharedCache
+from webhook_queue import get_webhook_queue, ENQUEUE_SPILLED, ENQUEUE_SHED
+from n8n_forwarder import get_n8n_forwarder
+from email_service import get_email_service, precompile_email_templates
+from email_outbox import get_email_outbox
+from anti_brute_force_service import get_anti_brute_force_service
+from audit_service import get_audit_service
+from media_staging import get_media_stager
+from metrics import REGISTRY as METRICS_REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from profiling import get_profiler
 
 # --- CORREÇÃO DO LOAD DOTENV ---
 CURRENT_DIR = Path(__file__).parent
@@ -84,29 +95,38 @@ def get_db() -> SupabaseService:
     return get_supabase_service()
 
 
-# ========== In-memory cache for session names (Problem 3 fix) ==========
-# Cache: company_id -> (session_name, timestamp)
-_session_name_cache: dict[str, tuple[str, float]] = {}
-_SESSION_CACHE_TTL = 300  # 5 minutes
+# ========== Session name cache (bounded TTL + LRU, shared across workers if REDIS_URL is set) ==========
+# company_id -> session_name. Negative entries (DB lookup failed) expire sooner.
+_session_name_cache = SharedCache(
+    'session_name',
+    maxsize=int(os.getenv('SESSION_CACHE_MAXSIZE', '2000')),
+    ttl=int(os.getenv('SESSION_CACHE_TTL', '300')),  # 5 minutes
+    negative_ttl=int(os.getenv('SESSION_CACHE_NEGATIVE_TTL', '30'))
+)
+
+
+async def invalidate_session_name(company_id: str) -> None:
+    """Drop the cached session name for a company (call after changing waha_session)"""
+    await _session_name_cache.invalidate(company_id)
 
 
 async def get_session_name_for_company(company_id: str, company_name: str = None) -> str:
     """
     Define o nome da sessão do WhatsApp de forma segura.
     Formato: nome_empresa_id (ex: "acme_corp_efdaca5d")
-    Uses in-memory cache with 5-minute TTL to avoid repeated DB queries.
+    Uses a bounded TTL/LRU cache; failed lookups are cached briefly as negative entries.
     """
     import re
 
     # Check cache first
-    if company_id in _session_name_cache:
-        cached_name, cached_time = _session_name_cache[company_id]
-        if (time_module.time() - cached_time) < _SESSION_CACHE_TTL:
-            return cached_name
+    hit, cached_name, _negative = await _session_name_cache.get(company_id)
+    if hit:
+        return cached_name
 
     logger.info(f"Buscando sessão para company_id: {company_id} (cache miss)")
 
     session_name = None
+    lookup_failed = False
     try:
         db = get_db()
         config = await db.get_waha_config(company_id)
@@ -126,6 +146,7 @@ async def get_session_name_for_company(company_id: str, company_name: str = None
                         company_name = company_result.data.get('name')
                 except Exception as e:
                     logger.warning(f"Não encontrou nome da empresa: {e}")
+                    lookup_failed = True
 
             if company_name:
                 safe_name = re.sub(r'[^a-zA-Z0-9]', '_', company_name.lower())
@@ -139,9 +160,10 @@ async def get_session_name_for_company(company_id: str, company_name: str = None
     except Exception as e:
         logger.warning(f"Usando sessão padrão devido a erro: {e}")
         session_name = f"company_{company_id.split('-')[0] if company_id else 'unknown'}"
+        lookup_failed = True
 
-    # Store in cache
-    _session_name_cache[company_id] = (session_name, time_module.time())
+    # Store in cache (failures as short-lived negative entries)
+    await _session_name_cache.set(company_id, session_name, negative=lookup_failed)
     return session_name
 
 
@@ -202,7 +224,28 @@ async def root():
 # ========== NEW: Health Check ==========
 @api_router.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "webhook_queue": get_webhook_queue().stats(),
+        "n8n": get_n8n_forwarder().stats(),
+        "email_outbox": get_email_outbox().stats(),
+        "audit": get_audit_service().stats()
+    }
+
+
+# ========== Prometheus Metrics ==========
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """Métricas do processo no formato texto do Prometheus (exige METRICS_TOKEN; sem ele o endpoint fica desligado)"""
+    token = os.getenv('METRICS_TOKEN')
+    if not token:
+        # A porta do backend é exposta direto - sem token não publica nomes de tabelas/campanhas
+        raise HTTPException(status_code=404, detail="Not Found")
+    provided = request.headers.get('authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(provided.encode(), token.encode()):
+        raise HTTPException(status_code=401, detail="Token de métricas inválido")
+    return Response(content=METRICS_REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
 
 
 # ========== WhatsApp Debug Endpoint ==========
@@ -318,6 +361,8 @@ async def start_whatsapp_session(
             'company_id': company_id,
             'waha_session': session_name
         }, on_conflict='company_id').execute()
+        await invalidate_session_name(company_id)
+        await invalidate_session_context(session_name)
         logger.info(f"✅ Sessão {session_name} salva em company_settings")
     except Exception as e:
         logger.warning(f"⚠️ Não foi possível salvar sessão em company_settings: {e}")
@@ -575,7 +620,26 @@ async def create_campaign_from_leads(
         
         campaign_id = str(uuid.uuid4())
         
-        # 1. Criar campanha
+        # 1. Preparar contatos (antes de criar a campanha, para gravar a contagem real)
+        contacts_to_insert = []
+        for contact in data.contacts:
+            phone = contact.get("phone", "").strip()
+            # Limpar telefone
+            phone = ''.join(filter(str.isdigit, phone))
+            if len(phone) < 10:
+                continue  # Pular telefones inválidos
+            
+            contacts_to_insert.append({
+                "campaign_id": campaign_id,
+                "name": contact.get("name", "Sem nome")[:100],
+                "phone": phone,
+                "category": contact.get("category", "")[:50] if contact.get("category") else None,
+                "extra_data": contact.get("extra_data", {}),
+                "status": "pending"
+            })
+        
+        actual_count = len(contacts_to_insert)
+        
         campaign_data = {
             "id": campaign_id,
             "company_id": auth_user["company_id"],
@@ -592,58 +656,25 @@ async def create_campaign_from_leads(
             "end_time": data.settings.end_time,
             "daily_limit": data.settings.daily_limit,
             "working_days": data.settings.working_days,
-            "total_contacts": len(data.contacts),
+            "total_contacts": actual_count,
             "sent_count": 0,
             "error_count": 0,
-            "pending_count": len(data.contacts)
+            "pending_count": actual_count
         }
         
         # Nota: timezone será buscado da empresa se não estiver na campanha
         
-        result = await db.create_campaign(campaign_data)
+        # 2. Criar campanha + contatos atomicamente (RPC única, retorna a linha final)
+        result = await db.create_campaign_with_contacts(campaign_data, contacts_to_insert)
         if not result:
             raise HTTPException(status_code=500, detail="Erro ao criar campanha")
         
-        # 2. Inserir contatos em batch (eficiente para Supabase)
-        contacts_to_insert = []
-        for contact in data.contacts:
-            phone = contact.get("phone", "").strip()
-            # Limpar telefone
-            phone = ''.join(filter(str.isdigit, phone))
-            if len(phone) < 10:
-                continue  # Pular telefones inválidos
-            
-            contacts_to_insert.append({
-                "campaign_id": campaign_id,
-                "name": contact.get("name", "Sem nome")[:100],
-                "phone": phone,
-                "category": contact.get("category", "")[:50] if contact.get("category") else None,
-                "extra_data": contact.get("extra_data", {}),
-                "status": "pending"
-            })
-        
-        # Inserir em batches de 500 para não sobrecarregar
-        batch_size = 500
-        for i in range(0, len(contacts_to_insert), batch_size):
-            batch = contacts_to_insert[i:i + batch_size]
-            db.client.table("campaign_contacts").insert(batch).execute()
-        
-        # 3. Atualizar contagem real (pode ter removido inválidos)
-        actual_count = len(contacts_to_insert)
-        if actual_count != len(data.contacts):
-            db.client.table("campaigns").update({
-                "total_contacts": actual_count,
-                "pending_count": actual_count
-            }).eq("id", campaign_id).execute()
-        
-        # 4. Incrementar quota
+        # 3. Incrementar quota
         await db.increment_quota(auth_user["user_id"], "create_campaign")
         
         logger.info(f"✅ Campanha {campaign_id} criada com {actual_count} contatos")
         
-        # Retornar campanha criada
-        final_result = db.client.table("campaigns").select("*").eq("id", campaign_id).single().execute()
-        return campaign_to_response(final_result.data) if final_result.data else result
+        return campaign_to_response(result)
     
     except HTTPException:
         raise
@@ -1196,19 +1227,57 @@ async def increment_quota_endpoint(
 
 
 # ========== WAHA Webhook (recebe mensagens do WhatsApp) ==========
+# WAHA reenvia webhooks (retries: 3x a cada 2s); ids já vistos são descartados
+_seen_waha_messages = SharedCache(
+    'waha_seen_messages',
+    maxsize=int(os.getenv('WAHA_DEDUP_MAXSIZE', '20000')),
+    ttl=int(os.getenv('WAHA_DEDUP_TTL', '600'))
+)
+
+
+def get_waha_message_id(payload: dict) -> Optional[str]:
+    """Id da mensagem WAHA (payload.id), com fallback para o id do evento"""
+    message = payload.get("payload") or {}
+    message_id = message.get("id") if isinstance(message, dict) else None
+    if isinstance(message_id, dict):
+        # Alguns engines mandam o id serializado em '_serialized'
+        message_id = message_id.get("_serialized")
+    message_id = message_id or payload.get("id")
+    if not message_id:
+        return None
+    return f"{payload.get('session')}:{message_id}"
+
+
 @api_router.post("/webhook/waha")
-async def waha_webhook(request: Request, background_tasks: BackgroundTasks):
+async def waha_webhook(request: Request):
     """
     Recebe webhooks do WAHA (mensagens do WhatsApp).
-    Fluxo: WAHA → Backend → n8n → OpenAI → WAHA (resposta)
+    Fluxo: WAHA → Backend → fila → n8n → OpenAI → WAHA (resposta)
     """
     try:
         payload = await request.json()
         event = payload.get("event")
         
-        # Só processa mensagens recebidas
+        # Só processa mensagens recebidas (fila limitada, ordem por sessão)
         if event == "message":
-            background_tasks.add_task(process_waha_message_for_n8n, payload)
+            message_id = get_waha_message_id(payload)
+            if message_id and not await _seen_waha_messages.add_if_absent(message_id):
+                return {"status": "duplicate"}
+            
+            outcome = await get_webhook_queue().enqueue(payload)
+            if outcome == ENQUEUE_SPILLED:
+                # Salvo no spill: será processado depois, o id continua marcado como visto
+                return {"status": "spilled"}
+            if outcome == ENQUEUE_SHED:
+                # Descartado: libera o id e responde 503 para o WAHA reenviar
+                # (com 200 o WAHA considera entregue e a mensagem se perde)
+                if message_id:
+                    await _seen_waha_messages.invalidate(message_id)
+                return JSONResponse(
+                    status_code=503,
+                    content={"status": "deferred"},
+                    headers={"Retry-After": "2"}
+                )
             return {"status": "processing"}
         
         return {"status": "ignored", "event": event}
@@ -1299,6 +1368,9 @@ async def update_agent_config(
         if not result:
             raise HTTPException(status_code=500, detail="Erro ao salvar configuração")
         
+        # Webhook do agente usa contexto em cache por sessão
+        await invalidate_session_context(await get_session_name_for_company(company_id))
+        
         logger.info(f"🤖 Config do agente atualizada para empresa {company_id}")
         return {"config": result, "success": True}
     except HTTPException:
@@ -1307,6 +1379,30 @@ async def update_agent_config(
         raise handle_error(e, "Erro ao salvar configuração do agente")
 
 
+# ========== Lifecycle ==========
+@app.on_event("startup")
+async def start_background_workers():
+    precompile_email_templates()
+    await get_webhook_queue().start()
+    await get_email_outbox().start()
+    await get_anti_brute_force_service().start()
+    await get_audit_service().start()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    # Lotes do debounce voltam para a fila - precisa rodar antes de parar a fila
+    await get_message_debouncer().flush_all()
+    await get_webhook_queue().stop()
+    await get_n8n_forwarder().close()
+    await get_email_outbox().stop()
+    await get_anti_brute_force_service().stop()
+    await get_audit_service().stop()
+    await get_email_service().close()
+    await get_media_stager().close()
+    get_profiler().dump()
+
+
 # Include the router in the main app
 app.include_router(api_router)
 app.include_router(webhook_router)
@@ -1335,4 +1431,22 @@ async def add_security_headers(request: Request, call_next):
     response.headers["X-Frame-Options"] = "DENY"
     response.headers["X-XSS-Protection"] = "1; mode=block"
     response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-    return response
\ No newline at end of file
+    return response
+
+
+def _route_key(request: Request) -> str:
+    """'MÉTODO /template/da/{rota}' - agrupa o profiling por rota, não por URL"""
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return f"{request.method} {route.path}"
+    return f"{request.method} {request.url.path}"
+
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    profiler = get_profiler()
+    if not profiler.wants_route(request.url.path):
+        return await call_next(request)
+    async with profiler.profile(_route_key(request)):
+        return await call_next(request)
@@ -0,0 +1,195 @@
+"""
+Shared Cache
+Cache em memória (TTL + LRU, com entradas negativas) e backend compartilhado
+opcional em Redis para que vários workers do uvicorn enxerguem os mesmos valores.
+"""
+import os
+import json
+import time
+import logging
+from typing import Any, Optional, Tuple
+from cachetools import TLRUCache
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # Redis é opcional
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+# Quando o Redis está ativo, o cache local vira só um L1 curto
+# (outros workers podem ter invalidado a chave no Redis)
+SHARED_CACHE_LOCAL_TTL = float(os.getenv('SHARED_CACHE_LOCAL_TTL', '5'))
+# Depois de um erro, o Redis fica fora por esse tempo: o cache volta a ser só
+# local (TTL cheio) em vez de errar - e logar - a cada acesso
+SHARED_CACHE_RETRY_AFTER = float(os.getenv('SHARED_CACHE_RETRY_AFTER', '30'))
+
+_redis_client = None
+_redis_checked = False
+_redis_down_until = 0.0
+
+
+def get_shared_store():
+    """Retorna cliente Redis (se REDIS_URL configurado e lib instalada) ou None"""
+    global _redis_client, _redis_checked
+    if _redis_checked:
+        return _redis_client
+
+    _redis_checked = True
+    redis_url = os.getenv('REDIS_URL')
+    if not redis_url:
+        return None
+    if redis_asyncio is None:
+        logger.warning("⚠️ REDIS_URL configurado mas pacote 'redis' não instalado - usando apenas cache local")
+        return None
+
+    _redis_client = redis_asyncio.from_url(redis_url, decode_responses=True)
+    logger.info("🗄️ Cache compartilhado ativado (Redis)")
+    return _redis_client
+
+
+def _healthy_store():
+    """Cliente Redis, ou None se não configurado ou fora do ar (aguardando nova tentativa)"""
+    store = get_shared_store()
+    if store is None or time.monotonic() < _redis_down_until:
+        return None
+    return store
+
+
+def _mark_down(namespace: str, error: Exception) -> None:
+    global _redis_down_until
+    if not _redis_down_until:
+        logger.warning(f"⚠️ Cache compartilhado indisponível ({namespace}: {error}) - usando só cache local, nova tentativa em {SHARED_CACHE_RETRY_AFTER:.0f}s")
+    _redis_down_until = time.monotonic() + SHARED_CACHE_RETRY_AFTER
+
+
+def _mark_up() -> None:
+    global _redis_down_until
+    if _redis_down_until:
+        _redis_down_until = 0.0
+        logger.info("🗄️ Cache compartilhado (Redis) disponível novamente")
+
+
+class SharedCache:
+    """
+    Cache TTL + LRU limitado, com suporte a entradas negativas (TTL próprio)
+    e espelhamento opcional em Redis.
+
+    shared=False deixa o cache só em memória - para valores com credenciais,
+    que não devem ir em texto puro para o Redis.
+    """
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float, negative_ttl: Optional[float] = None, shared: bool = True):
+        self.namespace = namespace
+        self.shared = shared
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        # Cada entrada guarda (valor, ttl, negativa) - o TTL é por item
+        self._local = TLRUCache(maxsize=maxsize, ttu=lambda _key, entry, now: now + entry[1])
+
+    def _redis_key(self, key: str) -> str:
+        return f"c4y:{self.namespace}:{key}"
+
+    def _store(self):
+        return _healthy_store() if self.shared else None
+
+    def _local_ttl(self, ttl: float) -> float:
+        # L1 curto só com o Redis respondendo; fora do ar o local é o único cache
+        if self._store() is not None:
+            return min(ttl, SHARED_CACHE_LOCAL_TTL)
+        return ttl
+
+    async def get(self, key: str) -> Tuple[bool, Any, bool]:
+        """
+        Busca uma chave.
+
+        Returns:
+            (hit, value, negative)
+        """
+        entry = self._local.get(key)
+        if entry is not None:
+            value, _ttl, negative = entry
+            return True, value, negative
+
+        store = self._store()
+        if store is None:
+            return False, None, False
+
+        try:
+            raw = await store.get(self._redis_key(key))
+        except Exception as e:
+            _mark_down(self.namespace, e)
+            return False, None, False
+        _mark_up()
+
+        if raw is None:
+            return False, None, False
+
+        data = json.loads(raw)
+        value, negative = data.get('v'), bool(data.get('n'))
+        ttl = self.negative_ttl if negative else self.ttl
+        self._local[key] = (value, self._local_ttl(ttl), negative)
+        return True, value, negative
+
+    async def set(self, key: str, value: Any, negative: bool = False, ttl: Optional[float] = None) -> None:
+        """Grava valor (negative=True usa negative_ttl)"""
+        if ttl is None:
+            ttl = self.negative_ttl if negative else self.ttl
+
+        self._local[key] = (value, self._local_ttl(ttl), negative)
+
+        store = self._store()
+        if store is None:
+            return
+
+        try:
+            await store.set(self._redis_key(key), json.dumps({'v': value, 'n': negative}), ex=max(int(ttl), 1))
+            _mark_up()
+        except Exception as e:
+            _mark_down(self.namespace, e)
+            # Gravado no local com o TTL curto do L1 - sem o Redis vale o TTL cheio
+            self._local[key] = (value, ttl, negative)
+
+    async def add_if_absent(self, key: str, value: Any = True, ttl: Optional[float] = None) -> bool:
+        """
+        Grava a chave só se ainda não existir (seen-set com janela de tempo).
+
+        Returns:
+            True se a chave foi gravada agora; False se já existia
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        if self._local.get(key) is not None:
+            return False
+
+        store = self._store()
+        if store is not None:
+            try:
+                created = await store.set(self._redis_key(key), json.dumps({'v': value, 'n': False}), ex=max(int(ttl), 1), nx=True)
+                _mark_up()
+                if not created:
+                    self._local[key] = (value, self._local_ttl(ttl), False)
+                    return False
+            except Exception as e:
+                _mark_down(self.namespace, e)
+
+        self._local[key] = (value, self._local_ttl(ttl), False)
+        return True
+
+    async def invalidate(self, key: str) -> None:
+        """Remove a chave do cache local e do compartilhado"""
+        self._local.pop(key, None)
+
+        store = self._store()
+        if store is None:
+            return
+
+        try:
+            await store.delete(self._redis_key(key))
+            _mark_up()
+        except Exception as e:
+            _mark_down(self.namespace, e)
+
+    def clear_local(self) -> None:
+        self._local.clear()
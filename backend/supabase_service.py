@@ -3,13 +3,27 @@ Supabase Database Service
 Handles all database operations using Supabase REST API
 """
 import os
+import asyncio
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from supabase import create_client, Client
 import logging
+from metrics import instrument_postgrest_session
 
 logger = logging.getLogger(__name__)
 
+# PostgREST "function not found in schema cache" / Postgres undefined_function
+MISSING_FUNCTION_CODES = ('PGRST202', '42883')
+
+
+def is_missing_function(error: Exception) -> bool:
+    """
+    True when an RPC failed because the function does not exist (migration not applied).
+    Only then is a non-transactional fallback safe: any other error may come from a
+    call that ran (and maybe committed) on the server.
+    """
+    return getattr(error, 'code', None) in MISSING_FUNCTION_CODES
+
 
 class SupabaseService:
     
@@ -23,6 +37,17 @@ class SupabaseService:
         
         self.client: Client = create_client(self.url, self.key)
 
+        # Latência por tabela/método em /metrics. O client recria o PostgREST em
+        # eventos de auth, então os hooks entram na criação e não uma vez só.
+        init_postgrest = self.client._init_postgrest_client
+
+        def _init_instrumented_postgrest(*args, **kwargs):
+            postgrest = init_postgrest(*args, **kwargs)
+            instrument_postgrest_session(postgrest.session)
+            return postgrest
+
+        self.client._init_postgrest_client = _init_instrumented_postgrest
+
     # ... (dentro da classe SupabaseService)
 
     async def get_agent_config(self, company_id: str) -> Optional[dict]:
@@ -108,6 +133,67 @@ class SupabaseService:
         result = self.client.table('campaigns').insert(campaign_data).execute()
         return result.data[0] if result.data else None
     
+    async def create_campaign_with_contacts(
+        self,
+        campaign_data: Dict[str, Any],
+        contacts: List[Dict[str, Any]],
+        batch_size: int = 500
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Create a campaign and all of its contacts atomically.
+        Uses the create_campaign_with_contacts RPC (single round trip, single transaction).
+        Falls back to insert + concurrent batch inserts, removing the campaign if any batch fails.
+        """
+        campaign_data = {
+            **campaign_data,
+            'total_contacts': len(contacts),
+            'pending_count': len(contacts),
+        }
+
+        try:
+            result = self.client.rpc('create_campaign_with_contacts', {
+                'p_campaign': campaign_data,
+                'p_contacts': contacts,
+            }).execute()
+            if isinstance(result.data, list):
+                return result.data[0] if result.data else None
+            return result.data
+        except Exception as rpc_err:
+            if not is_missing_function(rpc_err):
+                # The RPC is a single transaction: if it committed before the error
+                # (e.g. a timeout on the way back), the campaign is already there
+                if campaign_data.get('id'):
+                    existing = await self.get_campaign(campaign_data['id'])
+                    if existing:
+                        return existing
+                raise
+            logger.warning(f"RPC create_campaign_with_contacts not available, using fallback: {rpc_err}")
+
+        campaign = await self.create_campaign(campaign_data)
+        if not campaign:
+            return None
+
+        campaign_id = campaign['id']
+        rows = [{**contact, 'campaign_id': campaign_id} for contact in contacts]
+        batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+        def _insert_batch(batch: List[Dict[str, Any]]):
+            return self.client.table('campaign_contacts').insert(batch, returning='minimal').execute()
+
+        try:
+            # Batches are independent: send them in parallel instead of one after another
+            await asyncio.gather(*(asyncio.to_thread(_insert_batch, batch) for batch in batches))
+        except Exception:
+            # Compensate: don't leave a half-filled campaign behind
+            try:
+                await self.delete_contacts_by_campaign(campaign_id)
+                await self.delete_campaign(campaign_id)
+            except Exception as cleanup_err:
+                logger.error(f"Error rolling back campaign {campaign_id}: {cleanup_err}")
+            raise
+
+        return campaign
+
     async def get_campaign(self, campaign_id: str) -> Optional[Dict[str, Any]]:
         """Get a campaign by ID"""
         result = self.client.table('campaigns').select('*').eq('id', campaign_id).execute()
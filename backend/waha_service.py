@@ -3,7 +3,10 @@ import logging
 import base64
 from typing import Optional, Dict, Any
 import re
+from urllib.parse import urlparse
 from security_utils import validate_media_url, sanitize_template_value
+from send_logging import get_send_logger
+from metrics import WahaCallTimer
 
 logger = logging.getLogger(__name__)
 
@@ -221,14 +224,16 @@ class WahaService:
                 return False
 
             async with httpx.AsyncClient(timeout=8.0) as client:
-                response = await client.get(
-                    f"{self.waha_url}/api/contacts/check-exists",
-                    headers=self.headers,
-                    params={
-                        "phone": formatted_phone,
-                        "session": self.session_name
-                    }
-                )
+                with WahaCallTimer("check-exists") as call:
+                    response = await client.get(
+                        f"{self.waha_url}/api/contacts/check-exists",
+                        headers=self.headers,
+                        params={
+                            "phone": formatted_phone,
+                            "session": self.session_name
+                        }
+                    )
+                    call.status = response.status_code
                 
                 if response.status_code == 200:
                     data = response.json()
@@ -249,70 +254,75 @@ class WahaService:
         chat_id = f"{normalize_phone(phone)}@c.us"
         try:
             async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.waha_url}/api/sendText",
-                    headers=self.headers,
-                    json={"chatId": chat_id, "text": message, "session": self.session_name}
-                )
+                with WahaCallTimer("sendText") as call:
+                    response = await client.post(
+                        f"{self.waha_url}/api/sendText",
+                        headers=self.headers,
+                        json={"chatId": chat_id, "text": message, "session": self.session_name}
+                    )
+                    call.status = response.status_code
                 if response.status_code in [200, 201]:
                     return {"success": True, "data": response.json()}
                 return {"success": False, "error": f"HTTP {response.status_code}"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    async def send_image_message(self, phone: str, caption: str, image_url: Optional[str] = None, image_base64: Optional[str] = None) -> Dict[str, Any]:
+    async def send_image_message(self, phone: str, caption: str, image_url: Optional[str] = None, image_base64: Optional[str] = None, mimetype: Optional[str] = None) -> Dict[str, Any]:
         chat_id = f"{normalize_phone(phone)}@c.us"
         try:
-            logger.info(f"📸 Enviando imagem para {phone}")
-            logger.info(f"📸 URL da imagem: {image_url}")
-            logger.info(f"📸 Caption: {caption[:50]}...")
-            
             payload = {"chatId": chat_id, "caption": caption, "session": self.session_name}
             
             if image_url:
-                # Detectar mimetype pela extensão da URL
-                mimetype = "image/png"
-                if image_url.lower().endswith('.jpg') or image_url.lower().endswith('.jpeg'):
-                    mimetype = "image/jpeg"
-                elif image_url.lower().endswith('.gif'):
-                    mimetype = "image/gif"
-                elif image_url.lower().endswith('.webp'):
-                    mimetype = "image/webp"
+                if not mimetype:
+                    # Sem mimetype detectado pelo conteúdo: tenta pela extensão da URL
+                    path = urlparse(image_url).path.lower()
+                    mimetype = "image/png"
+                    if path.endswith('.jpg') or path.endswith('.jpeg'):
+                        mimetype = "image/jpeg"
+                    elif path.endswith('.gif'):
+                        mimetype = "image/gif"
+                    elif path.endswith('.webp'):
+                        mimetype = "image/webp"
                 
                 # IMPORTANTE: WAHA GOWS precisa do mimetype no payload
                 payload["file"] = {
                     "url": image_url,
                     "mimetype": mimetype
                 }
-                logger.info(f"📸 Mimetype detectado: {mimetype}")
             elif image_base64:
                 payload["file"] = {"data": image_base64}
+                if mimetype:
+                    payload["file"]["mimetype"] = mimetype
             else:
                 logger.error("📸 Nenhuma imagem fornecida!")
                 return {"success": False, "error": "No image provided"}
             
-            logger.info(f"📸 Payload: {payload}")
+            if get_send_logger().verbose:
+                # Sem caption nem base64 da mídia
+                logger.info(
+                    "📸 sendImage phone=%s source=%s mimetype=%s",
+                    phone, image_url or "base64", payload["file"].get("mimetype")
+                )
             
             async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.waha_url}/api/sendImage",
-                    headers=self.headers,
-                    json=payload
-                )
-                logger.info(f"📸 Resposta WAHA: status={response.status_code}")
-                
+                with WahaCallTimer("sendImage") as call:
+                    response = await client.post(
+                        f"{self.waha_url}/api/sendImage",
+                        headers=self.headers,
+                        json=payload
+                    )
+                    call.status = response.status_code
                 if response.status_code in [200, 201]:
-                    logger.info(f"📸 Imagem enviada com sucesso!")
                     return {"success": True, "data": response.json()}
                 else:
                     error_body = response.text
-                    logger.error(f"📸 Erro ao enviar imagem: {response.status_code} - {error_body}")
+                    logger.error("📸 Erro ao enviar imagem: %s - %s", response.status_code, error_body)
                     return {"success": False, "error": f"HTTP {response.status_code}: {error_body}"}
         except Exception as e:
-            logger.error(f"📸 Exceção ao enviar imagem: {e}")
+            logger.error("📸 Exceção ao enviar imagem: %s", e)
             return {"success": False, "error": str(e)}
     
-    async def send_document_message(self, phone: str, caption: str, document_url: Optional[str] = None, document_base64: Optional[str] = None, filename: str = "document") -> Dict[str, Any]:
+    async def send_document_message(self, phone: str, caption: str, document_url: Optional[str] = None, document_base64: Optional[str] = None, filename: str = "document", mimetype: Optional[str] = None) -> Dict[str, Any]:
         chat_id = f"{normalize_phone(phone)}@c.us"
         try:
             payload = {
@@ -327,13 +337,17 @@ class WahaService:
                 payload["file"]["data"] = document_base64
             else:
                 return {"success": False, "error": "No document provided"}
+            if mimetype:
+                payload["file"]["mimetype"] = mimetype
             
             async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.waha_url}/api/sendFile",
-                    headers=self.headers,
-                    json=payload
-                )
+                with WahaCallTimer("sendFile") as call:
+                    response = await client.post(
+                        f"{self.waha_url}/api/sendFile",
+                        headers=self.headers,
+                        json=payload
+                    )
+                    call.status = response.status_code
                 if response.status_code in [200, 201]:
                     return {"success": True, "data": response.json()}
                 return {"success": False, "error": f"HTTP {response.status_code}"}
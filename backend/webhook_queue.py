@@ -0,0 +1,271 @@
+"""
+Webhook Queue
+Fila assíncrona limitada para webhooks de entrada do WAHA.
+
+- Pool fixo de consumidores; cada sessão sempre cai no mesmo consumidor
+  (ordem preservada por sessão)
+- Fila limitada: em sobrecarga o evento é descartado (ou gravado na tabela
+  de spill, se habilitado) e contabilizado nas métricas
+- Retry com backoff quando o handler levanta exceção
+- Spill durável opcional: eventos pendentes no shutdown/overflow vão para
+  a tabela 'waha_webhook_spill'; uma task em background os devolve à fila
+  quando há espaço, e eventos mais velhos que WAHA_QUEUE_SPILL_MAX_AGE são
+  descartados (conversa já esfriou, não vale responder)
+"""
+import os
+import asyncio
+import logging
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from supabase_service import get_supabase_service
+
+logger = logging.getLogger(__name__)
+
+SPILL_TABLE = 'waha_webhook_spill'
+
+# Resultados de enqueue()
+ENQUEUE_ACCEPTED = 'accepted'  # na fila em memória
+ENQUEUE_SPILLED = 'spilled'    # gravado no spill, volta para a fila quando houver espaço
+ENQUEUE_SHED = 'shed'          # descartado - o remetente precisa reenviar
+
+
+class WebhookQueue:
+    """Fila particionada por sessão com consumidores fixos"""
+
+    def __init__(self, handler: Callable[[dict], Awaitable[Any]]):
+        self.handler = handler
+        self.workers = int(os.getenv('WAHA_QUEUE_WORKERS', '8'))
+        self.maxsize = int(os.getenv('WAHA_QUEUE_MAXSIZE', '200'))  # por consumidor
+        self.max_retries = int(os.getenv('WAHA_QUEUE_MAX_RETRIES', '2'))
+        self.retry_delay = float(os.getenv('WAHA_QUEUE_RETRY_DELAY', '1'))
+        self.spill_enabled = os.getenv('WAHA_QUEUE_SPILL', 'false').lower() == 'true'
+        self.drain_timeout = float(os.getenv('WAHA_QUEUE_DRAIN_TIMEOUT', '10'))
+        self.spill_interval = float(os.getenv('WAHA_QUEUE_SPILL_INTERVAL', '5'))
+        self.spill_max_age = float(os.getenv('WAHA_QUEUE_SPILL_MAX_AGE', '900'))  # 0 = sem limite
+
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._running = False
+        self._spill_task: Optional[asyncio.Task] = None
+        # Outro processo pode ter gravado spill antes do startup - começa verificando
+        self._spill_pending = True
+        self.metrics: Dict[str, int] = {
+            'enqueued': 0,
+            'processed': 0,
+            'retried': 0,
+            'failed': 0,
+            'shed': 0,
+            'spilled': 0,
+            'restored': 0,
+            'expired': 0,
+        }
+
+    def _shard(self, payload: dict) -> int:
+        session = payload.get('session') or ''
+        return zlib.crc32(session.encode()) % len(self._queues)
+
+    async def start(self) -> None:
+        """Cria as filas, inicia os consumidores e a task que reprocessa o spill"""
+        if self._running:
+            return
+
+        self._queues = [asyncio.Queue(maxsize=self.maxsize) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._consume(q)) for q in self._queues]
+        self._running = True
+        logger.info(f"📥 Fila de webhooks WAHA iniciada: {self.workers} consumidores, {self.maxsize} por fila, spill={'on' if self.spill_enabled else 'off'}")
+
+        if self.spill_enabled:
+            self._spill_task = asyncio.create_task(self._drain_spill())
+
+    async def stop(self) -> None:
+        """Para os consumidores; eventos ainda na fila vão para o spill (se habilitado)"""
+        if not self._running:
+            return
+
+        self._running = False
+
+        if self._spill_task:
+            self._spill_task.cancel()
+            await asyncio.gather(self._spill_task, return_exceptions=True)
+            self._spill_task = None
+
+        # Dá um tempo para os consumidores esvaziarem as filas
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in self._queues)),
+                timeout=self.drain_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Timeout ao drenar fila de webhooks WAHA")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        pending = []
+        for q in self._queues:
+            while not q.empty():
+                pending.append(q.get_nowait())
+
+        if pending and self.spill_enabled:
+            await self._spill(pending)
+        elif pending:
+            logger.warning(f"⚠️ {len(pending)} webhooks WAHA descartados no shutdown")
+
+        self._tasks = []
+        self._queues = []
+
+    async def enqueue(self, payload: dict, wait: bool = False) -> str:
+        """
+        Enfileira um evento sem bloquear.
+
+        Args:
+            wait: Para reenfileiramentos internos (lote do debounce), que não
+                têm remetente para reenviar - espera vaga na fila em vez de descartar
+
+        Returns:
+            ENQUEUE_ACCEPTED, ENQUEUE_SPILLED (fila cheia, evento salvo no spill)
+            ou ENQUEUE_SHED (fila cheia e evento descartado)
+        """
+        if not self._running:
+            # Fila ainda não iniciada (ex: testes) - processa inline
+            await self.handler(payload)
+            return ENQUEUE_ACCEPTED
+
+        queue = self._queues[self._shard(payload)]
+        if wait:
+            await queue.put(payload)
+            self.metrics['enqueued'] += 1
+            return ENQUEUE_ACCEPTED
+
+        try:
+            queue.put_nowait(payload)
+            self.metrics['enqueued'] += 1
+            return ENQUEUE_ACCEPTED
+        except asyncio.QueueFull:
+            if self.spill_enabled and await self._spill([payload]):
+                return ENQUEUE_SPILLED
+            if not self.spill_enabled:
+                self.metrics['shed'] += 1
+                logger.warning(f"⚠️ Fila de webhooks cheia - evento da sessão {payload.get('session')} descartado")
+            return ENQUEUE_SHED
+
+    async def _consume(self, queue: asyncio.Queue) -> None:
+        while True:
+            payload = await queue.get()
+            try:
+                await self._handle(payload)
+            finally:
+                queue.task_done()
+
+    async def _handle(self, payload: dict) -> None:
+        # Retry no próprio consumidor, para não furar a ordem da sessão
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.handler(payload)
+                self.metrics['processed'] += 1
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt < self.max_retries:
+                    self.metrics['retried'] += 1
+                    await asyncio.sleep(self.retry_delay * (2 ** attempt))
+                    continue
+                self.metrics['failed'] += 1
+                logger.error(f"❌ Webhook WAHA falhou após {attempt + 1} tentativas: {e}")
+
+    async def _spill(self, items: List[dict]) -> bool:
+        """Grava eventos na tabela de spill; False se a gravação falhou (eventos perdidos)"""
+        try:
+            db = get_supabase_service()
+            rows = [{'session': p.get('session'), 'payload': p} for p in items]
+            db.client.table(SPILL_TABLE).insert(rows, returning='minimal').execute()
+            self.metrics['spilled'] += len(rows)
+            self._spill_pending = True
+            return True
+        except Exception as e:
+            self.metrics['shed'] += len(items)
+            logger.error(f"❌ Erro ao gravar spill de webhooks ({len(items)} eventos perdidos): {e}")
+            return False
+
+    async def _drain_spill(self) -> None:
+        """Devolve o spill à fila enquanto houver espaço (eventos de overflow não esperam o próximo deploy)"""
+        while self._running:
+            try:
+                if self._spill_pending:
+                    await self._restore_spill()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Erro ao restaurar spill de webhooks: {e}")
+            await asyncio.sleep(self.spill_interval)
+
+    async def _restore_spill(self, batch_size: int = 500) -> None:
+        db = get_supabase_service()
+
+        if self.spill_max_age > 0:
+            cutoff = (datetime.utcnow() - timedelta(seconds=self.spill_max_age)).isoformat()
+            expired = db.client.table(SPILL_TABLE).delete().lt('created_at', cutoff).execute()
+            if expired.data:
+                self.metrics['expired'] += len(expired.data)
+                logger.warning(f"⚠️ {len(expired.data)} webhooks WAHA do spill descartados (mais velhos que {self.spill_max_age:.0f}s)")
+
+        result = db.client.table(SPILL_TABLE)\
+            .select('id, session')\
+            .order('id')\
+            .limit(batch_size)\
+            .execute()
+        rows = result.data or []
+
+        # Só pega o que cabe agora; uma fila cheia segura o resto da sessão (mantém a ordem)
+        free = {i: self.maxsize - q.qsize() for i, q in enumerate(self._queues)}
+        candidate_ids = []
+        for row in rows:
+            shard = self._shard(row)
+            if free[shard] <= 0:
+                continue
+            free[shard] -= 1
+            candidate_ids.append(row['id'])
+
+        if candidate_ids:
+            # O delete reivindica as linhas: com vários processos cada evento volta uma vez só
+            claimed = db.client.table(SPILL_TABLE).delete().in_('id', candidate_ids).execute()
+            restored = 0
+            for row in sorted(claimed.data or [], key=lambda r: r['id']):
+                try:
+                    self._queues[self._shard(row['payload'])].put_nowait(row['payload'])
+                    restored += 1
+                except asyncio.QueueFull:
+                    # Não deve acontecer (nada roda entre a contagem e o put) - devolve ao spill
+                    await self._spill([row['payload']])
+            self.metrics['restored'] += restored
+            if restored:
+                logger.info(f"📥 {restored} webhooks WAHA restaurados do spill")
+
+        # Tudo o que havia coube na fila - só volta a consultar quando houver novo spill
+        if len(rows) < batch_size and len(candidate_ids) == len(rows):
+            self._spill_pending = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.metrics,
+            'running': self._running,
+            'workers': len(self._queues),
+            'depth': sum(q.qsize() for q in self._queues),
+            'capacity': self.maxsize * len(self._queues),
+        }
+
+
+# Singleton global
+_webhook_queue: Optional[WebhookQueue] = None
+
+
+def get_webhook_queue() -> WebhookQueue:
+    """Retorna instância singleton da fila de webhooks WAHA"""
+    global _webhook_queue
+    if _webhook_queue is None:
+        from agent_service import process_waha_message_for_n8n
+        _webhook_queue = WebhookQueue(process_waha_message_for_n8n)
+    return _webhook_queue